@@ -1,9 +1,15 @@
 from django.contrib import admin
 
-from chat.models import Room
+from chat.models import Message, Room
 
 admin.site.register(
     Room,
     list_display=["id", "title", "staff_only"],
     list_display_links=["id", "title"],
 )
+admin.site.register(
+    Message,
+    list_display=["id", "room", "username", "created"],
+    list_display_links=["id"],
+    raw_id_fields=["room", "user"],
+)
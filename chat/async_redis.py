@@ -0,0 +1,82 @@
+"""
+aioredis connection pools for the Redis backends, whose asyncio API the consumers
+use so they never block the event loop waiting for Redis.
+
+Every event loop gets its own pool per server, opened on first use and closed
+along with the loop like the ones of the channel layer. The pools are shared by
+all the backends of the process talking to the same server, concurrent commands
+are pipelined on their connections.
+"""
+import asyncio
+import hashlib
+from typing import Dict, List, Optional
+
+import aioredis
+from channels_redis.core import _wrap_close
+from django.conf import settings
+
+
+class AsyncRedis:
+    """The aioredis pools of one Redis server by event loop."""
+
+    def __init__(self, address: str):
+        self.address: str = address
+        self.pools: Dict[asyncio.AbstractEventLoop, asyncio.Future] = {}
+
+    async def get_pool(self) -> aioredis.Redis:
+        """Return the pool of the running event loop, opening it on first use."""
+        loop = asyncio.get_event_loop()
+        pool: Optional[asyncio.Future] = self.pools.get(loop)
+        if pool is None:
+            # Like the connection pools of the channel layer, closed before the loop closes
+            _wrap_close(loop, self)
+        if pool is None or pool.cancelled() or pool.done() and (pool.exception() or pool.result().closed):
+            pool = self.pools[loop] = asyncio.ensure_future(aioredis.create_redis_pool(
+                self.address, maxsize=settings.ASYNC_REDIS_POOL_SIZE,
+            ))
+        # Callers cancelled while it connects must not cancel it for the others
+        return await asyncio.shield(pool)
+
+    async def close_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Close the pool of the loop, called as it closes."""
+        pool: Optional[asyncio.Future] = self.pools.pop(loop, None)
+        if pool is None:
+            return
+        if not pool.done():
+            pool.cancel()
+        elif not pool.cancelled() and pool.exception() is None:
+            pool.result().close()
+            await pool.result().wait_closed()
+
+
+_clients: Dict[str, AsyncRedis] = {}
+
+
+def get_async_redis(address: Optional[str] = None) -> AsyncRedis:
+    """Return the pools of the server, ``ASYNC_REDIS_URL`` by default."""
+    address = address or settings.ASYNC_REDIS_URL
+    client: Optional[AsyncRedis] = _clients.get(address)
+    if client is None:
+        client = _clients[address] = AsyncRedis(address)
+    return client
+
+
+_script_shas: Dict[str, str] = {}
+
+
+def get_script_sha(script: str) -> str:
+    """Return the SHA1 Redis knows the Lua script by."""
+    sha: Optional[str] = _script_shas.get(script)
+    if sha is None:
+        sha = _script_shas[script] = hashlib.sha1(script.encode('utf8')).hexdigest()
+    return sha
+
+
+async def run_script(redis: aioredis.Redis, script: str, keys: List[str], args: list):
+    """Run the script by its SHA1, sending it whole when Redis doesn't know it yet like redis-py does."""
+    try:
+        return await redis.evalsha(get_script_sha(script), keys=keys, args=args)
+    except aioredis.ReplyError as error:
+        if not str(error).startswith('NOSCRIPT'):
+            raise
+        return await redis.eval(script, keys=keys, args=args)
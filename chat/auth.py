@@ -0,0 +1,229 @@
+"""
+Websocket authentication that resolves sessions to users through a process-local
+cache, a drop-in replacement for Channels' ``AuthMiddlewareStack``.
+
+After a deploy every client reconnects at once; without the cache each handshake
+loads its full user row, so the same users get queried over and over. Here each
+user is loaded at most once per ``USER_CACHE_TIMEOUT`` seconds per process, and
+concurrent handshakes of a user wait for the load already in flight instead of
+starting their own. Cached users are found on the event loop, only the loads
+take a database thread.
+
+The scope gets a ``CachedUser`` holding only what the consumer uses. Changes to
+users evict them through the signals in ``chat.signals``; other processes catch
+up once their entry expires.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import AnonymousUser
+from django.utils.crypto import constant_time_compare
+
+from chat.db import database_sync_to_async
+from users.models import User
+
+
+class CachedUser(NamedTuple):
+    """The subset of a User the consumer needs, safe to share between connections."""
+    id: int
+    username: str
+    name: str
+    is_staff: bool
+
+    @property
+    def pk(self) -> int:
+        return self.id
+
+    @property
+    def is_authenticated(self) -> bool:
+        return True
+
+    @property
+    def is_anonymous(self) -> bool:
+        return False
+
+    def __str__(self) -> str:
+        return self.username
+
+
+# A cached user along with the hash its sessions must carry, see get_session_auth_hash
+UserEntry = Tuple[CachedUser, str]
+
+
+class UserCache:
+    """
+    Process-local LRU cache of users with request coalescing: while a user is
+    being loaded, other coroutines of the event loop asking for them wait for that load.
+
+    Entries expire after ``USER_CACHE_TIMEOUT`` seconds and the least recently used
+    ones are evicted once there are more than ``USER_CACHE_SIZE`` of them.
+    """
+
+    def __init__(self):
+        self._users: 'OrderedDict[int, Tuple[float, UserEntry]]' = OrderedDict()
+        # The loads underway by event loop and user
+        self._loading: Dict[Tuple[asyncio.AbstractEventLoop, int], asyncio.Future] = {}
+        # Bumped by invalidate, so loads that started before don't store what they read
+        self._generation: int = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def get_cached(self, user_id: int) -> Optional[UserEntry]:
+        """Return the cached user, or None when it's unknown or has expired."""
+        with self._lock:
+            return self._get(user_id)
+
+    def _get(self, user_id: int) -> Optional[UserEntry]:
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at <= time.monotonic():
+            del self._users[user_id]
+            return None
+        self._users.move_to_end(user_id)
+        return user
+
+    async def get(
+        self, user_id: int, load: Callable[[int], Awaitable[Optional[UserEntry]]],
+    ) -> Optional[UserEntry]:
+        """Return the cached user, awaiting ``load`` for it unless that's underway already."""
+        user: Optional[UserEntry] = self.get_cached(user_id)
+        if user is not None:
+            return user
+        key = (asyncio.get_event_loop(), user_id)
+        loading: Optional[asyncio.Future] = self._loading.get(key)
+        if loading is None:
+            loading = self._loading[key] = asyncio.ensure_future(self._load(user_id, load))
+            loading.add_done_callback(lambda _: self._loading.pop(key, None))
+        # Callers cancelled while it loads must not cancel it for the others
+        return await asyncio.shield(loading)
+
+    async def _load(
+        self, user_id: int, load: Callable[[int], Awaitable[Optional[UserEntry]]],
+    ) -> Optional[UserEntry]:
+        with self._lock:
+            generation: int = self._generation
+        user: Optional[UserEntry] = await load(user_id)
+        with self._lock:
+            # Missing users aren't cached, their sessions are flushed anyway
+            if user is not None and generation == self._generation:
+                self._users[user_id] = (time.monotonic() + settings.USER_CACHE_TIMEOUT, user)
+                self._users.move_to_end(user_id)
+                while len(self._users) > settings.USER_CACHE_SIZE:
+                    self._users.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id: int) -> None:
+        """Forget the user so the next lookup goes to the database."""
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._generation += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+            self._generation += 1
+
+
+user_cache = UserCache()
+
+
+# Handshakes wait for a thread, there's no command to answer SERVER_BUSY to yet
+@database_sync_to_async(fail_fast=False)
+def load_user(user_id: int) -> Optional[UserEntry]:
+    """
+    Load the fields of the user the consumer needs, with the hash their sessions
+    must carry. Only active users can log in, like with ModelBackend.get_user.
+    """
+    user: Optional[User] = User.objects.filter(pk=user_id, is_active=True).only(
+        'id', 'username', 'name', 'is_staff', 'password',
+    ).first()
+    if user is None:
+        return None
+    return CachedUser(id=user.id, username=user.username, name=user.name, is_staff=user.is_staff), \
+        user.get_session_auth_hash()
+
+
+# Sessions live in the cache rather than the database, see SESSION_ENGINE
+@sync_to_async
+def get_session_auth(session) -> Optional[Tuple[int, Optional[str]]]:
+    """Return the user id and auth hash of the session, None when nobody logged in with our backends."""
+    try:
+        user_id: int = User._meta.pk.to_python(session[SESSION_KEY])
+        backend_path: str = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return None
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return None
+    return user_id, session.get(HASH_SESSION_KEY)
+
+
+async def get_user(scope: dict):
+    """
+    Return the cached user of the session in the scope, or an ``AnonymousUser``.
+
+    Checks the session like ``channels.auth.get_user`` does, flushing the ones
+    whose hash doesn't match the user's anymore, e.g. after a password change.
+    """
+    session = scope["session"]
+    auth: Optional[Tuple[int, Optional[str]]] = await get_session_auth(session)
+    if auth is None:
+        return AnonymousUser()
+    user_id, session_hash = auth
+    entry: Optional[UserEntry] = await user_cache.get(user_id, load_user)
+    if entry is None:
+        return AnonymousUser()
+    user, session_auth_hash = entry
+    if not session_hash or not constant_time_compare(session_hash, session_auth_hash):
+        await sync_to_async(session.flush)()
+        return AnonymousUser()
+    return user
+
+
+class CachedAuthMiddleware:
+    """
+    Middleware which populates scope["user"] from a Django session, through the user cache.
+    Requires SessionMiddleware to function.
+
+    Unlike Channels' AuthMiddleware the user is resolved once the application
+    instance runs rather than when it's built, as servers build it on their
+    event loop where it can't block on the session store or the database.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def __call__(self, scope):
+        if "session" not in scope:
+            raise ValueError("CachedAuthMiddleware cannot find session in scope. SessionMiddleware must be above it.")
+        return CachedAuthMiddlewareInstance(scope, self)
+
+
+class CachedAuthMiddlewareInstance:
+    """
+    Inner class that is instantiated once per scope.
+    """
+
+    def __init__(self, scope, middleware: CachedAuthMiddleware):
+        self.middleware: CachedAuthMiddleware = middleware
+        self.scope: dict = dict(scope)
+
+    async def __call__(self, receive, send):
+        if "user" not in self.scope:
+            self.scope["user"] = await get_user(self.scope)
+        return await self.middleware.inner(self.scope)(receive, send)
+
+
+def CachedAuthMiddlewareStack(inner):
+    """Cookies, sessions and cached users, like ``channels.auth.AuthMiddlewareStack``."""
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
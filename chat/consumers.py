@@ -1,13 +1,66 @@
-from typing import Set
+import asyncio
+import logging
+import secrets
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple, Union
 
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from django.conf import settings
 
+from chat import encoding
 from chat.exceptions import ClientError
-from chat.models import Room
-from chat.utils import get_room_or_error, cache_or_update_room_presence, get_presence_users, remove_user_from_presence
+from chat.metrics import Counter as MetricCounter, CounterCollector, Gauge, Histogram, publisher
+from chat.models import Message, get_room_group_name
+from chat.ratelimit import TokenBucket, rate_limit_stats, room_rate_limiter
+from chat.room_cache import CachedRoom, invalidation_listener
+from chat.presence import PresenceChange
+from chat.replay import RoomReplay
+from chat.utils import (
+    get_room_or_error, cache_or_update_room_presence, get_presence_snapshot,
+    get_room_history, get_rooms_or_errors, cache_or_update_rooms_presence, remove_user_from_rooms_presence,
+    parse_room_id, get_presence_changes, get_presence_delta_event, append_room_event,
+    replay_room_events, save_resume_token, use_resume_token,
+)
+from chat.writer import message_writer
 from users.models import User
 
+logger = logging.getLogger(__name__)
+
+# An encoded websocket frame, text for JSON and bytes for MessagePack
+Frame = Union[str, bytes]
+# When the oldest of its frames was queued, and the frames sent together as one
+OutboxEntry = Tuple[float, List[Frame]]
+
+# How many times each OUTBOUND_QUEUE_POLICY kicked in
+slow_consumer_stats: Counter = Counter()
+
+# The commands a client can send, anything else is counted as "unknown"
+COMMANDS = frozenset([
+    "join", "leave", "join_many", "leave_many", "send", "room_users", "presence_subscribe", "presence_unsubscribe",
+    "history", "resume", "ack",
+])
+
+OPEN_CONNECTIONS = Gauge('whisper_websocket_connections', 'Open websocket connections.')
+CONNECTIONS = MetricCounter(
+    'whisper_websocket_connections_total', 'Websocket handshakes, by whether they were accepted.', ['status'],
+)
+ROOMS_JOINED = Gauge('whisper_rooms_joined', 'Rooms joined, summed over the open websocket connections.')
+COMMANDS_RECEIVED = MetricCounter('whisper_commands_total', 'Websocket commands received.', ['command'])
+COMMAND_ERRORS = MetricCounter(
+    'whisper_command_errors_total', 'Websocket commands answered with an error.', ['command', 'error'],
+)
+COMMAND_DURATION = Histogram(
+    'whisper_command_duration_seconds', 'Time spent handling websocket commands.', ['command'],
+)
+CHANNEL_LAYER_DURATION = Histogram(
+    'whisper_channel_layer_duration_seconds', 'Time spent in channel layer calls.', ['operation'],
+)
+CounterCollector(
+    'whisper_slow_consumers_total', 'Times a full outbound queue was dealt with, by policy.', 'policy',
+    slow_consumer_stats,
+)
+
 
 class ChatConsumer(AsyncJsonWebsocketConsumer):
     """
@@ -17,20 +70,80 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     must be async functions, and any sync work (like ORM access) has to be
     behind database_sync_to_async or sync_to_async. For more, read
     http://channels.readthedocs.io/en/latest/topics/consumers.html
+    The ORM calls run in the bounded thread pool of chat.db, commands needing
+    it while its queue is full get a SERVER_BUSY error to retry later.
+
+    Frames are JSON text by default. Clients that offer the "whisper.msgpack"
+    websocket subprotocol get MessagePack binary frames both ways instead.
+
+    Rather than polling room_users, clients can send presence_subscribe once for
+    a room they joined: they get a snapshot with its presence version, then a
+    {"presence_delta": room, "version": ...} frame for every change. Versions
+    go up by one per change, on a gap they send room_users with the last version
+    they applied as "since_version" to get only the changes they missed.
+
+    Room messages carry the "seq" number of the room, and join replies the
+    current one along with the "resume_token" of the connection. After a
+    reconnect, clients send resume with that token and the last seq they saw
+    per room instead of joining again, see resume.
+
+    Clients may acknowledge the frames they got with {"command": "ack", "frames": n},
+    n being how many they received on this connection. Once they did, no more than
+    OUTBOUND_ACK_WINDOW frames are written ahead of their last ack; room events
+    wait in the outbox meanwhile, where OUTBOUND_QUEUE_POLICY deals with them if the
+    client can't keep up. The server's own write buffers don't push back, so for
+    the others the policy only sees how fast events are handed to the server.
     """
+    msgpack_subprotocol: str = "whisper.msgpack"
+
     # WebSocket event handlers
 
     async def connect(self):
         """Called when the websocket is handshaking as part of initial connection."""
+        # Pick the wire format
+        self.msgpack: bool = self.msgpack_subprotocol in self.scope.get("subprotocols", [])
         # Are they logged in?
-        if self.scope["user"].is_anonymous:
+        self.accepted: bool = not self.scope["user"].is_anonymous
+        if not self.accepted:
             # Reject the connection
+            CONNECTIONS.labels("rejected").inc()
             await self.close()
         else:
             # Accept the connection
-            await self.accept()
+            CONNECTIONS.labels("accepted").inc()
+            OPEN_CONNECTIONS.inc()
+            publisher.start()
+            invalidation_listener.start()
+            await self.accept(subprotocol=self.msgpack_subprotocol if self.msgpack else None)
         # Store which rooms the user has joined on this connection
         self.rooms: Set[int] = set()
+        # Lets the client get the rooms and missed messages of this connection back once it reconnects
+        self.resume_token: str = secrets.token_urlsafe(16)
+        # And when we last refreshed our presence in each of them
+        self.presence_heartbeats: Dict[int, float] = {}
+        # Rooms whose presence changes are pushed to the client
+        self.presence_subscriptions: Set[int] = set()
+        # Refreshes our presence in the rooms we are silent in, so it isn't swept
+        self.presence_keepalive_task: Optional[asyncio.Future] = None
+        # Commands the client may send, and how many in a row were rejected for going over it
+        self.rate_limit = TokenBucket(settings.CONNECTION_RATE_LIMIT, settings.CONNECTION_RATE_LIMIT_BURST)
+        self.rate_limited: int = 0
+        # Room events waiting to be written to the socket, each entry is sent as one frame
+        self.outbox: Deque[OutboxEntry] = deque()
+        self.outbox_frames: int = 0
+        self.outbox_task: Optional[asyncio.Future] = None
+        # Holds the outbox back while missed messages are replayed, so they go out first
+        self.outbox_paused: bool = False
+        # Frames written to the socket, and how many of them the client acknowledged if it does
+        self.frames_sent: int = 0
+        self.frames_acked: Optional[int] = None
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        """Called with a decoded WebSocket frame, decodes MessagePack frames for receive_json."""
+        if self.msgpack and bytes_data is not None:
+            await self.receive_json(encoding.unpackb(bytes_data), **kwargs)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
 
     async def receive_json(self, content, **kwargs):
         """
@@ -39,149 +152,618 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         """
         # Messages will have a "command" key we can switch on
         command = content.get("command", None)
+        metric_command: str = command if command in COMMANDS else "unknown"
+        COMMANDS_RECEIVED.labels(metric_command).inc()
+        rooms: int = len(self.rooms)
         try:
-            if command == "join":
-                # Make them join the room
-                await self.join_room(content["room"])
-            elif command == "leave":
-                # Leave the room
-                await self.leave_room(content["room"])
-            elif command == "send":
-                await self.send_room(content["room"], content["message"])
-            elif command == "room_users":
-                await self.room_users(content['room'])
+            with COMMAND_DURATION.labels(metric_command).time():
+                await self.run_command(command, content)
         except ClientError as e:
             # Catch any errors and send it back
+            COMMAND_ERRORS.labels(metric_command, e.code).inc()
             await self.send_json({"error": e.code})
+            if 0 < settings.RATE_LIMIT_CLOSE_AFTER <= self.rate_limited:
+                # Still flooding us after all these errors, drop them
+                rate_limit_stats['closed'] += 1
+                await self.close(code=1008)
+        finally:
+            ROOMS_JOINED.inc(len(self.rooms) - rooms)
+
+    async def run_command(self, command: str, content: dict):
+        """Switch on the command of a frame, errors are raised as ClientError."""
+        if command == "ack":
+            # Not throttled, they come as fast as the frames they acknowledge
+            self.acknowledge(content.get("frames"))
+            return
+        # Throttle before doing any work for the command
+        self.check_rate_limit(content)
+        if command == "join":
+            # Make them join the room
+            await self.join_room(content["room"])
+        elif command == "leave":
+            # Leave the room
+            await self.leave_room(content["room"])
+        elif command == "join_many":
+            await self.join_rooms(content["rooms"])
+        elif command == "leave_many":
+            await self.leave_rooms(content["rooms"])
+        elif command == "send":
+            await self.send_room(content["room"], content["message"])
+        elif command == "room_users":
+            await self.room_users(content['room'], content.get("since_version"))
+        elif command == "presence_subscribe":
+            await self.presence_subscribe(content["room"], content.get("since_version"))
+        elif command == "presence_unsubscribe":
+            self.presence_subscriptions.discard(parse_room_id(content["room"]))
+        elif command == "history":
+            await self.room_history(content["room"], content.get("before"), content.get("limit"))
+        elif command == "resume":
+            await self.resume(content.get("token"), content.get("rooms"))
 
     async def disconnect(self, code):
         """Called when the WebSocket closes for any reason."""
-        # Leave all the rooms we are still in
-        for room_id in list(self.rooms):
+        if self.accepted:
+            OPEN_CONNECTIONS.dec()
+        # Forget the events nobody is going to read
+        self.clear_outbox()
+        if self.outbox_task is not None:
+            self.outbox_task.cancel()
+        if self.presence_keepalive_task is not None:
+            self.presence_keepalive_task.cancel()
+        # Leave all the rooms we are still in, the client may resume them for a while
+        if self.rooms:
             try:
-                await self.leave_room(room_id)
+                await save_resume_token(self.resume_token, self.scope['user'].id, list(self.rooms))
+            except Exception:
+                logger.warning('Failed to save the rooms of %s', self.scope['user'].username, exc_info=True)
+            await self.leave_all_rooms()
+
+    # Command helper methods called by receive_json
+    def check_rate_limit(self, content: dict) -> None:
+        """
+        Raise RATE_LIMITED when the connection, or the user in the room of the
+        command, sends commands faster than their token bucket allows.
+        """
+        if not self.rate_limit.consume():
+            self.reject_rate_limited('connection')
+        if content.get("room") is not None:
+            try:
+                room_id: int = parse_room_id(content["room"])
             except ClientError:
+                # The command will fail on its own
                 pass
+            else:
+                if not room_rate_limiter.consume(self.scope['user'].id, room_id):
+                    self.reject_rate_limited('room')
+        self.rate_limited = 0
+
+    def reject_rate_limited(self, limit: str) -> None:
+        rate_limit_stats[limit] += 1
+        self.rate_limited += 1
+        raise ClientError("RATE_LIMITED")
 
-    # Command helper methods called by receive_json
     async def join_room(self, room_id: int):
         """Called by receive_json when someone sent a join command."""
         # The logged-in user is in our scope thanks to the authentication ASGI middleware
         user: User = self.scope['user']
-        room: Room = await get_room_or_error(room_id, user)
-        # Send a join message if it's turned on
-        if settings.NOTIFY_USERS_ON_ENTER_OR_LEAVE_ROOMS:
-            await self.channel_layer.group_send(
-                room.group_name,
-                {
-                    "type": "chat.join",
-                    "room_id": room_id,
-                    "username": user.username,
-                }
-            )
-        # Store that we're in the room
-        self.rooms.add(room_id)
-        await cache_or_update_room_presence(room_id, user)
-        # Add them to the group so they get room messages
-        await self.channel_layer.group_add(
-            room.group_name,
-            self.channel_name,
-        )
+        room: CachedRoom = await get_room_or_error(room_id, user)
+        changes, replays = await self.enter_rooms({room.id: room})
+        seq, _ = replays[room.id]
         # Instruct their client to finish opening the room
         await self.send_json({
             "join": str(room.id),
             "title": room.title,
+            "seq": seq,
+            "resume_token": self.resume_token,
         })
+        await self.push_presence_changes(changes, joined=True)
+
+    async def join_rooms(self, room_ids: List[int]):
+        """
+        Called by receive_json when someone sent a join_many command.
+
+        The rooms are looked up together and joined like a single one, then a
+        single frame acknowledges all of them.
+        """
+        rooms, errors = await get_rooms_or_errors(self.check_room_ids(room_ids), self.scope['user'])
+        changes, replays = await self.enter_rooms(rooms)
+        # Instruct their client to finish opening the rooms
+        await self.send_json({
+            "join_many": [
+                {"join": str(room.id), "title": room.title, "seq": replays[room.id][0]} for room in rooms.values()
+            ],
+            "errors": errors,
+            "resume_token": self.resume_token,
+        })
+        await self.push_presence_changes(changes, joined=True)
+
+    async def enter_rooms(
+        self, rooms: Dict[int, CachedRoom], since: Optional[Dict[int, int]] = None,
+    ) -> Tuple[Dict[int, PresenceChange], Dict[int, RoomReplay]]:
+        """
+        Join the rooms, returns the presence changes to push once the client got its
+        reply, and the replays of the rooms after the seqs in ``since``.
+
+        The join notices go out for all the rooms at once, the channel layer keeps
+        the groups in memory, then the presence is updated on the event loop while
+        a thread pool call reads the replays. The presence changes go out after the
+        reply, which leaves about two round trips to Redis before it instead of five.
+        """
+        user: User = self.scope['user']
+        since = since or {}
+        # Store that we're in the rooms
+        now: float = time.monotonic()
+        for room_id in rooms:
+            self.rooms.add(room_id)
+            self.presence_heartbeats[room_id] = now
+        self.start_presence_keepalive()
+        await asyncio.gather(*(self.enter_group(room_id) for room_id in rooms))
+        # After entering the groups, so the client gets every message past the seqs
+        changes, replays = await asyncio.gather(
+            cache_or_update_rooms_presence(rooms, user),
+            replay_room_events({room_id: since.get(room_id) for room_id in rooms}),
+        )
+        return changes, replays
+
+    async def resume(self, token: str, last_seqs: Dict[str, int]):
+        """
+        Called by receive_json when a reconnecting client sent a resume command, with
+        the resume token of its previous connection and the last seq it saw per room.
+
+        Joins the rooms of that connection again in one go, then sends the messages
+        the client missed in them before the {"resume": [...]} reply. Rooms whose
+        missed messages aren't all remembered anymore come back with "reset", the
+        client has to reload their history or show the gap. Messages may be sent twice around the
+        resume, clients skip the ones whose seq they already saw.
+        """
+        if not isinstance(token, str) or not isinstance(last_seqs, dict):
+            raise ClientError("RESUME_INVALID")
+        if len(last_seqs) > settings.MAX_ROOMS_PER_COMMAND:
+            raise ClientError("TOO_MANY_ROOMS")
+        try:
+            since: Dict[int, int] = {int(room_id): int(seq) for room_id, seq in last_seqs.items()}
+        except (TypeError, ValueError):
+            raise ClientError("RESUME_INVALID")
+        user: User = self.scope['user']
+        room_ids: Optional[List[int]] = await use_resume_token(token, user.id)
+        if room_ids is None:
+            # Too late, the client joins its rooms again instead
+            raise ClientError("RESUME_EXPIRED")
+        self.outbox_paused = True
+        try:
+            rooms, errors = await get_rooms_or_errors(room_ids, user)
+            changes, replays = await self.enter_rooms(rooms, since)
+            frames: List[Frame] = []
+            resumed: List[dict] = []
+            for room in rooms.values():
+                seq, events = replays[room.id]
+                for event in events or ():
+                    frames.append(encoding.packb(encoding.loads(event)) if self.msgpack else event)
+                resumed.append({"join": str(room.id), "title": room.title, "seq": seq, "reset": events is None})
+            if frames:
+                await self.send_frames(frames)
+            await self.send_json({"resume": resumed, "errors": errors, "resume_token": self.resume_token})
+            await self.push_presence_changes(changes, joined=True)
+        finally:
+            self.outbox_paused = False
+            self.drain_outbox_soon()
 
     async def leave_room(self, room_id: int):
         """Called by receive_json when someone sent a leave command."""
         # The logged-in user is in our scope thanks to the authentication ASGI middleware
         user: User = self.scope['user']
-        room: Room = await get_room_or_error(room_id, user)
-        # Send a leave message if it's turned on
-        if settings.NOTIFY_USERS_ON_ENTER_OR_LEAVE_ROOMS:
-            await self.channel_layer.group_send(
-                room.group_name,
-                {
-                    "type": "chat.leave",
-                    "room_id": room_id,
-                    "username": user.username,
-                }
-            )
-        # Remove that we're in the room
-        self.rooms.discard(room_id)
-        await remove_user_from_presence(room_id, user.id)
-
-        # Remove them from the group so they no longer get room messages
-        await self.channel_layer.group_discard(
-            room.group_name,
-            self.channel_name,
-        )
+        room: CachedRoom = await get_room_or_error(room_id, user)
+        changes: Dict[int, PresenceChange] = await self.exit_rooms([room.id])
         # Instruct their client to finish closing the room
         await self.send_json({
             "leave": str(room.id),
         })
+        await self.push_presence_changes(changes)
+
+    async def leave_rooms(self, room_ids: List[int]):
+        """Called by receive_json when someone sent a leave_many command, the counterpart of join_rooms."""
+        rooms, errors = await get_rooms_or_errors(self.check_room_ids(room_ids), self.scope['user'])
+        changes: Dict[int, PresenceChange] = await self.exit_rooms(list(rooms))
+        # Instruct their client to finish closing the rooms
+        await self.send_json({
+            "leave_many": [str(room_id) for room_id in rooms],
+            "errors": errors,
+        })
+        await self.push_presence_changes(changes)
+
+    async def exit_rooms(self, room_ids: List[int]) -> Dict[int, PresenceChange]:
+        """Leave the rooms, the counterpart of enter_rooms, returns the presence changes to push."""
+        user: User = self.scope['user']
+        # Remove that we're in the rooms
+        for room_id in room_ids:
+            self.rooms.discard(room_id)
+            self.presence_heartbeats.pop(room_id, None)
+            self.presence_subscriptions.discard(room_id)
+        changes, *_ = await asyncio.gather(
+            remove_user_from_rooms_presence(room_ids, user.id),
+            *(self.exit_group(room_id) for room_id in room_ids),
+        )
+        return changes
+
+    @staticmethod
+    def check_room_ids(room_ids: List[int]) -> List[int]:
+        """Validate the room list of the join_many and leave_many commands."""
+        if not isinstance(room_ids, list):
+            raise ClientError("ROOMS_INVALID")
+        if len(room_ids) > settings.MAX_ROOMS_PER_COMMAND:
+            raise ClientError("TOO_MANY_ROOMS")
+        return room_ids
+
+    async def leave_all_rooms(self) -> None:
+        """
+        Called on disconnect to leave every room of the connection at once.
+
+        Unlike exit_rooms this carries on when some of it fails, and pushes the
+        presence changes without writing to the socket, which is already closed.
+        """
+        user: User = self.scope['user']
+        room_ids: List[int] = list(self.rooms)
+        ROOMS_JOINED.dec(len(room_ids))
+        self.rooms.clear()
+        self.presence_heartbeats.clear()
+        self.presence_subscriptions.clear()
+        results: list = await asyncio.gather(
+            remove_user_from_rooms_presence(room_ids, user.id),
+            *(self.exit_group(room_id) for room_id in room_ids),
+            return_exceptions=True,
+        )
+        if not isinstance(results[0], Exception):
+            try:
+                await self.push_presence_changes(results[0])
+            except Exception as e:
+                results.append(e)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning('Failed to clean up after %s left', user.username, exc_info=result)
+
+    async def enter_group(self, room_id: int) -> None:
+        """Announce the user in the room, then add them to its group so they get room messages."""
+        await self.announce(room_id, "chat.join", settings.MSG_TYPE_ENTER)
+        with CHANNEL_LAYER_DURATION.labels("group_add").time():
+            await self.channel_layer.group_add(get_room_group_name(room_id), self.channel_name)
+
+    async def exit_group(self, room_id: int) -> None:
+        """Announce the user is leaving the room, then remove them from its group."""
+        await self.announce(room_id, "chat.leave", settings.MSG_TYPE_LEAVE)
+        with CHANNEL_LAYER_DURATION.labels("group_discard").time():
+            await self.channel_layer.group_discard(get_room_group_name(room_id), self.channel_name)
+
+    async def announce(self, room_id: int, event_type: str, msg_type: int) -> None:
+        """Send the join or leave notice of the user to the room, if it's turned on."""
+        if not settings.NOTIFY_USERS_ON_ENTER_OR_LEAVE_ROOMS:
+            return
+        event: dict = await self.encode_event(event_type, {
+            "msg_type": msg_type,
+            "room": room_id,
+            "username": self.scope['user'].username,
+        })
+        with CHANNEL_LAYER_DURATION.labels("group_send").time():
+            await self.channel_layer.group_send(get_room_group_name(room_id), event)
 
     async def send_room(self, room_id: int, message: str):
         """Called by receive_json when someone sends a message to a room."""
         # Check they are in this room
+        room_id = parse_room_id(room_id)
         if room_id not in self.rooms:
             raise ClientError("ROOM_ACCESS_DENIED")
+        # Text only, PostgreSQL can't store NUL characters
+        if not isinstance(message, str) or "\x00" in message:
+            raise ClientError("MESSAGE_INVALID")
+        if len(message) > settings.MAX_MESSAGE_LENGTH:
+            raise ClientError("MESSAGE_TOO_LONG")
+        # The database is too far behind to take one more
+        if message_writer.full:
+            raise ClientError("SERVER_BUSY")
         # Get the room and send to the group about it
-        room: Room = await get_room_or_error(room_id, self.scope["user"])
+        room: CachedRoom = await get_room_or_error(room_id, self.scope["user"])
         user: User = self.scope['user']
-        await self.channel_layer.group_send(
-            room.group_name,
-            {
-                "type": "chat.message",
-                "room_id": room_id,
-                "username": user.username,
-                "message": message,
-            }
-        )
-        await cache_or_update_room_presence(room_id, user)
+        content: dict = {
+            "msg_type": settings.MSG_TYPE_MESSAGE,
+            "room": room.id,
+            "username": user.username,
+            "message": message,
+        }
+        # Numbered and kept for the clients that will resume, encoded there on the way
+        seq, text = await append_room_event(room.id, content)
+        event: dict = {
+            "type": "chat.message",
+            "text": text,
+            "bytes": encoding.packb({"seq": seq, **content}),
+        }
+        with CHANNEL_LAYER_DURATION.labels("group_send").time():
+            await self.channel_layer.group_send(room.group_name, event)
+        message_writer.write(room.id, user, message)
+        await self.presence_heartbeat(room_id)
+
+    async def presence_heartbeat(self, room_id: int) -> None:
+        """
+        Refresh our presence in the room, at most once per ROOM_PRESENCE_HEARTBEAT_INTERVAL
+        so chatty users don't rewrite their presence on every message.
+        """
+        now: float = time.monotonic()
+        last_heartbeat: float = self.presence_heartbeats.get(room_id)
+        if last_heartbeat is not None and now - last_heartbeat < settings.ROOM_PRESENCE_HEARTBEAT_INTERVAL:
+            return
+        self.presence_heartbeats[room_id] = now
+        change: Optional[PresenceChange] = await cache_or_update_room_presence(room_id, self.scope['user'])
+        # Only when the user data itself changed, refreshing it doesn't count
+        await self.push_presence_changes({room_id: change} if change else {})
+
+    def start_presence_keepalive(self) -> None:
+        if self.presence_keepalive_task is None and settings.ROOM_PRESENCE_KEEPALIVE_INTERVAL:
+            self.presence_keepalive_task = asyncio.ensure_future(self.keep_presence_alive())
+
+    async def keep_presence_alive(self) -> None:
+        """
+        Refresh our presence in the rooms we didn't send anything to for
+        ROOM_PRESENCE_KEEPALIVE_INTERVAL, all at once, so the presence sweeper
+        only removes users who are really gone.
+        """
+        interval: int = settings.ROOM_PRESENCE_KEEPALIVE_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            now: float = time.monotonic()
+            room_ids: List[int] = [
+                room_id for room_id, last_heartbeat in self.presence_heartbeats.items()
+                if now - last_heartbeat >= interval
+            ]
+            if not room_ids:
+                continue
+            for room_id in room_ids:
+                self.presence_heartbeats[room_id] = now
+            try:
+                await self.push_presence_changes(await cache_or_update_rooms_presence(room_ids, self.scope['user']))
+            except Exception:
+                logger.warning('Failed to refresh the presence of %s', self.scope['user'].username, exc_info=True)
+
+    async def push_presence_changes(self, changes: Dict[int, PresenceChange], joined: bool = False) -> None:
+        """
+        Send presence changes to their rooms, the consumers subscribed to them forward them.
+
+        The changes of our own joins are pushed after the join reply, by then any
+        presence the client asks for has them already, so they skip this consumer.
+        """
+        events: List[dict] = [get_presence_delta_event(room_id, change) for room_id, change in changes.items()]
+        if joined:
+            for event in events:
+                event["sender"] = self.channel_name
+        with CHANNEL_LAYER_DURATION.labels("group_send").time():
+            await asyncio.gather(*(
+                self.channel_layer.group_send(get_room_group_name(event["room"]), event) for event in events
+            ))
 
-    async def room_users(self, room_id: int) -> None:
-        """Called when asking for list of the online users in the room."""
+    async def room_history(self, room_id: int, before: Optional[int] = None, limit: Optional[int] = None) -> None:
+        """
+        Called when asking for the messages of a room, a page at a time.
+
+        Pages go from the newest message backwards; pass the returned "before"
+        cursor to get the next one, it's None once there's nothing older left.
+
+        Messages are saved in batches, see chat.writer: the first page ends with the
+        ones of this process not saved yet, whose "id" may be None. Those sent
+        through other processes show up once they saved them.
+        """
+        room: CachedRoom = await get_room_or_error(room_id, self.scope['user'])
+        try:
+            before = int(before) if before is not None else None
+            limit = min(int(limit or settings.HISTORY_PAGE_SIZE), settings.HISTORY_MAX_PAGE_SIZE)
+        except (TypeError, ValueError):
+            raise ClientError("HISTORY_INVALID")
+        if limit < 1:
+            raise ClientError("HISTORY_INVALID")
+        # The messages of this process not saved yet go on top of the first page, so senders see what they
+        # just sent. Taken before the query, which may find some of them saved by then
+        unsaved: List[Message] = message_writer.unsaved(room.id) if before is None else []
+        # Ask for one extra message to know whether there is another page
+        messages: List[dict] = await get_room_history(room.id, before, limit + 1)
+        has_more: bool = len(messages) > limit
+        messages = messages[:limit]
+        saved: Set[tuple] = {(message["username"], message["message"], message["created"]) for message in messages}
+        await self.send_json({
+            "history": room.id,
+            "messages": [
+                {
+                    "id": message["id"],
+                    "username": message["username"],
+                    "message": message["message"],
+                    "created": message["created"].timestamp(),
+                }
+                for message in reversed(messages)
+            ] + [
+                {
+                    "id": message.id,
+                    "username": message.username,
+                    "message": message.message,
+                    "created": message.created.timestamp(),
+                }
+                for message in unsaved if (message.username, message.message, message.created) not in saved
+            ],
+            "before": messages[-1]["id"] if has_more else None,
+        })
+
+    async def room_users(self, room_id: int, since_version: Optional[int] = None) -> None:
+        """
+        Called when asking for list of the online users in the room.
+
+        With ``since_version`` only the changes made after that version are sent,
+        unless they are too old to be known anymore.
+        """
+        data: Optional[dict] = None
+        if since_version is not None:
+            try:
+                since_version = int(since_version)
+            except (TypeError, ValueError):
+                raise ClientError("PRESENCE_VERSION_INVALID")
+            changes = await get_presence_changes(room_id, since_version)
+            if changes is not None:
+                data = {'version': changes[0], 'changes': changes[1]}
+        if data is None:
+            version, users = await get_presence_snapshot(room_id)
+            data = {'version': version, 'users': users}
         await self.send_json({
             'type': settings.MSG_TYPE_INTERNAL,
             'room': room_id,
-            'data': {'users': await get_presence_users(room_id)}
+            'data': data,
         })
 
+    async def presence_subscribe(self, room_id: int, since_version: Optional[int] = None) -> None:
+        """Called when asking for the presence changes of a joined room to be pushed, replies like room_users."""
+        room_id = parse_room_id(room_id)
+        if room_id not in self.rooms:
+            raise ClientError("ROOM_ACCESS_DENIED")
+        # Subscribe first, so no change falls between the reply and the first delta
+        self.presence_subscriptions.add(room_id)
+        await self.room_users(room_id, since_version)
+
     # Handlers for messages sent over the channel layer
 
     # These helper methods are named by the types we send - so chat.join becomes chat_join
     async def chat_join(self, event: dict):
         """Called when someone has joined our chat."""
-        # Send a message down to the client
-        await self.send_json(
-            {
-                "msg_type": settings.MSG_TYPE_ENTER,
-                "room": event["room_id"],
-                "username": event["username"],
-            },
-        )
+        await self.send_event(event)
 
     async def chat_leave(self, event: dict):
         """Called when someone has left our chat."""
-        # Send a message down to the client
-        await self.send_json(
-            {
-                "msg_type": settings.MSG_TYPE_LEAVE,
-                "room": event["room_id"],
-                "username": event["username"],
-            },
-        )
+        await self.send_event(event)
 
     async def chat_message(self, event: dict):
         """Called when someone has messaged our chat."""
-        # Send a message down to the client
-        await self.send_json(
-            {
-                "msg_type": settings.MSG_TYPE_MESSAGE,
-                "room": event["room_id"],
-                "username": event["username"],
-                "message": event["message"],
-            },
-        )
+        await self.send_event(event)
+
+    async def presence_delta(self, event: dict):
+        """Called when the presence of a room we are in has changed."""
+        if event["room"] in self.presence_subscriptions and event.get("sender") != self.channel_name:
+            await self.send_event(event)
+
+    # Encoding helpers
+
+    async def encode_event(self, event_type: str, content: dict) -> dict:
+        """
+        Build a channel layer event carrying the frame already encoded in every
+        wire format, so it's encoded once here rather than once per recipient.
+        """
+        return {
+            "type": event_type,
+            "text": await self.encode_json(content),
+            "bytes": encoding.packb(content),
+        }
+
+    async def send_event(self, event: dict) -> None:
+        """
+        Queue the already encoded frame of an event for the client.
+
+        Events queued within the same loop tick are written as a single
+        {"batch": [...]} frame. OUTBOUND_QUEUE_POLICY decides what happens to clients
+        that can't keep up: once OUTBOUND_QUEUE_SIZE entries or OUTBOUND_QUEUE_MAX_FRAMES
+        frames are queued, or the oldest of them waited OUTBOUND_QUEUE_MAX_DELAY seconds.
+        """
+        now: float = time.monotonic()
+        if self.outbox and (
+            len(self.outbox) >= settings.OUTBOUND_QUEUE_SIZE
+            or self.outbox_frames >= settings.OUTBOUND_QUEUE_MAX_FRAMES
+            or now - self.outbox[0][0] >= settings.OUTBOUND_QUEUE_MAX_DELAY
+        ) and not await self.handle_full_outbox(now):
+            return
+        self.outbox.append((now, [event["bytes"] if self.msgpack else event["text"]]))
+        self.outbox_frames += 1
+        self.drain_outbox_soon()
+
+    def clear_outbox(self) -> List[OutboxEntry]:
+        """Empty the outbox, returns what was in it."""
+        entries: List[OutboxEntry] = list(self.outbox)
+        self.outbox.clear()
+        self.outbox_frames = 0
+        return entries
+
+    def drain_outbox_soon(self) -> None:
+        if self.outbox and self.outbox_task is None and not self.outbox_paused and not self.ack_window_full():
+            # Starts on the next loop tick, so whatever arrives until then is coalesced
+            self.outbox_task = asyncio.ensure_future(self.drain_outbox())
+
+    async def handle_full_outbox(self, now: float) -> bool:
+        """Make room in the outbox, returns False when the event should be dropped instead."""
+        policy: str = settings.OUTBOUND_QUEUE_POLICY
+        slow_consumer_stats[policy] += 1
+        if policy == 'drop_oldest':
+            # Both what doesn't fit anymore and what waited too long
+            while self.outbox and (
+                len(self.outbox) >= settings.OUTBOUND_QUEUE_SIZE
+                or self.outbox_frames >= settings.OUTBOUND_QUEUE_MAX_FRAMES
+                or now - self.outbox[0][0] >= settings.OUTBOUND_QUEUE_MAX_DELAY
+            ):
+                self.outbox_frames -= len(self.outbox.popleft()[1])
+        elif (
+            policy == 'coalesce'
+            and self.outbox_frames < settings.OUTBOUND_QUEUE_MAX_FRAMES
+            and now - self.outbox[0][0] < settings.OUTBOUND_QUEUE_MAX_DELAY
+        ):
+            # Everything queued goes out as a single batch frame, as old as its oldest event
+            entries: List[OutboxEntry] = self.clear_outbox()
+            frames: List[Frame] = [frame for _, entry in entries for frame in entry]
+            self.outbox.append((entries[0][0], frames))
+            self.outbox_frames = len(frames)
+        else:
+            # Let them reconnect and catch up, rather than buffering for them forever
+            self.clear_outbox()
+            await self.send_json({"error": "SLOW_CONSUMER", "resume": True})
+            await self.close(code=1013)
+            return False
+        return True
+
+    async def drain_outbox(self) -> None:
+        """Write the queued events to the socket."""
+        try:
+            while self.outbox and not self.ack_window_full():
+                entries: List[List[Frame]] = [entry for _, entry in self.clear_outbox()]
+                if settings.OUTBOUND_COALESCE:
+                    entries = [[frame for entry in entries for frame in entry]]
+                for frames in entries:
+                    await self.send_frames(frames)
+        finally:
+            self.outbox_task = None
+
+    def ack_window_full(self) -> bool:
+        """Whether the client has OUTBOUND_ACK_WINDOW frames it didn't acknowledge yet, if it acknowledges them."""
+        return self.frames_acked is not None and self.frames_sent - self.frames_acked >= settings.OUTBOUND_ACK_WINDOW
+
+    def acknowledge(self, frames) -> None:
+        """Called by receive_json when the client acknowledged the frames it got, resumes writing the outbox."""
+        acked: int = self.frames_acked or 0
+        if not isinstance(frames, int) or not acked <= frames <= self.frames_sent:
+            raise ClientError("ACK_INVALID")
+        self.frames_acked = frames
+        self.drain_outbox_soon()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        """Send a frame, counting it for clients acknowledging them."""
+        if text_data is not None or bytes_data is not None:
+            self.frames_sent += 1
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def send_frames(self, frames: List[Frame]) -> None:
+        """Send already encoded frames down to the client, batched when there are several of them."""
+        if self.msgpack:
+            await self.send(bytes_data=frames[0] if len(frames) == 1 else encoding.batch_bytes(frames))
+        else:
+            await self.send(text_data=frames[0] if len(frames) == 1 else encoding.batch_text(frames))
+
+    async def send_json(self, content, close=False):
+        """Encode the given content in the wire format of the connection and send it to the client."""
+        if self.msgpack:
+            await self.send(bytes_data=encoding.packb(content), close=close)
+        else:
+            # Not super().send_json, which goes around our send
+            await self.send(text_data=await self.encode_json(content), close=close)
+
+    @classmethod
+    async def decode_json(cls, text_data: str):
+        return encoding.loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content) -> str:
+        return encoding.dumps(content)
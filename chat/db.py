@@ -0,0 +1,141 @@
+"""
+The thread pool running the ORM calls of the websocket consumers.
+
+``channels.db.database_sync_to_async`` runs them in the default executor of the
+event loop, shared with everything else calling ``run_in_executor`` and queueing
+without bounds: a slow database only shows up as ever growing latencies. The
+``database_sync_to_async`` of this module runs them in ``DB_EXECUTOR_WORKERS``
+threads of their own instead, and once ``DB_EXECUTOR_QUEUE_SIZE`` calls are
+waiting for one, further commands fail right away with ``SERVER_BUSY``.
+
+Each thread keeps its database connection open for ``CONN_MAX_AGE`` seconds, so
+calls don't pay for connecting. One that sat idle for ``DB_HEALTH_CHECK_INTERVAL``
+is checked before use, and replaced when the database dropped it meanwhile.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from chat.exceptions import ClientError
+from chat.metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+DB_QUEUE_DEPTH = Gauge('whisper_db_queue_depth', 'ORM calls waiting for a database thread.')
+DB_THREADS_BUSY = Gauge('whisper_db_threads_busy', 'Database threads running an ORM call.')
+DB_WAIT_DURATION = Histogram('whisper_db_wait_seconds', 'Time ORM calls waited for a database thread.')
+DB_REJECTED = Counter('whisper_db_rejected_total', 'ORM calls rejected with SERVER_BUSY as the queue was full.')
+DB_CONNECTIONS_REPLACED = Counter(
+    'whisper_db_connections_replaced_total', 'Database connections found broken by the health checks.',
+)
+
+
+class DatabaseExecutor:
+    """
+    Bounded thread pool for ORM calls, see the module docstring.
+
+    Only counts the calls waiting for a thread, the ones running are bounded by
+    the number of threads already.
+    """
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        # When each thread last used its connections
+        self._local = threading.local()
+        self.queued: int = 0
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(settings.DB_EXECUTOR_WORKERS, thread_name_prefix='whisper-db')
+        return self._executor
+
+    def submit(self, func: Callable, fail_fast: bool = True) -> Future:
+        """
+        Queue the call for a database thread. Raises SERVER_BUSY when ``fail_fast``
+        and the queue is full, otherwise it's queued anyway.
+        """
+        with self._lock:
+            if fail_fast and self.queued >= settings.DB_EXECUTOR_QUEUE_SIZE:
+                DB_REJECTED.inc()
+                raise ClientError("SERVER_BUSY")
+            self.queued += 1
+        DB_QUEUE_DEPTH.inc()
+        future: Future = self.executor.submit(self.run, time.perf_counter(), func)
+        # Cancelled before a thread took it, it never runs
+        future.add_done_callback(lambda future: future.cancelled() and self.dequeue())
+        return future
+
+    def dequeue(self) -> None:
+        with self._lock:
+            self.queued -= 1
+        DB_QUEUE_DEPTH.dec()
+
+    def run(self, queued_at: float, func: Callable):
+        self.dequeue()
+        DB_WAIT_DURATION.labels().observe(time.perf_counter() - queued_at)
+        DB_THREADS_BUSY.inc()
+        try:
+            self.check_connections()
+            return func()
+        finally:
+            self._local.last_used = time.monotonic()
+            DB_THREADS_BUSY.dec()
+
+    def check_connections(self) -> None:
+        """Close the connections of the thread the database dropped while they were idle, they reconnect on use."""
+        last_used: Optional[float] = getattr(self._local, 'last_used', None)
+        if last_used is None or time.monotonic() - last_used < settings.DB_HEALTH_CHECK_INTERVAL:
+            return
+        for connection in connections.all():
+            if connection.connection is not None and not connection.is_usable():
+                logger.warning('Replacing the broken connection to the %s database', connection.alias)
+                DB_CONNECTIONS_REPLACED.inc()
+                connection.close()
+
+
+db_executor = DatabaseExecutor()
+
+
+class BoundedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """``DatabaseSyncToAsync`` running in the bounded ``db_executor``."""
+
+    def __init__(self, func: Callable, fail_fast: bool = True):
+        super().__init__(func)
+        self.fail_fast: bool = fail_fast
+
+    async def __call__(self, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        future: Future = db_executor.submit(
+            functools.partial(self.thread_handler, loop, *args, **kwargs), fail_fast=self.fail_fast,
+        )
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def thread_handler(self, loop, *args, **kwargs):
+        # Like each request does, so connections past CONN_MAX_AGE or broken by an error aren't used
+        close_old_connections()
+        return super().thread_handler(loop, *args, **kwargs)
+
+
+def database_sync_to_async(func: Optional[Callable] = None, *, fail_fast: bool = True):
+    """
+    Turn the ORM calling function into an async one running in ``db_executor``,
+    like ``channels.db.database_sync_to_async``.
+
+    Calls made while the queue is full raise SERVER_BUSY, unless ``fail_fast`` is
+    False for the ones that can't be refused, e.g. saving messages already sent.
+    """
+    if func is None:
+        return functools.partial(database_sync_to_async, fail_fast=fail_fast)
+    return BoundedDatabaseSyncToAsync(func, fail_fast)
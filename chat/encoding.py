@@ -0,0 +1,52 @@
+"""
+Encoding of websocket frames.
+
+JSON uses orjson when it's installed, which is several times faster than the
+json module for the small frames we send, and falls back to json otherwise.
+Clients on the msgpack subprotocol get MessagePack binary frames instead.
+"""
+import json
+from typing import Any, List
+
+import msgpack
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(content: Any) -> str:
+    """Encode the content as a JSON string."""
+    if orjson is not None:
+        # Presence is keyed by user id, which orjson only allows with OPT_NON_STR_KEYS
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(content)
+
+
+def loads(text_data: str) -> Any:
+    """Decode a JSON string."""
+    if orjson is not None:
+        return orjson.loads(text_data)
+    return json.loads(text_data)
+
+
+def packb(content: Any) -> bytes:
+    """Encode the content with MessagePack, for clients on the msgpack subprotocol."""
+    return msgpack.packb(content, use_bin_type=True)
+
+
+def unpackb(bytes_data: bytes) -> Any:
+    """Decode a MessagePack frame."""
+    return msgpack.unpackb(bytes_data, raw=False)
+
+
+def batch_text(texts: List[str]) -> str:
+    """Wrap already encoded JSON frames into a single {"batch": [...]} frame without decoding them."""
+    return '{"batch":[' + ','.join(texts) + ']}'
+
+
+def batch_bytes(frames: List[bytes]) -> bytes:
+    """Wrap already encoded MessagePack frames into a single {"batch": [...]} frame without decoding them."""
+    packer = msgpack.Packer(use_bin_type=True)
+    return packer.pack_map_header(1) + packer.pack('batch') + packer.pack_array_header(len(frames)) + b''.join(frames)
@@ -0,0 +1,374 @@
+"""
+A Redis channel layer that fans group messages out in process.
+
+channels_redis sends a group message to every member channel through Redis, so
+a room of 3,000 users connected to the same worker costs 3,000 pushes into
+Redis and 3,000 pops out of it. ``HybridChannelLayer`` keeps the groups of the
+channels of its own process in memory and hands group messages straight to
+them. The other workers get one copy per group through Redis pub/sub, and fan
+it out to their own members in turn, so the cost of a group send grows with
+the number of workers instead of the number of members.
+
+Only the event loop the channels of the process receive on keeps groups in
+memory. Channels added from any other loop (e.g. ``async_to_sync`` in a
+thread), channels of other processes, and the ones that aren't process
+specific are grouped through Redis like with ``RedisChannelLayer``, and group
+sends reach them that way. Every process sending to the groups has to use this
+layer though, as the members kept in memory are only reached through pub/sub.
+
+Pub/sub doesn't queue: a worker that is reconnecting to Redis misses what was
+published to its groups meanwhile. Local members all get the same message
+values rather than their own copy, treat received messages as read-only.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set
+
+import aioredis
+from aioredis.pubsub import Receiver
+from channels_redis.core import RedisChannelLayer, _wrap_close
+
+logger = logging.getLogger(__name__)
+
+
+class FanoutSubscriber:
+    """
+    The pub/sub connection of the layer to one Redis host, subscribed to the fan-out
+    channels of the groups that have members in the process. Reconnects and
+    subscribes again when the connection is lost.
+    """
+
+    def __init__(self, layer: 'HybridChannelLayer', index: int):
+        self.layer: HybridChannelLayer = layer
+        self.index: int = index
+        self.connection = None
+        self.receiver: Optional[Receiver] = None
+        self.reader: Optional[asyncio.Future] = None
+        # The fan-out channels subscribed to
+        self.names: Set[str] = set()
+        self.closed: bool = False
+
+    async def connect(self) -> None:
+        self.connection = await aioredis.create_redis(**self.layer.hosts[self.index])
+        self.receiver = Receiver()
+        # The control channel is never unsubscribed from, or the receiver would stop along with the last group
+        await self.connection.subscribe(*(
+            self.receiver.channel(name) for name in [self.layer.fanout_control_name, *self.names]
+        ))
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def subscribe(self, name: str) -> None:
+        self.names.add(name)
+        if self.connection is None:
+            await self.connect()
+        else:
+            await self.connection.subscribe(self.receiver.channel(name))
+
+    async def unsubscribe(self, name: str) -> None:
+        self.names.discard(name)
+        if self.connection is not None:
+            await self.connection.unsubscribe(name)
+
+    async def read(self) -> None:
+        receiver: Receiver = self.receiver
+        while await receiver.wait_message():
+            sender, payload = await receiver.get()
+            try:
+                self.layer.receive_published(sender.name.decode('utf8'), payload)
+            except Exception:
+                logger.exception('Failed to fan out a message of %s', sender.name)
+        if self.closed:
+            return
+        logger.warning('Lost the fan-out connection to Redis host %s, reconnecting', self.index)
+        self.connection = None
+        while not self.closed:
+            try:
+                async with self.layer.subscription_lock:
+                    if self.connection is None and not self.closed:
+                        await self.connect()
+                return
+            except OSError:
+                await asyncio.sleep(1)
+
+    async def close(self) -> None:
+        self.closed = True
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.connection is not None:
+            self.connection.close()
+            await self.connection.wait_closed()
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer delivering group messages to the channels of its own process
+    in memory, and to the other processes once per group through Redis pub/sub.
+
+    The channels of the process receive from their in-memory buffers. A single
+    task per Redis list of them, running while anything receives, moves the
+    messages sent to them through Redis into those buffers.
+    """
+
+    # Publishes the message for the other workers, returns how many channels are grouped through Redis
+    PUBLISH_SCRIPT = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[2])
+    redis.call('PUBLISH', KEYS[2], ARGV[1])
+    return redis.call('ZCARD', KEYS[1])
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The event loop the channels of this process receive on, groups are only kept in memory for it
+        self.local_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.reset_local_state()
+
+    def reset_local_state(self) -> None:
+        """Forget everything that belonged to the previous local event loop."""
+        # Groups of the channels of this process, with when each channel was added
+        self.local_groups: Dict[str, Dict[str, float]] = {}
+        # Pub/sub connections by host index
+        self.subscribers: Dict[int, FanoutSubscriber] = {}
+        # Connections the group sends share, see publish(), by host index
+        self.publishers: Dict[int, asyncio.Future] = {}
+        self.subscription_lock: Optional[asyncio.Lock] = None
+        # Receive the messages sent to the channels of this process through Redis, by non-local name
+        self.pumps: Dict[str, asyncio.Future] = {}
+        self.receive_count = 0
+        self.receive_buffer.clear()
+        self.receive_cleaners = []
+
+    def adopt_loop(self) -> bool:
+        """
+        Make the running event loop the local one, unless another loop that is still
+        open already is. Returns whether the running loop is the local one.
+        """
+        loop = asyncio.get_event_loop()
+        if self.local_loop is loop:
+            return True
+        if self.local_loop is not None and not self.local_loop.is_closed():
+            return False
+        self.local_loop = loop
+        self.reset_local_state()
+        self.subscription_lock = asyncio.Lock()
+        # Like the connection pools, clean up before the loop closes
+        _wrap_close(loop, self)
+        return True
+
+    def on_local_loop(self) -> bool:
+        return self.local_loop is asyncio.get_event_loop()
+
+    async def close_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Stop receiving and close the pub/sub connections of the loop, called as it closes."""
+        if loop is not self.local_loop:
+            return
+        await self.close_local()
+        self.local_loop = None
+        self.reset_local_state()
+
+    async def close_local(self) -> None:
+        pumps: List[asyncio.Future] = list(self.pumps.values())
+        self.pumps.clear()
+        for pump in pumps:
+            pump.cancel()
+        if pumps:
+            await asyncio.wait(pumps)
+        subscribers: List[FanoutSubscriber] = list(self.subscribers.values())
+        self.subscribers.clear()
+        for subscriber in subscribers:
+            await subscriber.close()
+        publishers: List[asyncio.Future] = list(self.publishers.values())
+        self.publishers.clear()
+        for publisher in publishers:
+            if not publisher.done():
+                publisher.cancel()
+            elif not publisher.cancelled() and publisher.exception() is None:
+                publisher.result().close()
+                await publisher.result().wait_closed()
+        await self.wait_received()
+
+    @property
+    def fanout_control_name(self) -> str:
+        return f'{self.prefix}fanout!{self.client_prefix}'
+
+    def fanout_name(self, group: str) -> str:
+        """Return the pub/sub channel the messages of the group are published to."""
+        return f'{self.prefix}fanout:{group}'
+
+    def is_local(self, channel: str) -> bool:
+        """Return whether the channel was made by ``new_channel`` of this layer."""
+        return "!" in channel and self.non_local_name(channel).endswith(f'.{self.client_prefix}!')
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific"):
+        # Whoever makes channels of this process is going to receive on them
+        self.adopt_loop()
+        return await super().new_channel(prefix)
+
+    async def receive(self, channel):
+        """Receive the first message that arrives on the channel."""
+        assert self.valid_channel_name(channel)
+        if "!" not in channel:
+            return await super().receive(channel)
+        real_channel: str = self.non_local_name(channel)
+        assert real_channel.endswith(self.client_prefix + "!"), "Wrong client prefix"
+        if not self.adopt_loop():
+            raise RuntimeError("Two event loops are trying to receive() on one channel layer at once!")
+        loop = self.local_loop
+        self.receive_count += 1
+        try:
+            pump: Optional[asyncio.Future] = self.pumps.get(real_channel)
+            if pump is None or pump.done():
+                self.pumps[real_channel] = asyncio.ensure_future(self.pump(real_channel))
+            queue: asyncio.Queue = self.receive_buffer[channel]
+            try:
+                message: dict = await queue.get()
+            except asyncio.CancelledError:
+                # Like RedisChannelLayer, what was buffered for the channel goes with it
+                if self.local_loop is loop:
+                    self.receive_buffer.pop(channel, None)
+                raise
+            if queue.empty() and self.receive_buffer.get(channel) is queue:
+                del self.receive_buffer[channel]
+            return message
+        finally:
+            # Receives left behind on a closed loop don't count anymore
+            if self.local_loop is loop:
+                self.receive_count -= 1
+                if not self.receive_count:
+                    # Cancelling is safe, the next ones put back what they were receiving
+                    for pump in self.pumps.values():
+                        pump.cancel()
+                    self.pumps.clear()
+
+    async def pump(self, real_channel: str) -> None:
+        """Move the messages sent through Redis to the channels of this process into their buffers."""
+        index: int = self.consistent_hash(real_channel)
+        channel_key: str = self.prefix + real_channel
+        # Removing received messages from the backup queue must be done before it's restored
+        await self.wait_received()
+        while True:
+            content: Optional[bytes] = await self._brpop_with_clean(index, channel_key, timeout=self.brpop_timeout)
+            if content is None:
+                continue
+            cleaner: asyncio.Future = asyncio.ensure_future(self._clean_receive_backup(index, channel_key))
+            self.receive_cleaners.append(cleaner)
+            cleaner.add_done_callback(self.receive_cleaners.remove)
+            message: dict = self.deserialize(content)
+            channels = message.pop("__asgi_channel__", real_channel)
+            for channel in channels if isinstance(channels, list) else [channels]:
+                self.receive_buffer[channel].put_nowait(message)
+            # Cancelled or not, the cleaner goes on
+            await asyncio.shield(cleaner)
+
+    async def flush(self):
+        await super().flush()
+        self.local_groups.clear()
+
+    async def close_pools(self):
+        if self.on_local_loop():
+            await self.close_local()
+        await super().close_pools()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        """Adds the channel name to a group, in memory when the channel receives on this event loop."""
+        if not self.is_local(channel) or not self.on_local_loop():
+            return await super().group_add(group, channel)
+        assert self.valid_group_name(group), "Group name not valid"
+        self.local_groups.setdefault(group, {})[channel] = time.time()
+        await self.update_subscription(group)
+
+    async def group_discard(self, group, channel):
+        """Removes the channel name from the group if it is in it, does nothing otherwise."""
+        if not self.is_local(channel) or not self.on_local_loop():
+            return await super().group_discard(group, channel)
+        assert self.valid_group_name(group), "Group name not valid"
+        members: Optional[Dict[str, float]] = self.local_groups.get(group)
+        if members is None or members.pop(channel, None) is None:
+            # Added from another event loop, so through Redis
+            return await super().group_discard(group, channel)
+        if not members:
+            del self.local_groups[group]
+            await self.update_subscription(group)
+
+    async def update_subscription(self, group: str) -> None:
+        """Subscribe to the messages other workers send to the group while it has members here, and only then."""
+        async with self.subscription_lock:
+            index: int = self.consistent_hash(group)
+            subscriber: Optional[FanoutSubscriber] = self.subscribers.get(index)
+            if subscriber is None:
+                subscriber = self.subscribers[index] = FanoutSubscriber(self, index)
+            name: str = self.fanout_name(group)
+            if group in self.local_groups and name not in subscriber.names:
+                await subscriber.subscribe(name)
+            elif group not in self.local_groups and name in subscriber.names:
+                await subscriber.unsubscribe(name)
+
+    async def group_send(self, group, message):
+        """
+        Sends a message to the entire group: the members in this process get it
+        right away, other workers get it once through Redis pub/sub.
+        """
+        assert self.valid_group_name(group), "Group name not valid"
+        assert "__asgi_channel__" not in message
+        if self.on_local_loop():
+            self.fan_out(group, message)
+        elif self.local_loop is not None and not self.local_loop.is_closed():
+            # e.g. from async_to_sync in a thread, the buffers belong to the local loop
+            self.local_loop.call_soon_threadsafe(self.fan_out, group, dict(message))
+        payload: bytes = self.client_prefix.encode('utf8') + self.serialize(message)
+        grouped: int = await self.publish(
+            self.consistent_hash(group),
+            keys=[self._group_key(group), self.fanout_name(group)],
+            args=[payload, int(time.time()) - self.group_expiry],
+        )
+        if grouped:
+            # Members of other processes without this layer, or added from another event loop
+            await super().group_send(group, message)
+
+    async def publish(self, index: int, keys: List[str], args: list) -> int:
+        """
+        Run PUBLISH_SCRIPT on the host. The local event loop shares one connection
+        per host for it, aioredis pipelines the commands of concurrent callers on
+        it: a burst of group sends like a join storm takes a few round trips
+        instead of a pooled connection each, most of them opened for the occasion.
+        """
+        if not self.on_local_loop():
+            async with self.connection(index) as connection:
+                return await connection.eval(self.PUBLISH_SCRIPT, keys=keys, args=args)
+        publisher: Optional[asyncio.Future] = self.publishers.get(index)
+        if publisher is None or publisher.done() and (
+            publisher.cancelled() or publisher.exception() is not None or publisher.result().closed
+        ):
+            publisher = self.publishers[index] = asyncio.ensure_future(aioredis.create_redis(**self.hosts[index]))
+        # Other callers are waiting for it too
+        connection = await asyncio.shield(publisher)
+        return await connection.eval(self.PUBLISH_SCRIPT, keys=keys, args=args)
+
+    def receive_published(self, name: str, payload: bytes) -> None:
+        """Called with the messages other workers published to the groups with members here."""
+        prefix: bytes = self.client_prefix.encode('utf8')
+        # We already delivered our own messages, client prefixes all have the same length
+        if payload.startswith(prefix) or name == self.fanout_control_name:
+            return
+        self.fan_out(name[len(self.fanout_name('')):], self.deserialize(payload[len(prefix):]))
+
+    def fan_out(self, group: str, message: dict) -> None:
+        """Hand the message to the members of the group in this process, skipping the ones that are full."""
+        members: Optional[Dict[str, float]] = self.local_groups.get(group)
+        if not members:
+            return
+        expired: float = time.time() - self.group_expiry
+        for channel, added in list(members.items()):
+            if added < expired:
+                del members[channel]
+                continue
+            queue: asyncio.Queue = self.receive_buffer[channel]
+            if queue.qsize() < self.get_capacity(channel):
+                queue.put_nowait(message)
+        if not members:
+            del self.local_groups[group]
+            asyncio.ensure_future(self.update_subscription(group))
@@ -0,0 +1,293 @@
+"""
+Simulated websocket clients driving the real ASGI application, for load testing.
+
+Every client logs in with its own session cookie and goes through the same
+routing and authentication middleware as a browser would, so the numbers
+include everything but the network.
+"""
+import asyncio
+import time
+from importlib import import_module
+from typing import Callable, Dict, List, Optional
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+
+from chat import encoding
+from chat.consumers import ChatConsumer
+from chat.models import Room
+from chat.writer import message_writer
+from users.models import User
+
+LOAD_TEST_USERNAME = 'loadtest-{}'
+LOAD_TEST_ROOM_TITLE = 'Load test {}'
+
+
+def get_users(count: int) -> List[User]:
+    """Return ``count`` load test users, creating the missing ones."""
+    usernames: List[str] = [LOAD_TEST_USERNAME.format(i) for i in range(count)]
+    existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    missing: List[User] = [
+        User(username=username, email=f'{username}@example.com', name=username)
+        for username in usernames if username not in existing
+    ]
+    for user in missing:
+        user.set_unusable_password()
+    User.objects.bulk_create(missing)
+    users: Dict[str, User] = User.objects.in_bulk(usernames, field_name='username')
+    return [users[username] for username in usernames]
+
+
+def get_rooms(count: int) -> List[Room]:
+    """Return ``count`` public load test rooms, creating the missing ones."""
+    return [Room.objects.get_or_create(title=LOAD_TEST_ROOM_TITLE.format(i))[0] for i in range(count)]
+
+
+def login(user: User) -> str:
+    """Create a logged in session for the user and return its key."""
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return session.session_key
+
+
+def percentile(values: List[float], percent: float) -> Optional[float]:
+    """Nearest-rank percentile of already sorted values."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))]
+
+
+class SimulatedClient:
+    """A websocket client with its own session, which unwraps batch frames as the web client does."""
+
+    def __init__(self, application, session_key: str, msgpack: bool = False, timeout: float = 30):
+        self.msgpack: bool = msgpack
+        self.timeout: float = timeout
+        self.communicator = WebsocketCommunicator(
+            application,
+            '/chat/stream/',
+            headers=[(b'cookie', f'{settings.SESSION_COOKIE_NAME}={session_key}'.encode())],
+            subprotocols=[ChatConsumer.msgpack_subprotocol] if msgpack else None,
+        )
+
+    async def connect(self) -> None:
+        connected, _ = await self.communicator.connect(timeout=self.timeout)
+        if not connected:
+            raise ConnectionError('The load test client was rejected')
+
+    async def disconnect(self) -> None:
+        await self.communicator.disconnect(timeout=self.timeout)
+
+    async def send(self, content: dict) -> None:
+        if self.msgpack:
+            await self.communicator.send_to(bytes_data=encoding.packb(content))
+        else:
+            await self.communicator.send_to(text_data=encoding.dumps(content))
+
+    async def receive_output(self, timeout: float) -> dict:
+        # Unlike WebsocketCommunicator.receive_output, timing out doesn't kill the application
+        return await asyncio.wait_for(self.communicator.output_queue.get(), timeout)
+
+    async def receive(self) -> List[dict]:
+        """Wait for the next frame and return the messages in it."""
+        output: dict = await self.receive_output(self.timeout)
+        if output['type'] == 'websocket.close':
+            raise ConnectionError(f'The load test client was closed with {output.get("code")}')
+        if self.msgpack:
+            content: dict = encoding.unpackb(output['bytes'])
+        else:
+            content = encoding.loads(output['text'])
+        return content['batch'] if 'batch' in content else [content]
+
+    async def drain(self, quiet: float = 0.5) -> None:
+        """Skip everything received until nothing arrives for ``quiet`` seconds."""
+        while True:
+            try:
+                await self.receive_output(quiet)
+            except asyncio.TimeoutError:
+                return
+
+    async def receive_until(self, predicate: Callable[[dict], bool]) -> dict:
+        """Skip messages until one matches, and return it."""
+        while True:
+            for content in await self.receive():
+                if predicate(content):
+                    return content
+
+    async def request(self, content: dict, predicate: Callable[[dict], bool]) -> float:
+        """Send a command and return how many seconds it took for its reply to arrive."""
+        start: float = time.perf_counter()
+        await self.send(content)
+        await self.receive_until(predicate)
+        return time.perf_counter() - start
+
+    async def join(self, room_id: int) -> float:
+        return await self.request({'command': 'join', 'room': room_id}, lambda content: 'join' in content)
+
+
+class Scenario:
+    """
+    A load test run. ``run`` measures one phase and returns the latency of each
+    operation of it, in seconds; setting the clients up and tearing them down is
+    not measured.
+    """
+    name: str = None
+
+    def __init__(self, clients: int, rooms: int = 1, messages: int = 10, senders: int = 10,
+                 interval: float = 0, msgpack: bool = False, timeout: float = 10):
+        self.client_count: int = clients
+        self.room_count: int = rooms
+        self.messages: int = messages
+        self.senders: int = min(senders, clients)
+        self.interval: float = interval
+        self.msgpack: bool = msgpack
+        self.timeout: float = timeout
+        self.clients: List[SimulatedClient] = []
+        self.room_ids: List[int] = []
+        self.errors: int = 0
+        # Messages that never reached a client
+        self.lost: int = 0
+
+    def prepare(self) -> None:
+        """Create the users, their sessions and the rooms, this part talks to the database synchronously."""
+        self.room_ids = [room.id for room in get_rooms(self.room_count)]
+        from whisper.routing import application
+        self.clients = [
+            SimulatedClient(application, login(user), msgpack=self.msgpack, timeout=self.timeout)
+            for user in get_users(self.client_count)
+        ]
+
+    def get_room_id(self, index: int) -> int:
+        """Spread the clients over the rooms."""
+        return self.room_ids[index % len(self.room_ids)]
+
+    async def gather(self, operations) -> List[float]:
+        """Run the operations concurrently, counting failed ones as errors."""
+        latencies: List[float] = []
+        for result in await asyncio.gather(*operations, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.errors += 1
+            elif isinstance(result, list):
+                latencies.extend(result)
+            elif result is not None:
+                latencies.append(result)
+        return latencies
+
+    async def set_up(self) -> None:
+        await self.gather(client.connect() for client in self.clients)
+
+    async def run(self) -> List[float]:
+        raise NotImplementedError
+
+    async def tear_down(self) -> None:
+        await self.gather(client.disconnect() for client in self.clients)
+        await message_writer.flush()
+
+    async def execute(self) -> dict:
+        """Run the scenario and return its results."""
+        await self.set_up()
+        started_at: float = time.perf_counter()
+        cpu_started_at: float = time.process_time()
+        latencies: List[float] = sorted(await self.run())
+        duration: float = time.perf_counter() - started_at
+        cpu: float = time.process_time() - cpu_started_at
+        await self.tear_down()
+        operations: int = len(latencies)
+        return {
+            'scenario': self.name,
+            'clients': self.client_count,
+            'rooms': self.room_count,
+            'msgpack': self.msgpack,
+            'messages': operations,
+            'errors': self.errors,
+            'lost': self.lost,
+            'duration': duration,
+            'msgs_per_second': operations / duration if duration else None,
+            'latency_ms': {
+                name: value * 1000 if value is not None else None
+                for name, value in (
+                    ('p50', percentile(latencies, 50)),
+                    ('p95', percentile(latencies, 95)),
+                    ('p99', percentile(latencies, 99)),
+                    ('max', latencies[-1] if latencies else None),
+                )
+            },
+            'cpu_ms_per_message': cpu * 1000 / operations if operations else None,
+        }
+
+
+class JoinStorm(Scenario):
+    """Every client joins its room at the same time, measures the time to the join reply."""
+    name = 'join_storm'
+
+    async def run(self) -> List[float]:
+        return await self.gather(client.join(self.get_room_id(i)) for i, client in enumerate(self.clients))
+
+
+class HotRoom(Scenario):
+    """
+    Everybody is in the first room and a few of them chat, a message every ``interval``
+    seconds, measures the time from sending each message to it reaching every client.
+    """
+    name = 'hot_room'
+
+    async def set_up(self) -> None:
+        await super().set_up()
+        await self.gather(client.join(self.room_ids[0]) for client in self.clients)
+        # Don't measure the join notices everybody is still busy with
+        await self.gather(client.drain() for client in self.clients)
+
+    async def run(self) -> List[float]:
+        expected: int = self.senders * self.messages
+        return await self.gather([
+            *(self.receive_messages(client, expected) for client in self.clients),
+            *(self.send_messages(client) for client in self.clients[:self.senders]),
+        ])
+
+    async def send_messages(self, client: SimulatedClient) -> None:
+        for _ in range(self.messages):
+            # The message carries its send time, the clients all share the clock of this process
+            await client.send({'command': 'send', 'room': self.room_ids[0], 'message': repr(time.perf_counter())})
+            # Let the other clients run, as separate processes would
+            await asyncio.sleep(self.interval)
+
+    async def receive_messages(self, client: SimulatedClient, expected: int) -> List[float]:
+        latencies: List[float] = []
+        while len(latencies) < expected:
+            try:
+                contents: List[dict] = await client.receive()
+            except asyncio.TimeoutError:
+                # Nothing for a while, the rest was dropped on the way
+                self.lost += expected - len(latencies)
+                break
+            for content in contents:
+                if content.get('msg_type') == settings.MSG_TYPE_MESSAGE:
+                    latencies.append(time.perf_counter() - float(content['message']))
+                elif 'error' in content:
+                    raise ConnectionError(content['error'])
+        return latencies
+
+
+class PresencePolling(Scenario):
+    """Clients keep asking who else is in their room, measures the time to each reply."""
+    name = 'presence_polling'
+
+    async def set_up(self) -> None:
+        await super().set_up()
+        await self.gather(client.join(self.get_room_id(i)) for i, client in enumerate(self.clients))
+
+    async def run(self) -> List[float]:
+        return await self.gather(self.poll(client, self.get_room_id(i)) for i, client in enumerate(self.clients))
+
+    async def poll(self, client: SimulatedClient, room_id: int) -> List[float]:
+        return [
+            await client.request({'command': 'room_users', 'room': room_id}, lambda content: 'data' in content)
+            for _ in range(self.messages)
+        ]
+
+
+SCENARIOS: Dict[str, type] = {scenario.name: scenario for scenario in (JoinStorm, HotRoom, PresencePolling)}
@@ -0,0 +1,69 @@
+import time
+from typing import Callable, List
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.models import Message, Room
+
+BENCHMARK_ROOM_TITLE = 'History benchmark'
+
+
+class Command(BaseCommand):
+    help = (
+        "Times pages of room history at increasing depths, keyset pagination against OFFSET. "
+        "The benchmark room is filled with messages on the first run and reused afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000, help='Messages in the benchmark room.')
+        parser.add_argument('--page-size', type=int, default=settings.HISTORY_PAGE_SIZE)
+        parser.add_argument(
+            '--depths', default='0,10,100,1000,10000', help='Comma separated page numbers to time.',
+        )
+        parser.add_argument('--repeat', type=int, default=20, help='Times each page is loaded.')
+
+    def handle(self, *args, **options):
+        room: Room = self.get_room(options['messages'])
+        page_size: int = options['page_size']
+        ids = room.messages.order_by('-id').values_list('id', flat=True)
+
+        self.stdout.write(f'{"page":>8} {"keyset ms":>12} {"offset ms":>12}')
+        for depth in map(int, options['depths'].split(',')):
+            offset: int = depth * page_size
+            if offset >= options['messages']:
+                break
+            # The message right before the page, which is what a client would send as "before"
+            before = ids[offset - 1] if offset else None
+            keyset: float = self.time(options['repeat'], lambda: Message.objects.page(room.id, before, page_size))
+            offset_time: float = self.time(options['repeat'], lambda: list(
+                room.messages.order_by('-id').values('id', 'username', 'message', 'created')[
+                    offset:offset + page_size
+                ]
+            ))
+            self.stdout.write(f'{depth:>8} {keyset * 1000:>12.3f} {offset_time * 1000:>12.3f}')
+
+    def get_room(self, messages: int) -> Room:
+        """Return the benchmark room, with at least ``messages`` messages in it."""
+        room, _ = Room.objects.get_or_create(title=BENCHMARK_ROOM_TITLE)
+        missing: int = messages - room.messages.count()
+        if missing > 0:
+            self.stdout.write(f'Creating {missing} messages...')
+        while missing > 0:
+            batch: List[Message] = [
+                Message(room=room, username='benchmark', message=f'Message {i}')
+                for i in range(min(missing, 10000))
+            ]
+            Message.objects.bulk_create(batch)
+            missing -= len(batch)
+        return room
+
+    @staticmethod
+    def time(repeat: int, query: Callable) -> float:
+        """Return the median time in seconds ``query`` takes."""
+        timings: List[float] = []
+        for _ in range(repeat):
+            start: float = time.perf_counter()
+            query()
+            timings.append(time.perf_counter() - start)
+        return sorted(timings)[len(timings) // 2]
@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from chat.loadtest import SCENARIOS, Scenario
+from chat.room_cache import invalidation_listener
+
+# Only the users are being measured, not how fast the rate limits kick them out
+NO_RATE_LIMITS = {
+    'CONNECTION_RATE_LIMIT': 10 ** 9,
+    'CONNECTION_RATE_LIMIT_BURST': 10 ** 9,
+    'ROOM_RATE_LIMIT': 10 ** 9,
+    'ROOM_RATE_LIMIT_BURST': 10 ** 9,
+}
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs simulated websocket clients against whisper.routing.application in this process and "
+        "prints msgs/s, p50/p95/p99 latency and CPU time per message as JSON, to compare across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=10, help='Rooms the clients are spread over.')
+        parser.add_argument(
+            '--messages', type=int, default=10, help='Messages each sender sends, or polls each client makes.',
+        )
+        parser.add_argument('--senders', type=int, default=10, help='Clients chatting in the hot_room scenario.')
+        parser.add_argument(
+            '--interval', type=int, default=0, help='Milliseconds each sender waits between two messages.',
+        )
+        parser.add_argument(
+            '--layer', choices=('memory', 'redis'), default='memory',
+            help='The in-memory channel layer, or the one configured in CHANNEL_LAYERS.',
+        )
+        parser.add_argument('--msgpack', action='store_true', help='Use the MessagePack subprotocol.')
+        parser.add_argument('--rate-limits', action='store_true', help='Keep the rate limits on.')
+        parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait for any single frame.')
+        parser.add_argument('--output', help='Write the results to this file rather than stdout.')
+
+    def handle(self, *args, **options):
+        scenario: Scenario = SCENARIOS[options['scenario']](
+            clients=options['clients'],
+            rooms=options['rooms'],
+            messages=options['messages'],
+            senders=options['senders'],
+            interval=options['interval'] / 1000,
+            msgpack=options['msgpack'],
+            timeout=options['timeout'],
+        )
+        overrides: dict = {} if options['rate_limits'] else dict(NO_RATE_LIMITS)
+        if options['layer'] == 'memory':
+            overrides['CHANNEL_LAYERS'] = IN_MEMORY_CHANNEL_LAYERS
+        with override_settings(**overrides):
+            scenario.prepare()
+            loop = asyncio.get_event_loop()
+            results: dict = loop.run_until_complete(scenario.execute())
+            # The clients started it when connecting
+            loop.run_until_complete(invalidation_listener.stop())
+        results['layer'] = options['layer']
+
+        output: str = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
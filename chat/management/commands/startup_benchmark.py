@@ -0,0 +1,65 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+ENTRYPOINTS: List[str] = ['whisper.asgi', 'whisper.asgi_ws']
+
+# Runs in a fresh interpreter, so nothing the entrypoint needs is imported already
+MEASURE_SCRIPT: str = """
+import importlib, json, resource, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+import_ms = (time.perf_counter() - start) * 1000
+# Kilobytes on Linux, bytes on macOS
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+print(json.dumps({'import_ms': import_ms, 'rss_mb': max_rss, 'modules': len(sys.modules)}))
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports each ASGI entrypoint in fresh interpreters and prints the median import time, peak RSS and "
+        "number of loaded modules as JSON, to compare the startup of the workers across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Interpreters started per entrypoint.')
+        parser.add_argument('--output', help='Write the results to this file rather than stdout.')
+
+    def handle(self, *args, **options):
+        results: Dict[str, dict] = {
+            entrypoint: self.measure(entrypoint, options['runs']) for entrypoint in ENTRYPOINTS
+        }
+        results['runs'] = options['runs']
+
+        output: str = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    @staticmethod
+    def measure(entrypoint: str, runs: int) -> dict:
+        """Import the entrypoint ``runs`` times, returns the medians."""
+        # Each entrypoint picks its own settings
+        env: Dict[str, str] = {key: value for key, value in os.environ.items() if key != 'DJANGO_SETTINGS_MODULE'}
+        samples: List[dict] = []
+        for _ in range(runs):
+            process = subprocess.run(
+                [sys.executable, '-c', MEASURE_SCRIPT, entrypoint],
+                cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+            if process.returncode:
+                raise CommandError(f'Importing {entrypoint} failed:\n{process.stderr.decode()}')
+            samples.append(json.loads(process.stdout.decode().splitlines()[-1]))
+        return {
+            key: round(statistics.median(sample[key] for sample in samples), 1)
+            for key in ('import_ms', 'rss_mb', 'modules')
+        }
@@ -0,0 +1,68 @@
+import asyncio
+import os
+import socket
+from typing import Dict, List
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from chat.models import get_room_group_name
+from chat.presence import PresenceChange
+from chat.utils import get_presence_delta_event, sweep_presence
+
+SWEEP_LOCK_KEY = 'room-presence-sweeper'
+
+
+class Command(BaseCommand):
+    help = (
+        "Removes the users whose room presence wasn't refreshed for ROOM_PRESENCE_IDLE_TIMEOUT, or who left "
+        "over ROOM_PRESENCE_LEFT_TIMEOUT ago, and pushes the changes to the rooms. Safe to run on every host: "
+        "a single process sweeps per ROOM_PRESENCE_SWEEP_INTERVAL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', action='store_true', help='Keep sweeping every ROOM_PRESENCE_SWEEP_INTERVAL seconds.',
+        )
+        parser.add_argument('--batch-size', type=int, default=settings.ROOM_PRESENCE_SWEEP_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        asyncio.get_event_loop().run_until_complete(self.run(options['loop'], options['batch_size']))
+
+    async def run(self, loop: bool, batch_size: int) -> None:
+        while True:
+            if self.is_leader():
+                swept: int = await self.sweep(batch_size)
+                self.stdout.write(f'Swept {swept} users from the room presence')
+            if not loop:
+                break
+            await asyncio.sleep(settings.ROOM_PRESENCE_SWEEP_INTERVAL)
+
+    @staticmethod
+    def is_leader() -> bool:
+        """
+        Whether this process sweeps during the current interval: the first one to
+        take the lock does, it's released by expiring so the others wait their turn.
+        """
+        return cache.add(SWEEP_LOCK_KEY, f'{socket.gethostname()}:{os.getpid()}', settings.ROOM_PRESENCE_SWEEP_INTERVAL)
+
+    @staticmethod
+    async def sweep(batch_size: int) -> int:
+        """Sweep batches until the expired entries run out, then push the changes, returns how many were removed."""
+        swept: int = 0
+        channel_layer = get_channel_layer()
+        while True:
+            changes: Dict[int, List[PresenceChange]] = await sweep_presence(batch_size)
+            events: List[dict] = [
+                get_presence_delta_event(room_id, change)
+                for room_id, room_changes in changes.items() for change in room_changes
+            ]
+            await asyncio.gather(*(
+                channel_layer.group_send(get_room_group_name(event["room"]), event) for event in events
+            ))
+            swept += len(events)
+            # Fewer than asked for, nothing else is expired or some came back in between
+            if len(events) < batch_size:
+                return swept
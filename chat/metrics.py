@@ -0,0 +1,355 @@
+"""
+Counters, gauges and histograms of the websocket server, exposed in the
+Prometheus text format by the ``metrics`` view.
+
+Every thread updates its own copy of the values, so recording never takes a
+lock; the copies are only added up when the metrics are collected. Each
+process publishes what it collected to Redis every ``METRICS_PUSH_INTERVAL``
+seconds, and the view adds up the latest snapshot of every live process.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as CounterDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.utils.functional import cached_property
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = 'whisper:metrics'
+
+# Prometheus' own default buckets, in seconds
+DEFAULT_BUCKETS: Tuple[float, ...] = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+Labels = Tuple[str, ...]
+# What a process collected: {name: {"type", "help", "labelnames", "buckets", "samples": [[labels, value]]}}
+Snapshot = Dict[str, dict]
+
+
+class Registry:
+    """All the metrics of the process, by name."""
+
+    def __init__(self):
+        self.metrics: Dict[str, 'Metric'] = {}
+
+    def register(self, metric: 'Metric') -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f'The {metric.name} metric is already registered')
+        self.metrics[metric.name] = metric
+
+    def collect(self) -> Snapshot:
+        """Return the current values of every metric."""
+        return {name: metric.describe() for name, metric in self.metrics.items()}
+
+
+registry = Registry()
+
+
+class Metric:
+    """A metric family, one value per combination of label values."""
+    type: str = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), register: bool = True):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._shards_lock = threading.Lock()
+        self._children: Dict[Labels, MetricChild] = {}
+        if register:
+            registry.register(self)
+
+    def _shard(self) -> dict:
+        """Return the values of the current thread, only the first call of each thread locks."""
+        try:
+            return self._local.values
+        except AttributeError:
+            values: dict = {}
+            with self._shards_lock:
+                self._shards.append(values)
+            self._local.values = values
+            return values
+
+    def labels(self, *values) -> 'MetricChild':
+        """Return the metric for the given label values, in the order of ``labelnames``."""
+        key: Labels = tuple(map(str, values))
+        child: MetricChild = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f'{self.name} takes the {self.labelnames} labels')
+            child = self._children.setdefault(key, MetricChild(self, key))
+        return child
+
+    def add(self, key: Labels, amount: float) -> None:
+        values: dict = self._shard()
+        values[key] = values.get(key, 0) + amount
+
+    def samples(self) -> Dict[Labels, object]:
+        """Add up the values of all the threads."""
+        total: Dict[Labels, float] = CounterDict()
+        with self._shards_lock:
+            shards: List[dict] = list(self._shards)
+        for shard in shards:
+            # Copying a dict doesn't let the owning thread in, so it can't change size under us
+            total.update(shard.copy())
+        return dict(total)
+
+    def describe(self) -> dict:
+        return {
+            'type': self.type,
+            'help': self.documentation,
+            'labelnames': list(self.labelnames),
+            'samples': [[list(key), value] for key, value in self.samples().items()],
+        }
+
+
+class MetricChild:
+    """A metric with its label values bound, what the instrumented code keeps calling."""
+    __slots__ = ('metric', 'key')
+
+    def __init__(self, metric: Metric, key: Labels):
+        self.metric: Metric = metric
+        self.key: Labels = key
+
+    def inc(self, amount: float = 1) -> None:
+        self.metric.add(self.key, amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.metric.add(self.key, -amount)
+
+    def observe(self, value: float) -> None:
+        self.metric.observe(self.key, value)
+
+    def time(self) -> 'Timer':
+        return Timer(self)
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+    type = 'counter'
+
+    def inc(self, amount: float = 1) -> None:
+        self.add((), amount)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, like the number of open connections."""
+    type = 'gauge'
+
+    def inc(self, amount: float = 1) -> None:
+        self.add((), amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.add((), -amount)
+
+
+class Histogram(Metric):
+    """Counts observations, like durations in seconds, by bucket."""
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, register: bool = True):
+        super().__init__(name, documentation, labelnames, register)
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+
+    def observe(self, key: Labels, value: float) -> None:
+        values: dict = self._shard()
+        # A count per bucket, then the +Inf bucket, the sum and the count of the observations
+        counts: List[float] = values.get(key)
+        if counts is None:
+            counts = values[key] = [0] * (len(self.buckets) + 3)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def time(self) -> 'Timer':
+        return Timer(self.labels())
+
+    def samples(self) -> Dict[Labels, List[float]]:
+        total: Dict[Labels, List[float]] = {}
+        with self._shards_lock:
+            shards: List[dict] = list(self._shards)
+        for shard in shards:
+            for key, counts in shard.copy().items():
+                counts = list(counts)
+                if key in total:
+                    total[key] = [a + b for a, b in zip(total[key], counts)]
+                else:
+                    total[key] = counts
+        return total
+
+    def describe(self) -> dict:
+        return dict(super().describe(), buckets=list(self.buckets))
+
+
+class CounterCollector(Metric):
+    """Exposes an existing ``collections.Counter`` as a counter with a single label."""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelname: str, counter: CounterDict):
+        super().__init__(name, documentation, [labelname])
+        self.counter: CounterDict = counter
+
+    def samples(self) -> Dict[Labels, float]:
+        return {(str(label),): value for label, value in self.counter.copy().items()}
+
+
+class Timer:
+    """Context manager observing how many seconds its block took."""
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child: MetricChild):
+        self.child: MetricChild = child
+
+    def __enter__(self) -> 'Timer':
+        self.start: float = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class SnapshotStore:
+    """
+    Keeps the latest snapshot of every process in a Redis hash, so whichever
+    process serves the metrics view can add them all up.
+    """
+
+    def __init__(self, client=None):
+        if client is not None:
+            self.client = client
+
+    @cached_property
+    def client(self):
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+
+    @cached_property
+    def process_id(self) -> str:
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def publish(self, snapshot: Snapshot) -> None:
+        pipeline = self.client.pipeline()
+        pipeline.hset(METRICS_KEY, self.process_id, json.dumps({'time': time.time(), 'metrics': snapshot}))
+        pipeline.expire(METRICS_KEY, settings.METRICS_PUSH_INTERVAL * 3)
+        pipeline.execute()
+
+    def get_snapshots(self, own: Snapshot) -> List[Snapshot]:
+        """Return the snapshots of the live processes, with ``own`` standing in for this one."""
+        snapshots: List[Snapshot] = [own]
+        stale: List[str] = []
+        expired_at: float = time.time() - settings.METRICS_PUSH_INTERVAL * 3
+        for process_id, data in self.client.hgetall(METRICS_KEY).items():
+            process_id = process_id.decode() if isinstance(process_id, bytes) else process_id
+            if process_id == self.process_id:
+                continue
+            data = json.loads(data)
+            if data['time'] < expired_at:
+                stale.append(process_id)
+            else:
+                snapshots.append(data['metrics'])
+        if stale:
+            # Their processes are gone
+            self.client.hdel(METRICS_KEY, *stale)
+        return snapshots
+
+
+snapshot_store = SnapshotStore()
+
+
+class Publisher:
+    """Publishes the metrics of the process every ``METRICS_PUSH_INTERVAL`` seconds, from the event loop."""
+
+    def __init__(self, store: SnapshotStore):
+        self.store: SnapshotStore = store
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self) -> None:
+        """Start publishing from the running event loop, unless it's already being done."""
+        loop = asyncio.get_event_loop()
+        if settings.METRICS_PUSH_INTERVAL and loop is not self._loop:
+            self._loop = loop
+            loop.call_later(settings.METRICS_PUSH_INTERVAL, self._tick, loop)
+
+    def _tick(self, loop: asyncio.AbstractEventLoop) -> None:
+        if loop is not self._loop or loop.is_closed():
+            return
+        # The Redis client blocks, keep it off the event loop
+        loop.run_in_executor(None, self.publish)
+        loop.call_later(settings.METRICS_PUSH_INTERVAL, self._tick, loop)
+
+    def publish(self) -> None:
+        try:
+            self.store.publish(registry.collect())
+        except Exception:
+            logger.warning('Could not publish the metrics', exc_info=True)
+
+
+publisher = Publisher(snapshot_store)
+
+
+def collect_all() -> List[Snapshot]:
+    """Return the snapshots to expose, the ones of every process when they are published."""
+    own: Snapshot = registry.collect()
+    if not settings.METRICS_PUSH_INTERVAL:
+        return [own]
+    try:
+        return snapshot_store.get_snapshots(own)
+    except Exception:
+        logger.warning('Could not read the metrics of the other processes', exc_info=True)
+        return [own]
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs: List[str] = [
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in zip(names, values)
+    ]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render(snapshots: Iterable[Snapshot]) -> str:
+    """Add the snapshots up and render them in the Prometheus text exposition format."""
+    families: Dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, family in snapshot.items():
+            merged: dict = families.setdefault(name, dict(family, samples={}))
+            for labels, value in family['samples']:
+                key: Labels = tuple(labels)
+                if family['type'] == 'histogram':
+                    current: List[float] = merged['samples'].get(key)
+                    merged['samples'][key] = [a + b for a, b in zip(current, value)] if current else value
+                else:
+                    merged['samples'][key] = merged['samples'].get(key, 0) + value
+
+    lines: List[str] = []
+    for name, family in sorted(families.items()):
+        lines.append(f'# HELP {name} {family["help"]}')
+        lines.append(f'# TYPE {name} {family["type"]}')
+        labelnames: List[str] = family['labelnames']
+        for key, value in sorted(family['samples'].items()):
+            if family['type'] != 'histogram':
+                lines.append(f'{name}{format_labels(labelnames, key)} {format_value(value)}')
+                continue
+            cumulative: float = 0
+            for bucket, count in zip(family['buckets'] + [float('inf')], value):
+                cumulative += count
+                labels: str = format_labels(labelnames + ['le'], key + (format_value(float(bucket)),))
+                lines.append(f'{name}_bucket{labels} {format_value(cumulative)}')
+            lines.append(f'{name}_sum{format_labels(labelnames, key)} {format_value(value[-2])}')
+            lines.append(f'{name}_count{format_labels(labelnames, key)} {format_value(value[-1])}')
+    return '\n'.join(lines) + '\n'
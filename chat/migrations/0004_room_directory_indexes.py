@@ -0,0 +1,34 @@
+# Generated by Django 2.0.13 on 2026-10-18 18:34
+
+from django.db import migrations, models
+
+
+def create_title_trigram_index(apps, schema_editor):
+    # Backs the case insensitive title search of the room directory, LIKE '%...%' on UPPER(title)
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX chat_room_title_trgm_idx ON chat_room USING gin (UPPER("title"::text) gin_trgm_ops)'
+    )
+
+
+def drop_title_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS chat_room_title_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_room_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['title', 'id'], name='chat_room_title_id_idx'),
+        ),
+        migrations.RunPython(create_title_trigram_index, drop_title_trigram_index),
+    ]
@@ -1,16 +1,53 @@
+from typing import List, Optional, Tuple
+
+from django.conf import settings
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 
+class RoomQuerySet(models.QuerySet):
+
+    def page(self, after: Optional[Tuple[str, int]], size: int, query: str = '', staff: bool = False) -> List[dict]:
+        """
+        Return up to ``size`` rooms ordered by title after the ``after`` (title, id) pair,
+        only the ones whose title contains ``query`` if given, and staff only rooms
+        for ``staff`` users only.
+
+        This is keyset pagination over the (title, id) index. On PostgreSQL the search
+        is backed by a trigram index on the title, see the 0004 migration.
+        """
+        rooms: models.QuerySet = self
+        if not staff:
+            rooms = rooms.filter(staff_only=False)
+        if query:
+            rooms = rooms.filter(title__icontains=query)
+        if after is not None:
+            title, room_id = after
+            rooms = rooms.filter(Q(title__gt=title) | Q(title=title, id__gt=room_id))
+        return [
+            {'id': room_id, 'title': title, 'staff_only': staff_only, 'group_name': get_room_group_name(room_id)}
+            for room_id, title, staff_only in rooms.order_by('title', 'id').values_list('id', 'title', 'staff_only')[
+                :size
+            ]
+        ]
+
+
 class Room(models.Model):
     """A room for people to chat in."""
     title = models.CharField(verbose_name=_('title'), max_length=255)
     # If only "staff" users are allowed (is_staff on django's User)
     staff_only = models.BooleanField(verbose_name=_('staff only'), default=False)
 
+    objects = RoomQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('Room')
         verbose_name_plural = _('Rooms')
+        indexes = [
+            models.Index(fields=['title', 'id'], name='chat_room_title_id_idx'),
+        ]
 
     def __str__(self) -> str:
         return self.title
@@ -20,4 +57,52 @@ class Room(models.Model):
         """
         Returns the Channels Group name that sockets should subscribe to to get sent messages as they are generated.
         """
-        return f'room-{self.id}'
+        return get_room_group_name(self.id)
+
+
+def get_room_group_name(room_id: int) -> str:
+    """Returns the Channels Group name of the room, without having to load it."""
+    return f'room-{room_id}'
+
+
+class MessageQuerySet(models.QuerySet):
+
+    def page(self, room_id: int, before: Optional[int], size: int) -> List[dict]:
+        """
+        Return up to ``size`` messages of the room older than the ``before`` message id, newest first.
+
+        This is keyset pagination over the (room, id) index, so deep pages cost the
+        same as the first one, unlike OFFSET which has to walk every skipped row.
+        """
+        messages: models.QuerySet = self.filter(room_id=room_id)
+        if before is not None:
+            messages = messages.filter(id__lt=before)
+        return list(messages.order_by('-id').values('id', 'username', 'message', 'created')[:size])
+
+
+class Message(models.Model):
+    """A message sent to a room."""
+    # The (room, id) index in Meta covers lookups by room on its own
+    room = models.ForeignKey(
+        Room, verbose_name=_('room'), related_name='messages', on_delete=models.CASCADE, db_index=False,
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, verbose_name=_('user'), related_name='messages', null=True,
+        on_delete=models.SET_NULL,
+    )
+    # Kept as it was when the message was sent, so history doesn't have to join users
+    username = models.CharField(verbose_name=_('username'), max_length=150)
+    message = models.TextField(verbose_name=_('message'))
+    created = models.DateTimeField(verbose_name=_('created'), default=timezone.now)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _('Message')
+        verbose_name_plural = _('Messages')
+        indexes = [
+            models.Index(fields=['room', 'id'], name='chat_message_room_id_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.username}: {self.message}'
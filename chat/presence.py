@@ -0,0 +1,551 @@
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+import aioredis
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+from chat.async_redis import AsyncRedis, get_async_redis, run_script
+
+PresenceUsers = Dict[int, dict]
+# One change of the room presence: {"version": 3, "user": 1, "change": "joined", "data": {...}}
+PresenceChange = dict
+
+# Kinds of changes, "joined" and "updated" ones carry the new user data
+PRESENCE_JOINED = 'joined'
+PRESENCE_UPDATED = 'updated'
+PRESENCE_LEFT = 'left'
+PRESENCE_REMOVED = 'removed'
+
+
+def get_room_presence_cache_key(room_id: int) -> str:
+    """Return Room Presence Cache Key."""
+    return f'room-presence-{room_id}'
+
+
+def get_presence_deadline(data: dict) -> float:
+    """Return when the user entry gets swept unless it's refreshed, left users go sooner."""
+    timeout: int = settings.ROOM_PRESENCE_LEFT_TIMEOUT if data.get('left') else settings.ROOM_PRESENCE_IDLE_TIMEOUT
+    return time.time() + timeout
+
+
+def get_presence_change(old: Optional[dict], new: dict) -> Optional[str]:
+    """
+    Return how storing ``new`` over ``old`` changes the user presence, None when
+    it's only a heartbeat refreshing ``last_update``.
+    """
+    if old is None or old.get('left') and not new.get('left'):
+        return PRESENCE_JOINED
+    if any(old.get(key) != value for key, value in new.items() if key != 'last_update'):
+        return PRESENCE_UPDATED
+    return None
+
+
+class BasePresenceBackend:
+    """
+    Stores who is in which room, one entry per user.
+
+    Every method touches a single user entry (or removes a few of them), so
+    implementations have to apply it atomically without reading the whole room.
+
+    Each room also has a version, bumped by every change except heartbeats, and
+    remembers its last ``ROOM_PRESENCE_LOG_SIZE`` changes so clients can catch up
+    from the version they have. The methods writing to a room return the changes
+    they made, for them to be pushed to the room.
+
+    Every user entry has its own deadline, pushed back whenever it's written to:
+    ``ROOM_PRESENCE_IDLE_TIMEOUT`` for users in the room, ``ROOM_PRESENCE_LEFT_TIMEOUT``
+    for the ones who left. ``sweep`` removes the entries past their deadline.
+
+    The ``*_async`` methods are the same for the consumers, which must not block
+    the event loop. They call the blocking ones by default, which is fine for the
+    in-memory backends; the ones doing I/O override them.
+    """
+
+    def update(self, room_id: int, user_id: int, data: dict) -> Optional[PresenceChange]:
+        """Store or replace the presence of the user in the room."""
+        raise NotImplementedError
+
+    def update_many(self, room_ids: Iterable[int], user_id: int, data: dict) -> Dict[int, PresenceChange]:
+        """Store or replace the presence of the user in several rooms at once."""
+        changes: Dict[int, PresenceChange] = {}
+        for room_id in room_ids:
+            change: Optional[PresenceChange] = self.update(room_id, user_id, data)
+            if change:
+                changes[room_id] = change
+        return changes
+
+    def mark_left(self, room_id: int, user_id: int) -> Optional[PresenceChange]:
+        """Flag the user as ``left``, keeping the rest of their presence around."""
+        raise NotImplementedError
+
+    def mark_left_many(self, room_ids: Iterable[int], user_id: int) -> Dict[int, PresenceChange]:
+        """Flag the user as ``left`` in several rooms at once."""
+        changes: Dict[int, PresenceChange] = {}
+        for room_id in room_ids:
+            change: Optional[PresenceChange] = self.mark_left(room_id, user_id)
+            if change:
+                changes[room_id] = change
+        return changes
+
+    def discard(self, room_id: int, user_ids: Iterable[int]) -> List[PresenceChange]:
+        """Remove the users from the room presence altogether."""
+        raise NotImplementedError
+
+    def sweep(self, limit: int) -> Dict[int, List[PresenceChange]]:
+        """
+        Remove up to ``limit`` user entries past their deadline, from all the rooms,
+        and return the changes it made by room.
+        """
+        raise NotImplementedError
+
+    def get_users(self, room_id: int) -> PresenceUsers:
+        """Return all the presence users in the room."""
+        return self.get_snapshot(room_id)[1]
+
+    def get_snapshot(self, room_id: int) -> Tuple[int, PresenceUsers]:
+        """Return the version of the room presence along with its users."""
+        raise NotImplementedError
+
+    def get_changes(self, room_id: int, since_version: int) -> Optional[Tuple[int, List[PresenceChange]]]:
+        """
+        Return the current version and the changes made after ``since_version``, oldest
+        first. None when those changes aren't all remembered anymore, the caller needs
+        a new snapshot then.
+        """
+        raise NotImplementedError
+
+    async def update_many_async(self, room_ids: Iterable[int], user_id: int, data: dict) -> Dict[int, PresenceChange]:
+        return self.update_many(room_ids, user_id, data)
+
+    async def mark_left_many_async(self, room_ids: Iterable[int], user_id: int) -> Dict[int, PresenceChange]:
+        return self.mark_left_many(room_ids, user_id)
+
+    async def sweep_async(self, limit: int) -> Dict[int, List[PresenceChange]]:
+        return self.sweep(limit)
+
+    async def get_snapshot_async(self, room_id: int) -> Tuple[int, PresenceUsers]:
+        return self.get_snapshot(room_id)
+
+    async def get_changes_async(
+        self, room_id: int, since_version: int,
+    ) -> Optional[Tuple[int, List[PresenceChange]]]:
+        return self.get_changes(room_id, since_version)
+
+
+class LocMemRoomPresence:
+    __slots__ = ('expires_at', 'users', 'version', 'log')
+
+    def __init__(self):
+        self.expires_at: float = 0
+        self.users: PresenceUsers = {}
+        self.version: int = 0
+        self.log: Deque[PresenceChange] = deque(maxlen=settings.ROOM_PRESENCE_LOG_SIZE)
+
+    def record(self, user_id: int, change: str, data: Optional[dict] = None) -> PresenceChange:
+        self.version += 1
+        entry: PresenceChange = {'version': self.version, 'user': user_id, 'change': change}
+        if data is not None:
+            entry['data'] = dict(data)
+        self.log.append(entry)
+        return entry
+
+
+class LocMemPresenceBackend(BasePresenceBackend):
+    """Process-local presence, for tests and single process development servers."""
+
+    def __init__(self):
+        self._rooms: Dict[int, LocMemRoomPresence] = {}
+        # When each (room, user) entry gets swept
+        self._deadlines: Dict[Tuple[int, int], float] = {}
+        self._lock = threading.Lock()
+
+    def _get_room(self, room_id: int, create: bool = True) -> LocMemRoomPresence:
+        room: LocMemRoomPresence = self._rooms.get(room_id)
+        if room is None or room.expires_at <= time.monotonic():
+            self._rooms.pop(room_id, None)
+            room = LocMemRoomPresence()
+            if create:
+                self._rooms[room_id] = room
+        return room
+
+    @staticmethod
+    def _touch(room: LocMemRoomPresence) -> None:
+        room.expires_at = time.monotonic() + settings.ROOM_PRESENCE_TIMEOUT
+
+    def update(self, room_id: int, user_id: int, data: dict) -> Optional[PresenceChange]:
+        with self._lock:
+            room: LocMemRoomPresence = self._get_room(room_id)
+            change: Optional[str] = get_presence_change(room.users.get(user_id), data)
+            room.users[user_id] = dict(data)
+            self._deadlines[room_id, user_id] = get_presence_deadline(data)
+            self._touch(room)
+            return room.record(user_id, change, data) if change else None
+
+    def mark_left(self, room_id: int, user_id: int) -> Optional[PresenceChange]:
+        with self._lock:
+            room: LocMemRoomPresence = self._get_room(room_id, create=False)
+            user: Optional[dict] = room.users.get(user_id)
+            if user is None or user.get('left'):
+                return None
+            user['left'] = True
+            self._deadlines[room_id, user_id] = get_presence_deadline(user)
+            self._touch(room)
+            return room.record(user_id, PRESENCE_LEFT)
+
+    def discard(self, room_id: int, user_ids: Iterable[int]) -> List[PresenceChange]:
+        with self._lock:
+            room: LocMemRoomPresence = self._get_room(room_id, create=False)
+            changes: List[PresenceChange] = []
+            for user_id in user_ids:
+                self._deadlines.pop((room_id, user_id), None)
+                if room.users.pop(user_id, None) is not None:
+                    changes.append(room.record(user_id, PRESENCE_REMOVED))
+            return changes
+
+    def sweep(self, limit: int) -> Dict[int, List[PresenceChange]]:
+        now: float = time.time()
+        changes: Dict[int, List[PresenceChange]] = defaultdict(list)
+        with self._lock:
+            expired: List[Tuple[int, int]] = [key for key, deadline in self._deadlines.items() if deadline <= now]
+            for room_id, user_id in expired[:limit]:
+                del self._deadlines[room_id, user_id]
+                room: LocMemRoomPresence = self._get_room(room_id, create=False)
+                if room.users.pop(user_id, None) is not None:
+                    changes[room_id].append(room.record(user_id, PRESENCE_REMOVED))
+        return dict(changes)
+
+    def get_snapshot(self, room_id: int) -> Tuple[int, PresenceUsers]:
+        with self._lock:
+            room: LocMemRoomPresence = self._get_room(room_id, create=False)
+            return room.version, {user_id: dict(data) for user_id, data in room.users.items()}
+
+    def get_changes(self, room_id: int, since_version: int) -> Optional[Tuple[int, List[PresenceChange]]]:
+        with self._lock:
+            room: LocMemRoomPresence = self._get_room(room_id, create=False)
+            if since_version > room.version:
+                return None
+            changes: List[PresenceChange] = [change for change in room.log if change['version'] > since_version]
+            if len(changes) != room.version - since_version:
+                return None
+            return room.version, changes
+
+
+class RedisPresenceBackend(BasePresenceBackend):
+    """
+    Keeps one Redis hash per room with a JSON encoded field per user, so every
+    update is a single HSET/HDEL instead of rewriting the whole room.
+
+    The version of a room is a counter next to its hash, and its recent changes
+    a sorted set scored by version. Scripts keep the three in step.
+
+    The deadlines of all the entries are kept in a single sorted set of
+    "<room>:<user>" members scored by deadline, so sweeping reads the expired
+    entries off its head instead of scanning every room.
+
+    The asyncio API runs the same commands and scripts through the aioredis pools
+    of ``chat.async_redis``.
+    """
+
+    # Stores the user and logs the change, heartbeats that only refresh last_update aren't changes
+    UPDATE_SCRIPT = """
+    local function changed(old, new)
+        for key, value in pairs(new) do
+            if key ~= 'last_update' and old[key] ~= value then
+                return true
+            end
+        end
+        return false
+    end
+    local old = redis.call('HGET', KEYS[1], ARGV[1])
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    local change = false
+    if not old then
+        change = 'joined'
+    else
+        old = cjson.decode(old)
+        local new = cjson.decode(ARGV[2])
+        if old['left'] and not new['left'] then
+            change = 'joined'
+        elseif changed(old, new) then
+            change = 'updated'
+        end
+    end
+    local entry = false
+    if change then
+        local version = redis.call('INCR', KEYS[2])
+        -- Built by hand rather than with cjson, which would round the timestamps in the data
+        entry = '{"version":' .. version .. ',"user":' .. ARGV[1] .. ',"change":"' .. change .. '"'
+            .. ',"data":' .. ARGV[2] .. '}'
+        redis.call('ZADD', KEYS[3], version, entry)
+        redis.call('ZREMRANGEBYRANK', KEYS[3], 0, -tonumber(ARGV[4]) - 1)
+    end
+    for i = 1, 3 do
+        redis.call('EXPIRE', KEYS[i], ARGV[3])
+    end
+    redis.call('ZADD', KEYS[4], ARGV[5], ARGV[6])
+    return entry
+    """
+
+    # Flip the flag in place, the read and the write must not interleave with other workers
+    MARK_LEFT_SCRIPT = """
+    local data = redis.call('HGET', KEYS[1], ARGV[1])
+    if not data then
+        return false
+    end
+    -- Edits the JSON text, cjson would round last_update decoding and encoding it again. Quotes
+    -- inside the string values are escaped, so only the key itself matches
+    local flipped, count = string.gsub(data, '"left"%s*:%s*false', '"left": true', 1)
+    if count == 0 then
+        return false
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], flipped)
+    local version = redis.call('INCR', KEYS[2])
+    local entry = '{"version":' .. version .. ',"user":' .. ARGV[1] .. ',"change":"left"}'
+    redis.call('ZADD', KEYS[3], version, entry)
+    redis.call('ZREMRANGEBYRANK', KEYS[3], 0, -tonumber(ARGV[3]) - 1)
+    for i = 1, 3 do
+        redis.call('EXPIRE', KEYS[i], ARGV[2])
+    end
+    redis.call('ZADD', KEYS[4], ARGV[4], ARGV[5])
+    return entry
+    """
+
+    # Removes the users unless ARGV[3] is a time and their entry was refreshed past it in the meantime
+    DISCARD_SCRIPT = """
+    local entries = {}
+    for i = 4, #ARGV do
+        local member = ARGV[2] .. ':' .. ARGV[i]
+        local deadline = redis.call('ZSCORE', KEYS[4], member)
+        if ARGV[3] == '' or not deadline or tonumber(deadline) <= tonumber(ARGV[3]) then
+            redis.call('ZREM', KEYS[4], member)
+            if redis.call('HDEL', KEYS[1], ARGV[i]) == 1 then
+                local version = redis.call('INCR', KEYS[2])
+                local entry = '{"version":' .. version .. ',"user":' .. ARGV[i] .. ',"change":"removed"}'
+                redis.call('ZADD', KEYS[3], version, entry)
+                table.insert(entries, entry)
+            end
+        end
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[3], 0, -tonumber(ARGV[1]) - 1)
+    return entries
+    """
+
+    def __init__(self, client=None, address=None):
+        if client is not None:
+            self.client = client
+        self.async_redis: AsyncRedis = get_async_redis(address)
+
+    @cached_property
+    def client(self):
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+
+    @cached_property
+    def update_script(self):
+        return self.client.register_script(self.UPDATE_SCRIPT)
+
+    @cached_property
+    def mark_left_script(self):
+        return self.client.register_script(self.MARK_LEFT_SCRIPT)
+
+    @cached_property
+    def discard_script(self):
+        return self.client.register_script(self.DISCARD_SCRIPT)
+
+    @staticmethod
+    def get_key(room_id: int) -> str:
+        return cache.make_key(get_room_presence_cache_key(room_id))
+
+    def get_keys(self, room_id: int) -> List[str]:
+        """The users hash, the version counter and the change log of the room, then the deadlines of all rooms."""
+        key: str = self.get_key(room_id)
+        return [key, f'{key}:version', f'{key}:log', self.deadlines_key]
+
+    @cached_property
+    def deadlines_key(self) -> str:
+        return cache.make_key('room-presence-deadlines')
+
+    def update(self, room_id: int, user_id: int, data: dict) -> Optional[PresenceChange]:
+        return self.update_many([room_id], user_id, data).get(room_id)
+
+    def update_many(self, room_ids: Iterable[int], user_id: int, data: dict) -> Dict[int, PresenceChange]:
+        # One round trip for all the rooms
+        room_ids = list(room_ids)
+        value: str = json.dumps(data)
+        deadline: float = get_presence_deadline(data)
+        pipeline = self.client.pipeline()
+        for room_id in room_ids:
+            self.update_script(
+                keys=self.get_keys(room_id),
+                args=[
+                    user_id, value, settings.ROOM_PRESENCE_TIMEOUT, settings.ROOM_PRESENCE_LOG_SIZE,
+                    deadline, f'{room_id}:{user_id}',
+                ],
+                client=pipeline,
+            )
+        return self.parse_changes(room_ids, pipeline.execute())
+
+    def mark_left(self, room_id: int, user_id: int) -> Optional[PresenceChange]:
+        return self.mark_left_many([room_id], user_id).get(room_id)
+
+    def mark_left_many(self, room_ids: Iterable[int], user_id: int) -> Dict[int, PresenceChange]:
+        room_ids = list(room_ids)
+        deadline: float = get_presence_deadline({'left': True})
+        pipeline = self.client.pipeline()
+        for room_id in room_ids:
+            self.mark_left_script(
+                keys=self.get_keys(room_id),
+                args=[
+                    user_id, settings.ROOM_PRESENCE_TIMEOUT, settings.ROOM_PRESENCE_LOG_SIZE,
+                    deadline, f'{room_id}:{user_id}',
+                ],
+                client=pipeline,
+            )
+        return self.parse_changes(room_ids, pipeline.execute())
+
+    @staticmethod
+    def parse_changes(room_ids: List[int], entries: list) -> Dict[int, PresenceChange]:
+        return {room_id: json.loads(entry) for room_id, entry in zip(room_ids, entries) if entry}
+
+    def discard(self, room_id: int, user_ids: Iterable[int]) -> List[PresenceChange]:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return []
+        entries: list = self.discard_script(
+            keys=self.get_keys(room_id), args=[settings.ROOM_PRESENCE_LOG_SIZE, room_id, '', *user_ids],
+        )
+        return [json.loads(entry) for entry in entries]
+
+    def sweep(self, limit: int) -> Dict[int, List[PresenceChange]]:
+        now: float = time.time()
+        members: List[bytes] = self.client.zrangebyscore(self.deadlines_key, '-inf', now, start=0, num=limit)
+        expired: Dict[int, List[int]] = defaultdict(list)
+        for member in members:
+            room_id, user_id = map(int, member.split(b':'))
+            expired[room_id].append(user_id)
+        # One script per room, each one checks the deadlines again as users may have come back since
+        pipeline = self.client.pipeline()
+        for room_id, user_ids in expired.items():
+            self.discard_script(
+                keys=self.get_keys(room_id),
+                args=[settings.ROOM_PRESENCE_LOG_SIZE, room_id, now, *user_ids],
+                client=pipeline,
+            )
+        changes: Dict[int, List[PresenceChange]] = {}
+        for room_id, entries in zip(expired, pipeline.execute()):
+            if entries:
+                changes[room_id] = [json.loads(entry) for entry in entries]
+        return changes
+
+    def get_snapshot(self, room_id: int) -> Tuple[int, PresenceUsers]:
+        users_key, version_key = self.get_keys(room_id)[:2]
+        # MULTI, so the version matches the users
+        users, version = self.client.pipeline().hgetall(users_key).get(version_key).execute()
+        return int(version or 0), {int(user_id): json.loads(data) for user_id, data in users.items()}
+
+    def get_changes(self, room_id: int, since_version: int) -> Optional[Tuple[int, List[PresenceChange]]]:
+        version_key, log_key = self.get_keys(room_id)[1:3]
+        version, entries = self.client.pipeline().get(version_key).zrangebyscore(
+            log_key, f'({since_version}', '+inf',
+        ).execute()
+        version = int(version or 0)
+        if since_version > version or len(entries) != version - since_version:
+            return None
+        return version, [json.loads(entry) for entry in entries]
+
+    # asyncio API, the same Redis commands and scripts through aioredis
+
+    async def update_many_async(self, room_ids: Iterable[int], user_id: int, data: dict) -> Dict[int, PresenceChange]:
+        room_ids = list(room_ids)
+        value: str = json.dumps(data)
+        deadline: float = get_presence_deadline(data)
+        redis: aioredis.Redis = await self.async_redis.get_pool()
+        entries: list = await asyncio.gather(*(
+            run_script(
+                redis, self.UPDATE_SCRIPT,
+                keys=self.get_keys(room_id),
+                args=[
+                    user_id, value, settings.ROOM_PRESENCE_TIMEOUT, settings.ROOM_PRESENCE_LOG_SIZE,
+                    deadline, f'{room_id}:{user_id}',
+                ],
+            ) for room_id in room_ids
+        ))
+        return self.parse_changes(room_ids, entries)
+
+    async def mark_left_many_async(self, room_ids: Iterable[int], user_id: int) -> Dict[int, PresenceChange]:
+        room_ids = list(room_ids)
+        deadline: float = get_presence_deadline({'left': True})
+        redis: aioredis.Redis = await self.async_redis.get_pool()
+        entries: list = await asyncio.gather(*(
+            run_script(
+                redis, self.MARK_LEFT_SCRIPT,
+                keys=self.get_keys(room_id),
+                args=[
+                    user_id, settings.ROOM_PRESENCE_TIMEOUT, settings.ROOM_PRESENCE_LOG_SIZE,
+                    deadline, f'{room_id}:{user_id}',
+                ],
+            ) for room_id in room_ids
+        ))
+        return self.parse_changes(room_ids, entries)
+
+    async def sweep_async(self, limit: int) -> Dict[int, List[PresenceChange]]:
+        now: float = time.time()
+        redis: aioredis.Redis = await self.async_redis.get_pool()
+        members: List[bytes] = await redis.zrangebyscore(self.deadlines_key, max=now, offset=0, count=limit)
+        expired: Dict[int, List[int]] = defaultdict(list)
+        for member in members:
+            room_id, user_id = map(int, member.split(b':'))
+            expired[room_id].append(user_id)
+        results: list = await asyncio.gather(*(
+            run_script(
+                redis, self.DISCARD_SCRIPT,
+                keys=self.get_keys(room_id),
+                args=[settings.ROOM_PRESENCE_LOG_SIZE, room_id, now, *user_ids],
+            ) for room_id, user_ids in expired.items()
+        ))
+        changes: Dict[int, List[PresenceChange]] = {}
+        for room_id, entries in zip(expired, results):
+            if entries:
+                changes[room_id] = [json.loads(entry) for entry in entries]
+        return changes
+
+    async def get_snapshot_async(self, room_id: int) -> Tuple[int, PresenceUsers]:
+        users_key, version_key = self.get_keys(room_id)[:2]
+        redis: aioredis.Redis = await self.async_redis.get_pool()
+        transaction = redis.multi_exec()
+        transaction.hgetall(users_key)
+        transaction.get(version_key)
+        users, version = await transaction.execute()
+        return int(version or 0), {int(user_id): json.loads(data) for user_id, data in users.items()}
+
+    async def get_changes_async(
+        self, room_id: int, since_version: int,
+    ) -> Optional[Tuple[int, List[PresenceChange]]]:
+        version_key, log_key = self.get_keys(room_id)[1:3]
+        redis: aioredis.Redis = await self.async_redis.get_pool()
+        transaction = redis.multi_exec()
+        transaction.get(version_key)
+        transaction.zrangebyscore(log_key, since_version, exclude=aioredis.Redis.ZSET_EXCLUDE_MIN)
+        version, entries = await transaction.execute()
+        version = int(version or 0)
+        if since_version > version or len(entries) != version - since_version:
+            return None
+        return version, [json.loads(entry) for entry in entries]
+
+
+_backend: Optional[BasePresenceBackend] = None
+
+
+def get_presence_backend() -> BasePresenceBackend:
+    """Return the presence backend configured by ``ROOM_PRESENCE_BACKEND``."""
+    global _backend
+    if _backend is None:
+        _backend = import_string(settings.ROOM_PRESENCE_BACKEND)()
+    return _backend
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Tuple
+
+from django.conf import settings
+
+from chat.metrics import CounterCollector
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` actions per second on average, with bursts of up to ``capacity`` actions.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate: float = rate
+        self.capacity: int = capacity
+        self.tokens: float = capacity
+        self.updated_at: float = time.monotonic()
+
+    def consume(self, tokens: int = 1) -> bool:
+        """Take tokens from the bucket, returns False when there aren't enough of them left."""
+        now: float = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class RoomRateLimiter:
+    """
+    One token bucket per (user, room), shared by all the connections of the user in this process.
+
+    Only the ``ROOM_RATE_LIMIT_USERS`` most recently active buckets are kept around.
+    """
+
+    def __init__(self):
+        self._buckets: 'OrderedDict[Tuple[int, int], TokenBucket]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, user_id: int, room_id: int) -> bool:
+        key: Tuple[int, int] = (user_id, room_id)
+        with self._lock:
+            bucket: TokenBucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(settings.ROOM_RATE_LIMIT, settings.ROOM_RATE_LIMIT_BURST)
+                while len(self._buckets) > settings.ROOM_RATE_LIMIT_USERS:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.consume()
+
+
+room_rate_limiter = RoomRateLimiter()
+
+# How many commands were rejected, by limit, and how many sockets were closed for it
+rate_limit_stats: Counter = Counter()
+CounterCollector(
+    'whisper_rate_limited_total', 'Commands rejected by a rate limit, and sockets closed for it.', 'limit',
+    rate_limit_stats,
+)
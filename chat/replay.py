@@ -0,0 +1,303 @@
+"""
+Sequence numbers and replay buffers of the room messages, so clients that lost
+their connection for a moment can catch up instead of reloading everything.
+
+Every message sent to a room gets the next sequence number of the room, and the
+last ``ROOM_REPLAY_BUFFER_SIZE`` of them are kept encoded as sent. Reconnecting
+clients send the ``resume`` command with the resume token of their previous
+connection and the last sequence number they saw in each room; the rooms of
+that connection are joined again and only the messages they missed are sent.
+
+Join and leave notices and presence deltas aren't numbered, presence has its
+own versions for catching up, see ``chat.presence``.
+"""
+import json
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import aioredis
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+from chat import encoding
+from chat.async_redis import AsyncRedis, get_async_redis, run_script
+
+# The current sequence number of a room, and the events after the one asked for or None
+RoomReplay = Tuple[int, Optional[List[str]]]
+
+
+def get_room_events_cache_key(room_id: int) -> str:
+    return f'room-events-{room_id}'
+
+
+def get_resume_cache_key(token: str) -> str:
+    return f'resume-{token}'
+
+
+def add_seq(seq: int, text: str) -> str:
+    """Add the sequence number to an encoded JSON object without decoding it."""
+    return f'{{"seq":{seq},{text[1:]}'
+
+
+class BaseReplayBackend:
+    """
+    Numbers the messages of each room and remembers the last ``ROOM_REPLAY_BUFFER_SIZE``
+    of them. The events of rooms nobody wrote to for ``ROOM_REPLAY_TIMEOUT`` seconds
+    are forgotten, their numbering goes on where it was: connected clients skip
+    the numbers they already saw, so it must never start over.
+
+    The ``*_async`` methods are the same for the consumers, which must not block
+    the event loop. They call the blocking ones by default, which is fine for the
+    in-memory backend; the ones doing I/O override them.
+    """
+
+    def append(self, room_id: int, content: dict) -> Tuple[int, str]:
+        """Number the event and remember it, returns its sequence number and its JSON encoding."""
+        raise NotImplementedError
+
+    def replay(self, since: Dict[int, Optional[int]]) -> Dict[int, RoomReplay]:
+        """
+        Return the current sequence number of every room, with the JSON encoded events
+        sent after the one asked for, oldest first. The events are None when no number
+        was asked for, or when they aren't all remembered anymore.
+        """
+        raise NotImplementedError
+
+    def save_resume_rooms(self, token: str, user_id: int, room_ids: List[int]) -> None:
+        """Remember the rooms of a closed connection for ``RESUME_TIMEOUT`` seconds, for it to be resumed."""
+        raise NotImplementedError
+
+    def pop_resume_rooms(self, token: str, user_id: int) -> Optional[List[int]]:
+        """
+        Return the rooms of the connection the token was given to and forget them,
+        None when the token isn't valid anymore or belongs to someone else. Each token
+        is used once, the resumed connection gets its own.
+        """
+        raise NotImplementedError
+
+    async def append_async(self, room_id: int, content: dict) -> Tuple[int, str]:
+        return self.append(room_id, content)
+
+    async def replay_async(self, since: Dict[int, Optional[int]]) -> Dict[int, RoomReplay]:
+        return self.replay(since)
+
+    async def save_resume_rooms_async(self, token: str, user_id: int, room_ids: List[int]) -> None:
+        self.save_resume_rooms(token, user_id, room_ids)
+
+    async def pop_resume_rooms_async(self, token: str, user_id: int) -> Optional[List[int]]:
+        return self.pop_resume_rooms(token, user_id)
+
+
+class LocMemRoomEvents:
+    __slots__ = ('expires_at', 'seq', 'events')
+
+    def __init__(self):
+        self.expires_at: float = 0
+        self.seq: int = 0
+        self.events: Deque[str] = deque(maxlen=settings.ROOM_REPLAY_BUFFER_SIZE)
+
+
+class LocMemReplayBackend(BaseReplayBackend):
+    """Process-local replay buffers, for tests and single process development servers."""
+
+    def __init__(self):
+        self._rooms: Dict[int, LocMemRoomEvents] = {}
+        # The expiry, owner and rooms of each resume token
+        self._resume: Dict[str, Tuple[float, int, List[int]]] = {}
+        self._lock = threading.Lock()
+
+    def _get_room(self, room_id: int) -> LocMemRoomEvents:
+        room: LocMemRoomEvents = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = LocMemRoomEvents()
+        elif room.expires_at <= time.monotonic():
+            room.events.clear()
+        return room
+
+    def append(self, room_id: int, content: dict) -> Tuple[int, str]:
+        text: str = encoding.dumps(content)
+        with self._lock:
+            room: LocMemRoomEvents = self._get_room(room_id)
+            room.seq += 1
+            event: str = add_seq(room.seq, text)
+            room.events.append(event)
+            room.expires_at = time.monotonic() + settings.ROOM_REPLAY_TIMEOUT
+            return room.seq, event
+
+    def replay(self, since: Dict[int, Optional[int]]) -> Dict[int, RoomReplay]:
+        replays: Dict[int, RoomReplay] = {}
+        with self._lock:
+            for room_id, since_seq in since.items():
+                room: LocMemRoomEvents = self._get_room(room_id)
+                events: Optional[List[str]] = None
+                if since_seq is not None and 0 <= room.seq - since_seq <= len(room.events):
+                    events = list(room.events)[len(room.events) - (room.seq - since_seq):]
+                replays[room_id] = room.seq, events
+        return replays
+
+    def save_resume_rooms(self, token: str, user_id: int, room_ids: List[int]) -> None:
+        now: float = time.monotonic()
+        with self._lock:
+            for expired in [key for key, (expires_at, _, _) in self._resume.items() if expires_at <= now]:
+                del self._resume[expired]
+            self._resume[token] = now + settings.RESUME_TIMEOUT, user_id, list(room_ids)
+
+    def pop_resume_rooms(self, token: str, user_id: int) -> Optional[List[int]]:
+        with self._lock:
+            expires_at, owner, room_ids = self._resume.get(token, (0, None, None))
+            if expires_at <= time.monotonic() or owner != user_id:
+                return None
+            del self._resume[token]
+            return room_ids
+
+
+class RedisReplayBackend(BaseReplayBackend):
+    """
+    Keeps the sequence number of a room in a counter and its last events in a
+    sorted set scored by sequence number, a script keeps both in step. Only the
+    events expire, the counter is a few bytes per room and stays.
+
+    The asyncio API runs the same commands and scripts through the aioredis pools
+    of ``chat.async_redis``.
+    """
+
+    APPEND_SCRIPT = """
+    local seq = redis.call('INCR', KEYS[1])
+    local event = '{"seq":' .. seq .. ',' .. string.sub(ARGV[1], 2)
+    redis.call('ZADD', KEYS[2], seq, event)
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    return seq
+    """
+
+    # Only the owner gets the rooms, GET and DEL in one step so a token can't be used twice
+    POP_RESUME_SCRIPT = """
+    local value = redis.call('GET', KEYS[1])
+    if not value or cjson.decode(value)[1] ~= tonumber(ARGV[1]) then
+        return false
+    end
+    redis.call('DEL', KEYS[1])
+    return value
+    """
+
+    def __init__(self, client=None, address=None):
+        if client is not None:
+            self.client = client
+        self.async_redis: AsyncRedis = get_async_redis(address)
+
+    @cached_property
+    def client(self):
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+
+    @cached_property
+    def append_script(self):
+        return self.client.register_script(self.APPEND_SCRIPT)
+
+    @cached_property
+    def pop_resume_script(self):
+        return self.client.register_script(self.POP_RESUME_SCRIPT)
+
+    @staticmethod
+    def get_keys(room_id: int) -> List[str]:
+        """The sequence number counter and the events of the room."""
+        key: str = cache.make_key(get_room_events_cache_key(room_id))
+        return [f'{key}:seq', key]
+
+    @staticmethod
+    def get_resume_key(token: str) -> str:
+        return cache.make_key(get_resume_cache_key(token))
+
+    def append(self, room_id: int, content: dict) -> Tuple[int, str]:
+        text: str = encoding.dumps(content)
+        seq: int = self.append_script(
+            keys=self.get_keys(room_id),
+            args=[text, settings.ROOM_REPLAY_BUFFER_SIZE, settings.ROOM_REPLAY_TIMEOUT],
+        )
+        return seq, add_seq(seq, text)
+
+    def replay(self, since: Dict[int, Optional[int]]) -> Dict[int, RoomReplay]:
+        # One round trip for all the rooms, MULTI so the events match the numbers
+        pipeline = self.client.pipeline()
+        for room_id, since_seq in since.items():
+            seq_key, events_key = self.get_keys(room_id)
+            pipeline.get(seq_key)
+            if since_seq is not None:
+                pipeline.zrangebyscore(events_key, f'({since_seq}', '+inf')
+        return self.parse_replays(since, pipeline.execute())
+
+    @staticmethod
+    def parse_replays(since: Dict[int, Optional[int]], results: list) -> Dict[int, RoomReplay]:
+        """Pair the results of the replay commands with the rooms."""
+        results = iter(results)
+        replays: Dict[int, RoomReplay] = {}
+        for room_id, since_seq in since.items():
+            seq: int = int(next(results) or 0)
+            events: Optional[List[str]] = None
+            if since_seq is not None:
+                events = [event.decode() for event in next(results)]
+                if since_seq > seq or len(events) != seq - since_seq:
+                    events = None
+            replays[room_id] = seq, events
+        return replays
+
+    def save_resume_rooms(self, token: str, user_id: int, room_ids: List[int]) -> None:
+        self.client.set(self.get_resume_key(token), json.dumps([user_id, room_ids]), ex=settings.RESUME_TIMEOUT)
+
+    def pop_resume_rooms(self, token: str, user_id: int) -> Optional[List[int]]:
+        value: Optional[bytes] = self.pop_resume_script(keys=[self.get_resume_key(token)], args=[user_id])
+        if value is None:
+            return None
+        return json.loads(value.decode())[1]
+
+    # asyncio API, the same Redis commands and scripts through aioredis
+
+    async def append_async(self, room_id: int, content: dict) -> Tuple[int, str]:
+        text: str = encoding.dumps(content)
+        redis: aioredis.Redis = await self.async_redis.get_pool()
+        seq: int = await run_script(
+            redis, self.APPEND_SCRIPT,
+            keys=self.get_keys(room_id),
+            args=[text, settings.ROOM_REPLAY_BUFFER_SIZE, settings.ROOM_REPLAY_TIMEOUT],
+        )
+        return seq, add_seq(seq, text)
+
+    async def replay_async(self, since: Dict[int, Optional[int]]) -> Dict[int, RoomReplay]:
+        if not since:
+            return {}
+        redis: aioredis.Redis = await self.async_redis.get_pool()
+        transaction = redis.multi_exec()
+        for room_id, since_seq in since.items():
+            seq_key, events_key = self.get_keys(room_id)
+            transaction.get(seq_key)
+            if since_seq is not None:
+                transaction.zrangebyscore(events_key, since_seq, exclude=aioredis.Redis.ZSET_EXCLUDE_MIN)
+        return self.parse_replays(since, await transaction.execute())
+
+    async def save_resume_rooms_async(self, token: str, user_id: int, room_ids: List[int]) -> None:
+        redis: aioredis.Redis = await self.async_redis.get_pool()
+        await redis.set(self.get_resume_key(token), json.dumps([user_id, room_ids]), expire=settings.RESUME_TIMEOUT)
+
+    async def pop_resume_rooms_async(self, token: str, user_id: int) -> Optional[List[int]]:
+        redis: aioredis.Redis = await self.async_redis.get_pool()
+        value: Optional[bytes] = await run_script(
+            redis, self.POP_RESUME_SCRIPT, keys=[self.get_resume_key(token)], args=[user_id],
+        )
+        if value is None:
+            return None
+        return json.loads(value.decode())[1]
+
+
+_backend: Optional[BaseReplayBackend] = None
+
+
+def get_replay_backend() -> BaseReplayBackend:
+    """Return the replay backend configured by ``ROOM_REPLAY_BACKEND``."""
+    global _backend
+    if _backend is None:
+        _backend = import_string(settings.ROOM_REPLAY_BACKEND)()
+    return _backend
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+from channels.layers import DEFAULT_CHANNEL_LAYER, channel_layers
+from django.conf import settings
+
+from chat.models import Room
+
+logger = logging.getLogger(__name__)
+
+# Every worker serving websockets is in this group, see InvalidationListener
+ROOM_INVALIDATION_GROUP = 'room-invalidations'
+
+
+class CachedRoom(NamedTuple):
+    """The subset of a Room the consumer needs, safe to share between connections."""
+    id: int
+    title: str
+    staff_only: bool
+    group_name: str
+
+    @classmethod
+    def from_room(cls, room: Room) -> 'CachedRoom':
+        return cls(id=room.id, title=room.title, staff_only=room.staff_only, group_name=room.group_name)
+
+
+class RoomCache:
+    """
+    Process-local LRU cache of rooms, so the consumer hot path doesn't hit the database.
+
+    Entries expire after ``ROOM_CACHE_TIMEOUT`` seconds and the least recently used
+    ones are evicted once there are more than ``ROOM_CACHE_SIZE`` of them.
+    Changes to rooms are pushed to every worker by the signals in ``chat.signals``,
+    see ``InvalidationListener``.
+    """
+
+    def __init__(self):
+        self._rooms: 'OrderedDict[int, Tuple[float, CachedRoom]]' = OrderedDict()
+        # Bumped by invalidate, so rooms read before it aren't stored after it
+        self._generation: int = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    @property
+    def generation(self) -> int:
+        """Take it before reading rooms from the database, and pass it to ``set`` along with them."""
+        return self._generation
+
+    def get(self, room_id: int) -> Optional[CachedRoom]:
+        """Return the cached room, or None when it's unknown or has expired."""
+        with self._lock:
+            entry = self._rooms.get(room_id)
+            if entry is None:
+                return None
+            expires_at, room = entry
+            if expires_at <= time.monotonic():
+                del self._rooms[room_id]
+                return None
+            self._rooms.move_to_end(room_id)
+            return room
+
+    def set(self, room: CachedRoom, generation: Optional[int] = None) -> None:
+        """
+        Cache the room, evicting the least recently used rooms if we're full. Given the
+        ``generation`` from before it was read, it's dropped if rooms were invalidated since.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._rooms[room.id] = (time.monotonic() + settings.ROOM_CACHE_TIMEOUT, room)
+            self._rooms.move_to_end(room.id)
+            while len(self._rooms) > settings.ROOM_CACHE_SIZE:
+                self._rooms.popitem(last=False)
+
+    def invalidate(self, room_id: int) -> None:
+        """Forget the room so the next lookup goes to the database."""
+        with self._lock:
+            self._rooms.pop(room_id, None)
+            self._generation += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rooms.clear()
+            self._generation += 1
+
+
+room_cache = RoomCache()
+
+
+class InvalidationListener:
+    """
+    Evicts the rooms changed by any process from the room cache of this one.
+
+    A single channel per process is added to ``ROOM_INVALIDATION_GROUP``, so every
+    worker gets one message per change whatever rooms its connections are in,
+    including the rooms it only cached for denied joins. It receives through a
+    channel layer of its own, the consumers share theirs with one event loop.
+    """
+
+    def __init__(self, cache: RoomCache):
+        self.cache: RoomCache = cache
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Future] = None
+        self._join_handle: Optional[asyncio.Handle] = None
+
+    def start(self) -> None:
+        """Start listening from the running event loop, unless it's already being done."""
+        loop = asyncio.get_event_loop()
+        if loop is not self._loop and DEFAULT_CHANNEL_LAYER in channel_layers:
+            self._loop = loop
+            self._task = asyncio.ensure_future(self.listen(channel_layers.make_backend(DEFAULT_CHANNEL_LAYER)))
+
+    async def stop(self) -> None:
+        """Stop listening, from the event loop it was started from."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+        self._loop = self._task = None
+
+    async def listen(self, channel_layer) -> None:
+        channel: Optional[str] = None
+        try:
+            channel = await channel_layer.new_channel()
+            await self.join(channel_layer, channel)
+            while True:
+                message: dict = await channel_layer.receive(channel)
+                if message.get("type") == "room.invalidate":
+                    self.cache.invalidate(message["room_id"])
+        except asyncio.CancelledError:
+            if channel is not None:
+                await channel_layer.group_discard(ROOM_INVALIDATION_GROUP, channel)
+            raise
+        except Exception:
+            # Cached rooms still expire after ROOM_CACHE_TIMEOUT, try again with the next connection
+            logger.warning('Stopped listening to room invalidations', exc_info=True)
+            self._loop = None
+        finally:
+            if self._join_handle is not None:
+                self._join_handle.cancel()
+            if hasattr(channel_layer, 'close_pools'):
+                await channel_layer.close_pools()
+
+    def _tick(self, channel_layer, channel: str) -> None:
+        asyncio.ensure_future(self.join(channel_layer, channel))
+
+    async def join(self, channel_layer, channel: str) -> None:
+        """Join the group again well before the layer forgets its members after ``group_expiry``."""
+        await channel_layer.group_add(ROOM_INVALIDATION_GROUP, channel)
+        self._join_handle = asyncio.get_event_loop().call_later(
+            channel_layer.group_expiry / 2, self._tick, channel_layer, channel,
+        )
+
+
+invalidation_listener = InvalidationListener(room_cache)
@@ -0,0 +1,81 @@
+"""
+The first page of the room directory the index page embeds, serialized once per
+change of the rooms. The rest is fetched from the ``rooms`` view.
+
+The serialized page is kept in the Django cache under the current room list
+version, which is the time the rooms last changed. Changing a room (see
+``chat.signals``) moves the version on, so every process starts using the new
+page at once and the old one simply expires. The version is also part of the
+ETags of the index page and the ``rooms`` view, see ``chat.views``.
+
+Bulk queryset operations don't send signals, call ``invalidate_room_list`` after them.
+"""
+import base64
+import json
+import time
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from chat.exceptions import ClientError
+from chat.models import Room
+
+ROOM_LIST_VERSION_KEY = 'room-list-version'
+
+
+def get_room_list_cache_key(version: str, staff: bool) -> str:
+    return f'room-list-{version}-{"staff" if staff else "all"}'
+
+
+def get_room_list_version() -> str:
+    """Return the current version of the room list, starting one if the cache lost it."""
+    version: str = cache.get(ROOM_LIST_VERSION_KEY)
+    if version is None:
+        # Whoever gets there first sets it, the others use theirs
+        cache.add(ROOM_LIST_VERSION_KEY, repr(time.time()), None)
+        version = cache.get(ROOM_LIST_VERSION_KEY)
+    return version
+
+
+def invalidate_room_list() -> None:
+    """Move the room list to a new version, after rooms were changed."""
+    cache.set(ROOM_LIST_VERSION_KEY, repr(time.time()), None)
+
+
+def encode_cursor(room: dict) -> str:
+    """Return the opaque cursor of the directory page after ``room``."""
+    return base64.urlsafe_b64encode(json.dumps([room['title'], room['id']]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """Return the (title, id) pair of a cursor made by ``encode_cursor``."""
+    try:
+        title, room_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return str(title), int(room_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ClientError("CURSOR_INVALID")
+
+
+def get_rooms_page(after: Optional[str], size: int, query: str = '',
+                   staff: bool = False) -> Tuple[List[dict], Optional[str]]:
+    """Return a page of the room directory and the cursor of the next one, None if it's the last."""
+    rooms: List[dict] = Room.objects.page(decode_cursor(after) if after else None, size + 1, query, staff)
+    if len(rooms) > size:
+        return rooms[:size], encode_cursor(rooms[size - 1])
+    return rooms, None
+
+
+def get_room_list(staff: bool) -> Tuple[str, str, Optional[str]]:
+    """
+    Return the current room list version, the JSON first page of the room directory
+    for staff users or the others, and the cursor of its next page.
+    """
+    version: str = get_room_list_version()
+    key: str = get_room_list_cache_key(version, staff)
+    cached: Optional[Tuple[str, Optional[str]]] = cache.get(key)
+    if cached is None:
+        rooms, cursor = get_rooms_page(None, settings.ROOM_DIRECTORY_PAGE_SIZE, staff=staff)
+        cached = json.dumps(rooms), cursor
+        cache.set(key, cached, settings.ROOM_LIST_CACHE_TIMEOUT)
+    return (version, *cached)
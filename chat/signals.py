@@ -0,0 +1,55 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from chat.auth import user_cache
+from chat.models import Room
+from chat.room_cache import ROOM_INVALIDATION_GROUP, room_cache
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def invalidate_room_cache(sender, instance: Room, **kwargs) -> None:
+    """
+    Evict the changed room from the room cache of this process and of every
+    worker listening to room invalidations. Also moves the room list of the index
+    page on to a new version.
+    """
+    room_id: int = instance.id
+
+    def broadcast() -> None:
+        # Only the index page uses it, the websocket workers don't load it unless their rooms change
+        from chat.room_list import invalidate_room_list
+
+        room_cache.invalidate(room_id)
+        # The change is committed already, failing here would only fail the request that made it
+        try:
+            invalidate_room_list()
+            channel_layer = get_channel_layer()
+            if channel_layer is not None:
+                async_to_sync(channel_layer.group_send)(
+                    ROOM_INVALIDATION_GROUP, {"type": "room.invalidate", "room_id": room_id},
+                )
+        except Exception:
+            # The other workers serve the old room until ROOM_CACHE_TIMEOUT
+            logger.exception('Broadcasting the change of room %s failed', room_id)
+
+    # Wait for the commit, otherwise other workers could cache the old row again
+    transaction.on_commit(broadcast)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_cache(sender, instance, **kwargs) -> None:
+    """Evict the changed user from the websocket user cache of this process, the others let it expire."""
+    user_id: int = instance.id
+    user_cache.invalidate(user_id)
+    # Again once committed, in case a handshake cached the old row in between
+    transaction.on_commit(lambda: user_cache.invalidate(user_id))
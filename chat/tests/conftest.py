@@ -0,0 +1,34 @@
+import pytest
+import redis
+
+from chat.room_cache import invalidation_listener
+
+# The Redis backends are tested in a database of their own, emptied around each test,
+# so they neither see nor wipe what a development server keeps in the default one
+TEST_REDIS_URL = 'redis://localhost:6379/15'
+
+
+@pytest.fixture(autouse=True)
+def stop_invalidation_listener(event_loop):
+    # Connecting consumers start it on the loop of the test, which is closed afterwards
+    yield
+    event_loop.run_until_complete(invalidation_listener.stop())
+
+
+@pytest.fixture
+def redis_client() -> redis.StrictRedis:
+    client = redis.StrictRedis.from_url(TEST_REDIS_URL)
+    client.flushdb()
+    yield client
+    client.flushdb()
+
+
+@pytest.fixture(params=['locmem', 'redis'])
+def backend(request, redis_client: redis.StrictRedis):
+    """
+    Runs the test against both backends of the test module, which names their classes
+    ``LOCMEM_BACKEND`` and ``REDIS_BACKEND``.
+    """
+    if request.param == 'locmem':
+        return request.module.LOCMEM_BACKEND()
+    return request.module.REDIS_BACKEND(client=redis_client, address=TEST_REDIS_URL)
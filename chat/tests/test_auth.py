@@ -0,0 +1,110 @@
+import asyncio
+from importlib import import_module
+from typing import List, Optional
+
+import pytest
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.test.utils import override_settings
+
+from chat.auth import CachedUser, UserCache, UserEntry, get_user, user_cache
+from chat.loadtest import login
+from users.models import User
+from whisper.routing import application
+
+
+@pytest.mark.asyncio
+async def test_user_cache_coalesces_loads() -> None:
+    cache = UserCache()
+    loads: List[int] = []
+    entry: UserEntry = (CachedUser(id=1, username='alireza', name='Alireza Savand', is_staff=False), 'hash')
+
+    async def load(user_id: int) -> Optional[UserEntry]:
+        loads.append(user_id)
+        await asyncio.sleep(0.1)
+        return entry
+
+    gets = [asyncio.ensure_future(cache.get(1, load)) for _ in range(10)]
+    # The one that started the load going away doesn't fail the others
+    await asyncio.sleep(0.01)
+    gets[0].cancel()
+    assert await asyncio.gather(*gets[1:]) == [entry] * 9
+
+    assert loads == [1]
+    assert cache.get_cached(1) == entry
+    # Found without awaiting anything
+    assert await cache.get(1, None) == entry
+
+
+@pytest.mark.asyncio
+async def test_user_cache_expires_and_invalidates(monkeypatch) -> None:
+    now: float = 1000
+    monkeypatch.setattr('chat.auth.time.monotonic', lambda: now)
+    cache = UserCache()
+    entry: UserEntry = (CachedUser(id=1, username='alireza', name='Alireza Savand', is_staff=False), 'hash')
+
+    async def load(user_id: int) -> Optional[UserEntry]:
+        return entry if user_id == 1 else None
+
+    async def fail(user_id: int) -> Optional[UserEntry]:
+        raise RuntimeError
+
+    with override_settings(USER_CACHE_TIMEOUT=10):
+        await cache.get(1, load)
+    now += 5
+    assert cache.get_cached(1) == entry
+    now += 5
+    assert cache.get_cached(1) is None
+
+    await cache.get(1, load)
+    cache.invalidate(1)
+    assert cache.get_cached(1) is None
+
+    # Missing users and failed loads aren't cached
+    assert await cache.get(2, load) is None
+    with pytest.raises(RuntimeError):
+        await cache.get(2, fail)
+    assert len(cache) == 0
+
+
+async def connect(session_key: Optional[str]) -> bool:
+    """Return whether the handshake with the session is accepted, only logged in users are."""
+    headers = [(b'cookie', f'{settings.SESSION_COOKIE_NAME}={session_key}'.encode())] if session_key else []
+    communicator = WebsocketCommunicator(application, '/chat/stream/', headers=headers)
+    connected, _ = await communicator.connect()
+    await communicator.disconnect()
+    return connected
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_cached_auth_middleware(monkeypatch) -> None:
+    user_cache.clear()
+    user: User = await database_sync_to_async(User.objects.create_user)(
+        email='ali@email.com', username='alireza', name='Alireza Savand', password='somepassword',
+    )
+    session_key: str = await database_sync_to_async(login)(user)
+    session = import_module(settings.SESSION_ENGINE).SessionStore
+
+    assert await get_user({'session': session(session_key)}) == CachedUser(
+        id=user.id, username='alireza', name='Alireza Savand', is_staff=False,
+    )
+    assert await connect(session_key)
+
+    # The next handshakes don't load the user again
+    with monkeypatch.context() as patch:
+        patch.setattr('chat.auth.load_user', None)
+        assert await connect(session_key)
+
+    assert isinstance(await get_user({'session': session()}), AnonymousUser)
+    assert not await connect(None)
+
+    # Changing the password logs the sessions out, the change evicts the user from the cache
+    user.set_password('otherpassword')
+    await database_sync_to_async(user.save)()
+    assert isinstance(await get_user({'session': session(session_key)}), AnonymousUser)
+    assert not await connect(session_key)
+
+    await database_sync_to_async(User.objects.filter().delete)()
@@ -0,0 +1,182 @@
+"""
+Micro-benchmarks of the hot paths, run with ``pytest --benchmark``.
+
+Timings are compared against ``benchmarks.json``, refresh it with
+``pytest --benchmark-save`` after an intended change, on the machine the suite runs on.
+"""
+import asyncio
+from functools import partial
+from typing import Dict
+
+import pytest
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.test import Client
+
+from chat.consumers import ChatConsumer
+from chat.models import Room
+from chat.presence import get_presence_backend
+from chat.room_cache import room_cache
+from chat.room_list import invalidate_room_list
+from chat.utils import (
+    cache_or_update_room_presence, get_presence_users, get_room_or_error, get_user_presence, remove_user_from_presence,
+)
+from users.models import User
+
+ROOM_SIZES = (1, 100, 10000, 100000)
+
+# Rooms listed by the index page benchmark
+INDEX_ROOMS = 10000
+
+# Rooms nobody uses, so the benchmarks don't need Room rows to fill their presence
+FIRST_PRESENCE_ROOM_ID = 1000000
+
+# Single user operations may get this many times slower in the biggest room than in
+# the smallest one, more than that means they got linear in the size of the room
+MAX_SLOWDOWN = 10
+
+pytestmark = pytest.mark.benchmark
+
+
+def fill_presence(room_id: int, size: int, user: User) -> None:
+    """Put ``size`` users in the room presence, ``user`` being one of them."""
+    backend = get_presence_backend()
+    backend.discard(room_id, range(size))
+    data: dict = get_user_presence(user)
+    for user_id in range(size - 1):
+        backend.update(room_id, user_id, data)
+    backend.update(room_id, user.id, data)
+
+
+@pytest.fixture
+def user() -> User:
+    # The user id must not clash with the ones fill_presence makes up
+    return User(id=10 ** 9, username='alireza', name='Alireza Savand', is_staff=False)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_get_room_or_error(benchmark, user: User) -> None:
+    room: Room = await database_sync_to_async(Room.objects.create)(title='Savand Bros')
+
+    await get_room_or_error(room.id, user)
+    await benchmark('get_room_or_error.cached', lambda: get_room_or_error(room.id, user))
+
+    async def uncached():
+        room_cache.invalidate(room.id)
+        await get_room_or_error(room.id, user)
+    await benchmark('get_room_or_error.uncached', uncached)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('name', ['cache_or_update_room_presence', 'remove_user_from_presence'])
+async def test_presence_update(benchmark, user: User, name: str) -> None:
+    timings: Dict[int, float] = {}
+    for size in ROOM_SIZES:
+        room_id: int = FIRST_PRESENCE_ROOM_ID + size
+        await database_sync_to_async(fill_presence)(room_id, size, user)
+        if name == 'cache_or_update_room_presence':
+            function = partial(cache_or_update_room_presence, room_id, user)
+        else:
+            function = partial(remove_user_from_presence, room_id, user.id)
+        timings[size] = await benchmark(f'{name}.{size}', function)
+    assert timings[ROOM_SIZES[-1]] <= timings[ROOM_SIZES[0]] * MAX_SLOWDOWN, timings
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('size', ROOM_SIZES)
+async def test_get_presence_users(benchmark, user: User, size: int) -> None:
+    # Linear in the size of the room by nature, only the baseline keeps it in check
+    room_id: int = FIRST_PRESENCE_ROOM_ID + size
+    await database_sync_to_async(fill_presence)(room_id, size, user)
+    await benchmark(f'get_presence_users.{size}', lambda: get_presence_users(room_id))
+
+
+async def connect_consumer(user: User, msgpack: bool = False) -> ChatConsumer:
+    """Return a connected consumer which doesn't write its frames anywhere."""
+    consumer = ChatConsumer({
+        'type': 'websocket',
+        'user': user,
+        'subprotocols': [ChatConsumer.msgpack_subprotocol] if msgpack else [],
+    })
+    consumer.sent = []
+
+    async def base_send(message: dict) -> None:
+        consumer.sent.append(message)
+    consumer.base_send = base_send
+    await consumer.connect()
+    return consumer
+
+
+def get_chat_message(user: User) -> dict:
+    return {
+        'msg_type': settings.MSG_TYPE_MESSAGE,
+        'room': 1,
+        'username': user.username,
+        'message': 'Hello Alireza, how are you doing?',
+    }
+
+
+@pytest.mark.asyncio
+async def test_encode_event(benchmark, user: User) -> None:
+    # Once per message, by the sender
+    consumer: ChatConsumer = await connect_consumer(user)
+    content: dict = get_chat_message(user)
+    await benchmark('ChatConsumer.encode_event', lambda: consumer.encode_event('chat.message', content))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('msgpack', [False, True], ids=['json', 'msgpack'])
+async def test_chat_message(benchmark, user: User, msgpack: bool) -> None:
+    # Once per message, by every receiver
+    consumer: ChatConsumer = await connect_consumer(user, msgpack)
+    event: dict = await consumer.encode_event('chat.message', get_chat_message(user))
+
+    async def chat_message():
+        await consumer.chat_message(event)
+        # Let the outbox drain, as the next event would arrive on a later tick
+        await asyncio.sleep(0)
+    await benchmark(f'ChatConsumer.chat_message.{"msgpack" if msgpack else "json"}', chat_message)
+    assert consumer.sent[-1] == {'type': 'websocket.send', 'bytes': event['bytes']} if msgpack else {
+        'type': 'websocket.send', 'text': event['text'],
+    }
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_join_room(benchmark, user: User) -> None:
+    # Once per room opened, over the configured channel layer so its round trips to Redis count
+    room: Room = await database_sync_to_async(Room.objects.create)(title='Savand Bros')
+    consumer: ChatConsumer = await connect_consumer(user)
+    consumer.channel_layer = get_channel_layer()
+    consumer.channel_name = await consumer.channel_layer.new_channel()
+    await benchmark('ChatConsumer.join_room', lambda: consumer.join_room(room.id))
+    await consumer.disconnect(1000)
+
+
+def get_index_client() -> Client:
+    """Return a client logged in to look at the index page, with INDEX_ROOMS rooms to list."""
+    Room.objects.bulk_create(Room(title=f'Room {i}') for i in range(INDEX_ROOMS - Room.objects.count()))
+    invalidate_room_list()
+    User.objects.create_user(email='ali@email.com', username='alireza', password='somepassword')
+    client = Client()
+    client.login(username='alireza', password='somepassword')
+    return client
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_index(benchmark) -> None:
+    client: Client = await database_sync_to_async(get_index_client)()
+    get = database_sync_to_async(client.get)
+
+    async def uncached():
+        invalidate_room_list()
+        await get('/')
+    await benchmark('index.uncached', uncached)
+    await benchmark('index.cached', lambda: get('/'))
+
+    etag: str = (await get('/'))['ETag']
+    await benchmark('index.not_modified', lambda: get('/', HTTP_IF_NONE_MATCH=etag))
+    assert (await get('/', HTTP_IF_NONE_MATCH=etag)).status_code == 304
@@ -1,11 +1,18 @@
+import asyncio
+from typing import List, Tuple
+
+import msgpack
 import pytest
 from channels.db import database_sync_to_async
 from channels.testing import WebsocketCommunicator
 from django.conf import settings
-from django.test.utils import freeze_time
+from django.test.utils import freeze_time, override_settings
 
 from chat.consumers import ChatConsumer
-from chat.models import Room
+from chat.models import Message, Room
+from chat.ratelimit import rate_limit_stats
+from chat.replay import get_replay_backend
+from chat.writer import message_writer
 from users.models import User
 
 
@@ -15,8 +22,15 @@ def create_room() -> Room:
 
 
 @database_sync_to_async
-def create_user(email: str, username: str, name: str) -> User:
-    return User.objects.create_user(email=email, username=username, name=name, password='somepassword', is_staff=True)
+def create_user(email: str, username: str, name: str, is_staff: bool = True) -> User:
+    return User.objects.create_user(
+        email=email, username=username, name=name, password='somepassword', is_staff=is_staff,
+    )
+
+
+@database_sync_to_async
+def get_messages(room: Room) -> List[Tuple[int, str, str]]:
+    return list(room.messages.order_by('id').values_list('user_id', 'username', 'message'))
 
 
 @database_sync_to_async
@@ -46,7 +60,9 @@ async def test_chat_consumer() -> None:
     # Test joining
     await communicator.send_json_to({"command": "join", "room": room.id})
     response = await communicator.receive_json_from()
-    assert response == {'join': str(room.id), 'title': 'Savand Bros'}
+    assert response == {
+        'join': str(room.id), 'title': 'Savand Bros', 'seq': 0, 'resume_token': communicator.instance.resume_token,
+    }
 
     assert communicator.instance.rooms == set(list([room.id, ]))
 
@@ -57,50 +73,62 @@ async def test_chat_consumer() -> None:
     assert response == {'msg_type': settings.MSG_TYPE_MESSAGE,
                         'room': room.id,
                         'username': user.username,
-                        'message': message}
+                        'message': message,
+                        'seq': 1}
 
     # Getting list of users in the room
     await communicator.send_json_to({'command': 'room_users', 'room': room.id})
     response = await communicator.receive_json_from()
-    last_update: float = response['data']['users']['1']['last_update']
+    last_update: float = response['data']['users'][str(user.id)]['last_update']
     assert isinstance(last_update, float)
     assert response == {
         'data': {
             'users': {
-                '1': {
+                str(user.id): {
                     'name': 'Alireza Savand',
                     'username': 'alireza',
                     'left': False,
                     'last_update': last_update
                 }
-            }
+            },
+            'version': 1,
         },
         'type': settings.MSG_TYPE_INTERNAL, 'room': room.id
     }
 
-    # Testing Sending Message and getting last updated newer
-    message: str = 'Hello Alireza'
+    # Sending again right away doesn't refresh the presence, heartbeats are debounced
     await communicator.send_json_to({"command": "send", "room": room.id, 'message': message})
+    await communicator.receive_json_from()
+    await communicator.send_json_to({'command': 'room_users', 'room': room.id})
     response = await communicator.receive_json_from()
+    assert response['data']['users'][str(user.id)]['last_update'] == last_update
+
+    # Testing Sending Message and getting last updated newer
+    message: str = 'Hello Alireza'
+    with override_settings(ROOM_PRESENCE_HEARTBEAT_INTERVAL=0):
+        await communicator.send_json_to({"command": "send", "room": room.id, 'message': message})
+        response = await communicator.receive_json_from()
     assert response == {'msg_type': settings.MSG_TYPE_MESSAGE,
                         'room': room.id,
                         'username': user.username,
-                        'message': message}
+                        'message': message,
+                        'seq': 3}
 
     await communicator.send_json_to({'command': 'room_users', 'room': room.id})
     response = await communicator.receive_json_from()
-    last_update_now: float = response['data']['users']['1']['last_update']
+    last_update_now: float = response['data']['users'][str(user.id)]['last_update']
     assert last_update_now > last_update
     assert response == {
         'data': {
             'users': {
-                '1': {
+                str(user.id): {
                     'name': 'Alireza Savand',
                     'username': 'alireza',
                     'left': False,
                     'last_update': last_update_now
                 }
-            }
+            },
+            'version': 1,
         },
         'type': settings.MSG_TYPE_INTERNAL, 'room': room.id
     }
@@ -112,7 +140,10 @@ async def test_chat_consumer() -> None:
 
     await communicator_2.send_json_to({"command": "join", "room": room.id})
     response = await communicator_2.receive_json_from()
-    assert response == {'join': str(room.id), 'title': 'Savand Bros'}
+    assert response == {
+        'join': str(room.id), 'title': 'Savand Bros', 'seq': 3, 'resume_token': communicator_2.instance.resume_token,
+    }
+    assert communicator_2.instance.resume_token != communicator.instance.resume_token
 
     response = await communicator.receive_json_from()
     assert response == {'msg_type': settings.MSG_TYPE_ENTER, 'room': room.id, 'username': user_2.username}
@@ -122,17 +153,22 @@ async def test_chat_consumer() -> None:
     await communicator_2.send_json_to({'command': 'room_users', 'room': room.id})
     response = await communicator_2.receive_json_from()
 
-    last_update_1: float = response['data']['users']['1']['last_update']
-    last_update_2: float = response['data']['users']['2']['last_update']
+    last_update_1: float = response['data']['users'][str(user.id)]['last_update']
+    last_update_2: float = response['data']['users'][str(user_2.id)]['last_update']
 
     assert isinstance(last_update_1, float)
     assert isinstance(last_update_2, float)
     assert response == {
         'data': {
             'users': {
-                '1': {'username': user.username, 'name': user.name, 'left': False, 'last_update': last_update_1},
-                '2': {'username': user_2.username, 'name': user_2.name, 'left': False, 'last_update': last_update_2}
-            }
+                str(user.id): {
+                    'username': user.username, 'name': user.name, 'left': False, 'last_update': last_update_1,
+                },
+                str(user_2.id): {
+                    'username': user_2.username, 'name': user_2.name, 'left': False, 'last_update': last_update_2,
+                }
+            },
+            'version': 2,
         },
         'type': settings.MSG_TYPE_INTERNAL, 'room': room.id
     }
@@ -150,14 +186,19 @@ async def test_chat_consumer() -> None:
     # Let's get the users online the room now since Alireza has left us alone
     await communicator_2.send_json_to({'command': 'room_users', 'room': room.id})
     response = await communicator_2.receive_json_from()
-    last_update_1: float = response['data']['users']['1']['last_update']
-    last_update_2: float = response['data']['users']['2']['last_update']
+    last_update_1: float = response['data']['users'][str(user.id)]['last_update']
+    last_update_2: float = response['data']['users'][str(user_2.id)]['last_update']
     assert response == {
         'data': {
             'users': {
-                '1': {'username': user.username, 'name': user.name, 'left': True, 'last_update': last_update_1},
-                '2': {'username': user_2.username, 'name': user_2.name, 'left': False, 'last_update': last_update_2}
-            }
+                str(user.id): {
+                    'username': user.username, 'name': user.name, 'left': True, 'last_update': last_update_1,
+                },
+                str(user_2.id): {
+                    'username': user_2.username, 'name': user_2.name, 'left': False, 'last_update': last_update_2,
+                }
+            },
+            'version': 3,
         },
         'type': settings.MSG_TYPE_INTERNAL, 'room': room.id
     }
@@ -172,5 +213,592 @@ async def test_chat_consumer() -> None:
     await communicator.disconnect()
     await communicator_2.disconnect()
 
+    # Messages are saved in the background
+    await message_writer.flush()
+    assert await get_messages(room) == [(user.id, 'alireza', 'Hello Alireza')] * 3
+
     # Teardown
     await tear_down()
+
+
+@database_sync_to_async
+def create_messages(room: Room, user: User, count: int) -> None:
+    Message.objects.bulk_create(
+        Message(room=room, user=user, username=user.username, message=str(i)) for i in range(count)
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_history() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+    room: Room = await create_room()
+    await create_messages(room, user, 5)
+
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    assert connected
+
+    # Newest page first, each page in chronological order
+    await communicator.send_json_to({"command": "history", "room": room.id, "limit": 2})
+    response = await communicator.receive_json_from()
+    assert response['history'] == room.id
+    assert [message['message'] for message in response['messages']] == ['3', '4']
+    assert response['before'] == response['messages'][0]['id']
+    assert isinstance(response['messages'][0]['created'], float)
+
+    await communicator.send_json_to({"command": "history", "room": room.id, "limit": 2, "before": response['before']})
+    response = await communicator.receive_json_from()
+    assert [message['message'] for message in response['messages']] == ['1', '2']
+
+    await communicator.send_json_to({"command": "history", "room": room.id, "limit": 2, "before": response['before']})
+    response = await communicator.receive_json_from()
+    assert [message['message'] for message in response['messages']] == ['0']
+    assert response['before'] is None
+
+    # Page sizes are capped
+    with override_settings(HISTORY_MAX_PAGE_SIZE=3):
+        await communicator.send_json_to({"command": "history", "room": room.id, "limit": 1000})
+        response = await communicator.receive_json_from()
+    assert [message['message'] for message in response['messages']] == ['2', '3', '4']
+
+    await communicator.send_json_to({"command": "history", "room": room.id, "limit": 'many'})
+    response = await communicator.receive_json_from()
+    assert response == {'error': 'HISTORY_INVALID'}
+
+    # Messages waiting to be saved are on top of the first page already, without waiting for them
+    await communicator.send_json_to({"command": "join", "room": room.id})
+    await communicator.receive_json_from()
+    await communicator.send_json_to({"command": "send", "room": room.id, "message": "5"})
+    await communicator.receive_json_from()
+    await communicator.send_json_to({"command": "history", "room": room.id, "limit": 2})
+    response = await communicator.receive_json_from()
+    assert [message['message'] for message in response['messages']] == ['3', '4', '5']
+    assert len(message_writer) == 1
+    await communicator.send_json_to({"command": "history", "room": room.id, "limit": 2, "before": response['before']})
+    response = await communicator.receive_json_from()
+    assert [message['message'] for message in response['messages']] == ['1', '2']
+
+    # Once saved they show up once
+    await message_writer.flush()
+    await communicator.send_json_to({"command": "history", "room": room.id, "limit": 2})
+    response = await communicator.receive_json_from()
+    assert [message['message'] for message in response['messages']] == ['4', '5']
+
+    await communicator.disconnect()
+    await tear_down()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_msgpack() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+    user_2: User = await create_user(email='amir@email.com', username='amir', name='Amir Savand')
+    room: Room = await create_room()
+
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/", subprotocols=['whisper.msgpack'])
+    communicator.scope['user'] = user
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    assert subprotocol == 'whisper.msgpack'
+
+    # JSON stays the default
+    communicator_2 = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator_2.scope['user'] = user_2
+    connected, subprotocol = await communicator_2.connect()
+    assert connected
+    assert subprotocol is None
+
+    await communicator.send_to(bytes_data=msgpack.packb({"command": "join", "room": room.id}, use_bin_type=True))
+    response = msgpack.unpackb(await communicator.receive_from(), raw=False)
+    assert response == {
+        'join': str(room.id), 'title': 'Savand Bros', 'seq': 0, 'resume_token': communicator.instance.resume_token,
+    }
+
+    await communicator_2.send_json_to({"command": "join", "room": room.id})
+    await communicator_2.receive_json_from()
+    response = msgpack.unpackb(await communicator.receive_from(), raw=False)
+    assert response == {'msg_type': settings.MSG_TYPE_ENTER, 'room': room.id, 'username': user_2.username}
+
+    # Both formats get the same message
+    await communicator.send_to(bytes_data=msgpack.packb(
+        {"command": "send", "room": room.id, "message": 'Hello Amir'}, use_bin_type=True,
+    ))
+    expected: dict = {
+        'msg_type': settings.MSG_TYPE_MESSAGE, 'room': room.id, 'username': user.username, 'message': 'Hello Amir',
+        'seq': 1,
+    }
+    assert msgpack.unpackb(await communicator.receive_from(), raw=False) == expected
+    assert await communicator_2.receive_json_from() == expected
+
+    await communicator.disconnect()
+    await communicator_2.disconnect()
+    await message_writer.flush()
+    await tear_down()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_join_and_leave_many() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand', is_staff=False)
+    staff_room: Room = await create_room()
+    room: Room = await database_sync_to_async(Room.objects.create)(title='Lobby')
+
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    assert connected
+
+    await communicator.send_json_to({"command": "join_many", "rooms": [room.id, staff_room.id, 5451, 'lobby']})
+    response = await communicator.receive_json_from()
+    assert response == {
+        'join_many': [{'join': str(room.id), 'title': 'Lobby', 'seq': 0}],
+        'errors': {str(staff_room.id): 'ROOM_ACCESS_DENIED', '5451': 'ROOM_INVALID', 'lobby': 'ROOM_INVALID'},
+        'resume_token': communicator.instance.resume_token,
+    }
+    assert communicator.instance.rooms == {room.id}
+
+    # They are in the group and in the presence of the room
+    await communicator.send_json_to({"command": "send", "room": room.id, 'message': 'Hello'})
+    response = await communicator.receive_json_from()
+    assert response['message'] == 'Hello'
+    await communicator.send_json_to({'command': 'room_users', 'room': room.id})
+    response = await communicator.receive_json_from()
+    assert response['data']['users'][str(user.id)]['left'] is False
+
+    await communicator.send_json_to({"command": "leave_many", "rooms": [room.id]})
+    response = await communicator.receive_json_from()
+    assert response == {'leave_many': [str(room.id)], 'errors': {}}
+    assert communicator.instance.rooms == set()
+    # Like with leave, the notice goes out while we are still in the group
+    response = await communicator.receive_json_from()
+    assert response == {'msg_type': settings.MSG_TYPE_LEAVE, 'room': room.id, 'username': user.username}
+
+    await communicator.send_json_to({'command': 'room_users', 'room': room.id})
+    response = await communicator.receive_json_from()
+    assert response['data']['users'][str(user.id)]['left'] is True
+
+    await communicator.send_json_to({"command": "join_many", "rooms": room.id})
+    response = await communicator.receive_json_from()
+    assert response == {'error': 'ROOMS_INVALID'}
+
+    await communicator.disconnect()
+    await message_writer.flush()
+    await tear_down()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_disconnect() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+    user_2: User = await create_user(email='amir@email.com', username='amir', name='Amir Savand')
+    room: Room = await create_room()
+    room_2: Room = await database_sync_to_async(Room.objects.create)(title='Lobby')
+
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    await communicator.connect()
+    await communicator.send_json_to({"command": "join_many", "rooms": [room.id, room_2.id]})
+    await communicator.receive_json_from()
+
+    communicator_2 = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator_2.scope['user'] = user_2
+    await communicator_2.connect()
+    await communicator_2.send_json_to({"command": "join", "room": room.id})
+    await communicator_2.receive_json_from()
+    await communicator.receive_json_from()
+
+    await communicator.disconnect()
+    # Nothing is written to the closed socket
+    assert await communicator.receive_nothing()
+
+    # The others are still told about it
+    response = await communicator_2.receive_json_from()
+    assert response == {'msg_type': settings.MSG_TYPE_LEAVE, 'room': room.id, 'username': user.username}
+
+    # And the user has left both rooms
+    for room_id in (room.id, room_2.id):
+        await communicator_2.send_json_to({'command': 'room_users', 'room': room_id})
+        response = await communicator_2.receive_json_from()
+        assert response['data']['users'][str(user.id)]['left'] is True
+
+    await communicator_2.disconnect()
+    await tear_down()
+
+
+async def receive_frames(communicator: WebsocketCommunicator, count: int) -> List[dict]:
+    """Receive ``count`` frames, unwrapping the ones that went out batched."""
+    frames: List[dict] = []
+    while len(frames) < count:
+        response: dict = await communicator.receive_json_from()
+        frames.extend(response['batch'] if 'batch' in response else [response])
+    return frames
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_presence_subscribe() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+    user_2: User = await create_user(email='amir@email.com', username='amir', name='Amir Savand')
+    room: Room = await create_room()
+
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    await communicator.connect()
+
+    # Only members of the room can follow its presence
+    await communicator.send_json_to({'command': 'presence_subscribe', 'room': room.id})
+    assert await communicator.receive_json_from() == {'error': 'ROOM_ACCESS_DENIED'}
+
+    await communicator.send_json_to({'command': 'join', 'room': room.id})
+    await communicator.receive_json_from()
+    await communicator.send_json_to({'command': 'presence_subscribe', 'room': room.id})
+    response = await communicator.receive_json_from()
+    assert response['data']['version'] == 1
+    assert list(response['data']['users']) == [str(user.id)]
+
+    communicator_2 = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator_2.scope['user'] = user_2
+    await communicator_2.connect()
+    await communicator_2.send_json_to({'command': 'join', 'room': room.id})
+    await communicator_2.receive_json_from()
+
+    # The join notice and the presence delta, only the latter carries the new state
+    enter, delta = await receive_frames(communicator, 2)
+    assert enter == {'msg_type': settings.MSG_TYPE_ENTER, 'room': room.id, 'username': user_2.username}
+    assert delta == {
+        'presence_delta': room.id,
+        'version': 2,
+        'user': user_2.id,
+        'change': 'joined',
+        'data': {
+            'name': 'Amir Savand',
+            'username': 'amir',
+            'left': False,
+            'last_update': delta['data']['last_update'],
+        },
+    }
+    # Non subscribers only get the notice
+    assert await communicator_2.receive_nothing()
+
+    # Catching up from a version only sends what changed since
+    await communicator_2.send_json_to({'command': 'room_users', 'room': room.id, 'since_version': 1})
+    response = await communicator_2.receive_json_from()
+    assert response == {
+        'data': {'version': 2, 'changes': [{key: value for key, value in delta.items() if key != 'presence_delta'}]},
+        'type': settings.MSG_TYPE_INTERNAL, 'room': room.id,
+    }
+    await communicator_2.send_json_to({'command': 'room_users', 'room': room.id, 'since_version': 'latest'})
+    assert await communicator_2.receive_json_from() == {'error': 'PRESENCE_VERSION_INVALID'}
+
+    await communicator_2.send_json_to({'command': 'leave', 'room': room.id})
+    await communicator_2.receive_json_from()
+    leave, delta = await receive_frames(communicator, 2)
+    assert leave == {'msg_type': settings.MSG_TYPE_LEAVE, 'room': room.id, 'username': user_2.username}
+    assert delta == {'presence_delta': room.id, 'version': 3, 'user': user_2.id, 'change': 'left'}
+
+    # Unsubscribed, only the notices keep coming
+    await communicator.send_json_to({'command': 'presence_unsubscribe', 'room': room.id})
+    await communicator_2.send_json_to({'command': 'join', 'room': room.id})
+    await communicator_2.receive_json_from()
+    response = await communicator.receive_json_from()
+    assert response == {'msg_type': settings.MSG_TYPE_ENTER, 'room': room.id, 'username': user_2.username}
+    assert await communicator.receive_nothing()
+
+    await communicator.disconnect()
+    await communicator_2.disconnect()
+    await message_writer.flush()
+    await tear_down()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_presence_keepalive() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+    room: Room = await create_room()
+
+    with override_settings(ROOM_PRESENCE_KEEPALIVE_INTERVAL=0.1):
+        communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+        communicator.scope['user'] = user
+        await communicator.connect()
+        await communicator.send_json_to({'command': 'join', 'room': room.id})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'command': 'room_users', 'room': room.id})
+        response = await communicator.receive_json_from()
+        last_update: float = response['data']['users'][str(user.id)]['last_update']
+
+        # Silent users still refresh their presence, so it isn't swept
+        await asyncio.sleep(0.25)
+        await communicator.send_json_to({'command': 'room_users', 'room': room.id})
+        response = await communicator.receive_json_from()
+        assert response['data']['users'][str(user.id)]['last_update'] > last_update
+        # Refreshing isn't a change
+        assert response['data']['version'] == 1
+
+        await communicator.disconnect()
+    assert communicator.instance.presence_keepalive_task.cancelled()
+    await tear_down()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_rate_limit() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+    room: Room = await create_room()
+
+    with override_settings(CONNECTION_RATE_LIMIT=0, CONNECTION_RATE_LIMIT_BURST=3, RATE_LIMIT_CLOSE_AFTER=2):
+        communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+        communicator.scope['user'] = user
+        await communicator.connect()
+
+        rate_limited: int = rate_limit_stats['connection']
+        closed: int = rate_limit_stats['closed']
+        for _ in range(3):
+            await communicator.send_json_to({'command': 'room_users', 'room': room.id})
+            response = await communicator.receive_json_from()
+            assert 'data' in response
+
+        await communicator.send_json_to({'command': 'room_users', 'room': room.id})
+        assert await communicator.receive_json_from() == {'error': 'RATE_LIMITED'}
+        assert rate_limit_stats['connection'] == rate_limited + 1
+
+        # Keeps flooding, so the socket gets closed
+        await communicator.send_json_to({'command': 'room_users', 'room': room.id})
+        assert await communicator.receive_json_from() == {'error': 'RATE_LIMITED'}
+        assert await communicator.receive_output() == {'type': 'websocket.close', 'code': 1008}
+        assert rate_limit_stats['closed'] == closed + 1
+
+    await communicator.disconnect()
+    await tear_down()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_invalid_message() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+    room: Room = await create_room()
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    await communicator.connect()
+    communicator.instance.rooms.add(room.id)
+
+    for message in [None, 42, ['Hello'], {'text': 'Hello'}, 'Hello\x00']:
+        await communicator.send_json_to({"command": "send", "room": room.id, "message": message})
+        assert await communicator.receive_json_from() == {'error': 'MESSAGE_INVALID'}
+    with override_settings(MAX_MESSAGE_LENGTH=5):
+        await communicator.send_json_to({"command": "send", "room": room.id, "message": 'Hello!'})
+        assert await communicator.receive_json_from() == {'error': 'MESSAGE_TOO_LONG'}
+
+    # Nothing reached the writer
+    assert len(message_writer) == 0
+    await communicator.disconnect()
+    await tear_down()
+
+
+async def connect_for_outbox(user: User, count: int = 3) -> Tuple[WebsocketCommunicator, List[dict]]:
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    await communicator.connect()
+    events: List[dict] = [
+        await communicator.instance.encode_event('chat.message', {'message': i}) for i in range(count)
+    ]
+    return communicator, events
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_outbox() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+
+    # Events arriving within one loop tick go out as a single frame
+    communicator, events = await connect_for_outbox(user)
+    for event in events:
+        await communicator.instance.chat_message(event)
+    assert await communicator.receive_json_from() == {'batch': [{'message': 0}, {'message': 1}, {'message': 2}]}
+    await communicator.instance.chat_message(events[0])
+    assert await communicator.receive_json_from() == {'message': 0}
+    await communicator.disconnect()
+
+    with override_settings(OUTBOUND_QUEUE_SIZE=2, OUTBOUND_QUEUE_POLICY='drop_oldest'):
+        communicator, events = await connect_for_outbox(user)
+        for event in events:
+            await communicator.instance.chat_message(event)
+        assert await communicator.receive_json_from() == {'batch': [{'message': 1}, {'message': 2}]}
+        await communicator.disconnect()
+
+    with override_settings(OUTBOUND_QUEUE_SIZE=2, OUTBOUND_QUEUE_POLICY='coalesce', OUTBOUND_COALESCE=False):
+        communicator, events = await connect_for_outbox(user)
+        for event in events:
+            await communicator.instance.chat_message(event)
+        assert await communicator.receive_json_from() == {'batch': [{'message': 0}, {'message': 1}]}
+        assert await communicator.receive_json_from() == {'message': 2}
+        await communicator.disconnect()
+
+    # Coalescing only goes on up to OUTBOUND_QUEUE_MAX_FRAMES events
+    with override_settings(
+        OUTBOUND_QUEUE_SIZE=2, OUTBOUND_QUEUE_MAX_FRAMES=3, OUTBOUND_QUEUE_POLICY='coalesce', OUTBOUND_COALESCE=False,
+    ):
+        communicator, events = await connect_for_outbox(user, 4)
+        for event in events:
+            await communicator.instance.chat_message(event)
+        assert await communicator.receive_json_from() == {'error': 'SLOW_CONSUMER', 'resume': True}
+        assert await communicator.receive_output() == {'type': 'websocket.close', 'code': 1013}
+        assert communicator.instance.outbox_frames == 0
+        await communicator.disconnect()
+
+    # The queue is full once its oldest event waited too long, however short it is
+    with override_settings(OUTBOUND_QUEUE_MAX_DELAY=0, OUTBOUND_QUEUE_POLICY='drop_oldest'):
+        communicator, events = await connect_for_outbox(user)
+        for event in events:
+            await communicator.instance.chat_message(event)
+        assert await communicator.receive_json_from() == {'message': 2}
+        await communicator.disconnect()
+
+    with override_settings(OUTBOUND_QUEUE_MAX_DELAY=0, OUTBOUND_QUEUE_POLICY='coalesce'):
+        communicator, events = await connect_for_outbox(user, 2)
+        for event in events:
+            await communicator.instance.chat_message(event)
+        assert await communicator.receive_json_from() == {'error': 'SLOW_CONSUMER', 'resume': True}
+        await communicator.disconnect()
+
+    with override_settings(OUTBOUND_QUEUE_SIZE=2, OUTBOUND_QUEUE_POLICY='disconnect'):
+        communicator, events = await connect_for_outbox(user)
+        for event in events:
+            await communicator.instance.chat_message(event)
+        assert await communicator.receive_json_from() == {'error': 'SLOW_CONSUMER', 'resume': True}
+        assert await communicator.receive_output() == {'type': 'websocket.close', 'code': 1013}
+        await communicator.disconnect()
+
+    await tear_down()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_ack_window() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+
+    with override_settings(OUTBOUND_ACK_WINDOW=2, OUTBOUND_QUEUE_SIZE=2, OUTBOUND_QUEUE_POLICY='disconnect'):
+        communicator, events = await connect_for_outbox(user, 7)
+        # Nothing was sent yet
+        await communicator.send_json_to({'command': 'ack', 'frames': 1})
+        assert await communicator.receive_json_from() == {'error': 'ACK_INVALID'}
+        await communicator.send_json_to({'command': 'ack', 'frames': 0})
+        assert await communicator.receive_nothing()
+
+        # The error and this one fill the window, the next one waits for an ack
+        await communicator.instance.chat_message(events[0])
+        assert await communicator.receive_json_from() == {'message': 0}
+        await communicator.instance.chat_message(events[1])
+        assert await communicator.receive_nothing()
+        await communicator.send_json_to({'command': 'ack', 'frames': 2})
+        assert await communicator.receive_json_from() == {'message': 1}
+
+        await communicator.instance.chat_message(events[2])
+        assert await communicator.receive_json_from() == {'message': 2}
+
+        # Not acknowledging anymore, events pile up in the outbox however long it's given until the policy kicks in
+        for event in events[3:]:
+            await communicator.instance.chat_message(event)
+            await asyncio.sleep(0.01)
+        assert await communicator.receive_json_from() == {'error': 'SLOW_CONSUMER', 'resume': True}
+        assert await communicator.receive_output() == {'type': 'websocket.close', 'code': 1013}
+        await communicator.disconnect()
+
+    await tear_down()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_resume() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+    user_2: User = await create_user(email='amir@email.com', username='amir', name='Amir Savand')
+    room: Room = await create_room()
+    room_2: Room = await database_sync_to_async(Room.objects.create)(title='Lobby')
+
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    await communicator.connect()
+    await communicator.send_json_to({"command": "join_many", "rooms": [room.id, room_2.id]})
+    token: str = (await communicator.receive_json_from())['resume_token']
+    await communicator.send_json_to({"command": "send", "room": room.id, 'message': 'Hello'})
+    assert (await communicator.receive_json_from())['seq'] == 1
+
+    communicator_2 = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator_2.scope['user'] = user_2
+    await communicator_2.connect()
+    await communicator_2.send_json_to({"command": "join", "room": room.id})
+    await communicator_2.receive_json_from()
+
+    # Amir keeps talking while Alireza is gone
+    await communicator.disconnect()
+    for message in ('Are you there?', 'Alireza?'):
+        await communicator_2.send_json_to({"command": "send", "room": room.id, 'message': message})
+    # Alireza's leave notice and the messages
+    await receive_frames(communicator_2, 3)
+
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    await communicator.connect()
+    await communicator.send_json_to({"command": "resume", "token": token, "rooms": {str(room.id): 1}})
+    frames: List[dict] = await receive_frames(communicator, 3)
+    assert [(frame['seq'], frame['message']) for frame in frames[:2]] == [(2, 'Are you there?'), (3, 'Alireza?')]
+    assert frames[2] == {
+        'resume': [
+            {'join': str(room.id), 'title': 'Savand Bros', 'seq': 3, 'reset': False},
+            # Nothing was asked for in it, so the client has to reload it
+            {'join': str(room_2.id), 'title': 'Lobby', 'seq': 0, 'reset': True},
+        ],
+        'errors': {},
+        'resume_token': communicator.instance.resume_token,
+    }
+    assert communicator.instance.rooms == {room.id, room_2.id}
+
+    # Back in the group
+    await communicator_2.send_json_to({"command": "send", "room": room.id, 'message': 'Welcome back'})
+    assert (await communicator.receive_json_from())['seq'] == 4
+
+    # Tokens are used once
+    await communicator.send_json_to({"command": "resume", "token": token, "rooms": {}})
+    assert await communicator.receive_json_from() == {'error': 'RESUME_EXPIRED'}
+    await communicator.send_json_to({"command": "resume", "token": token, "rooms": {str(room.id): 'last'}})
+    assert await communicator.receive_json_from() == {'error': 'RESUME_INVALID'}
+
+    await communicator.disconnect()
+    await communicator_2.disconnect()
+    await message_writer.flush()
+    await tear_down()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_chat_consumer_numbering_outlives_events() -> None:
+    user: User = await create_user(email='ali@email.com', username='alireza', name='Alireza Savand')
+    room: Room = await create_room()
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    await communicator.connect()
+    await communicator.send_json_to({"command": "join", "room": room.id})
+    token: str = (await communicator.receive_json_from())['resume_token']
+    for message in ('Hello', 'Anyone?'):
+        await communicator.send_json_to({"command": "send", "room": room.id, 'message': message})
+    assert [frame['seq'] for frame in await receive_frames(communicator, 2)] == [1, 2]
+
+    # The room goes quiet for longer than ROOM_REPLAY_TIMEOUT while the client stays connected
+    get_replay_backend()._rooms[room.id].expires_at = 0
+    await communicator.send_json_to({"command": "send", "room": room.id, 'message': 'Hello again'})
+    # Numbered after what the client saw, so it isn't skipped as already seen
+    assert (await communicator.receive_json_from())['seq'] == 3
+    await communicator.disconnect()
+
+    communicator = WebsocketCommunicator(ChatConsumer, "/testws/")
+    communicator.scope['user'] = user
+    await communicator.connect()
+    await communicator.send_json_to({"command": "resume", "token": token, "rooms": {str(room.id): 3}})
+    assert (await communicator.receive_json_from())['resume'] == [
+        {'join': str(room.id), 'title': 'Savand Bros', 'seq': 3, 'reset': False},
+    ]
+
+    await communicator.disconnect()
+    await message_writer.flush()
+    await tear_down()
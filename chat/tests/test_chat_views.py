@@ -1,13 +1,22 @@
-from django.http import HttpResponseRedirect, HttpResponse
-from django.test import TestCase
+from typing import List, Optional, Tuple
+
+from django.core.cache import cache
+from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from django.urls import reverse
 
 from chat.models import Room
+from chat.room_list import invalidate_room_list
 from users.models import User
 
 
 class TestChatViews(TestCase):
     """Unit testing Chat Views."""
+    def setUp(self) -> None:
+        # Rooms are only invalidated on commit, which never comes in a TestCase
+        cache.clear()
+
     @staticmethod
     def create_user() -> User:
         user: User = User.objects.filter(username='alireza').first()
@@ -42,10 +51,100 @@ class TestChatViews(TestCase):
         resp: HttpResponse = self.client.get(reverse('chat:index'))
 
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(resp.context['rooms'].count(), Room.objects.order_by("title").count())
-        print(resp.context['rooms_js'])
+        # Staff only rooms are only listed for staff users
+        self.assertEqual(
+            resp.context['rooms_js'],
+            '[{"id": 2, "title": "second room", "staff_only": false, "group_name": "room-2"}]'
+        )
+        self.assertIsNone(resp.context['rooms_next'])
+
+        User.objects.filter(username='alireza').update(is_staff=True)
+        resp = self.client.get(reverse('chat:index'))
         self.assertEqual(
             resp.context['rooms_js'],
             '[{"id": 1, "title": "my room", "staff_only": true, "group_name": "room-1"}, '
             '{"id": 2, "title": "second room", "staff_only": false, "group_name": "room-2"}]'
         )
+
+    def test_not_modified(self) -> None:
+        self.create_user()
+        self.login_user()
+
+        resp: HttpResponse = self.client.get(reverse('chat:index'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('private', resp['Cache-Control'])
+        etag: str = resp['ETag']
+
+        resp = self.client.get(reverse('chat:index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertNotIn('Last-Modified', resp)
+
+        # Someone else gets their own page, even when a date is all their browser sends
+        User.objects.create_user(email='amir@email.com', username='amir', password='somepassword')
+        self.client.login(username='amir', password='somepassword')
+        resp = self.client.get(reverse('chat:index'), HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(reverse('chat:index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp['ETag']
+
+        # And so does everyone once the rooms changed
+        invalidate_room_list()
+        resp = self.client.get(reverse('chat:index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+    @override_settings(ROOM_DIRECTORY_PAGE_SIZE=2, ROOM_DIRECTORY_MAX_PAGE_SIZE=3)
+    def test_rooms(self) -> None:
+        self.create_user()
+        self.login_user()
+        Room.objects.filter().delete()
+        for title in ('Bravo', 'Alpha', 'Charlie', 'Bravo', 'Delta'):
+            Room.objects.create(title=title)
+        Room.objects.create(title='Staff', staff_only=True)
+
+        def get_titles(**params) -> Tuple[List[str], Optional[str]]:
+            resp: JsonResponse = self.client.get(reverse('chat:rooms'), params)
+            self.assertEqual(resp.status_code, 200)
+            return [room['title'] for room in resp.json()['rooms']], resp.json()['next']
+
+        # Keyset pages, the same title twice doesn't throw them off
+        titles, after = get_titles()
+        self.assertEqual(titles, ['Alpha', 'Bravo'])
+        titles, after = get_titles(after=after)
+        self.assertEqual(titles, ['Bravo', 'Charlie'])
+        self.assertEqual(get_titles(after=after), (['Delta'], None))
+
+        self.assertEqual(get_titles(limit=10), (['Alpha', 'Bravo', 'Bravo'], get_titles(limit=3)[1]))
+        self.assertEqual(get_titles(q='rAV'), (['Bravo', 'Bravo'], None))
+        self.assertEqual(get_titles(q='staff'), ([], None))
+        self.assertEqual(self.client.get(reverse('chat:rooms'), {'after': 'nope'}).json(), {'error': 'CURSOR_INVALID'})
+        self.assertEqual(self.client.get(reverse('chat:rooms'), {'limit': 0}).status_code, 400)
+
+        User.objects.filter(username='alireza').update(is_staff=True)
+        self.assertEqual(get_titles(q='staff'), (['Staff'], None))
+
+        resp: JsonResponse = self.client.get(reverse('chat:rooms'))
+        self.assertEqual(self.client.get(reverse('chat:rooms'), HTTP_IF_NONE_MATCH=resp['ETag']).status_code, 304)
+
+
+class TestRoomListInvalidation(TransactionTestCase):
+    """The rooms changes are committed here, so the signals do invalidate the room list."""
+
+    def test_room_changes(self) -> None:
+        User.objects.create_user(email='ali@email.com', username='alireza', password='somepassword')
+        self.client.login(username='alireza', password='somepassword')
+        room: Room = Room.objects.create(title='my room')
+
+        resp: HttpResponse = self.client.get(reverse('chat:index'))
+        self.assertIn('"my room"', resp.context['rooms_js'])
+
+        room.title = 'renamed room'
+        room.save()
+        resp = self.client.get(reverse('chat:index'), HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('"renamed room"', resp.context['rooms_js'])
+
+        room.delete()
+        resp = self.client.get(reverse('chat:index'))
+        self.assertNotIn('"renamed room"', resp.context['rooms_js'])
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from django.db import connection
+from django.test.utils import override_settings
+
+from chat import db
+from chat.db import DatabaseExecutor, database_sync_to_async
+from chat.exceptions import ClientError
+
+
+@pytest.fixture
+def executor(monkeypatch) -> DatabaseExecutor:
+    executor = DatabaseExecutor()
+    monkeypatch.setattr(db, 'db_executor', executor)
+    yield executor
+    executor.executor.shutdown()
+
+
+@database_sync_to_async
+def wait(event: threading.Event) -> str:
+    event.wait(5)
+    return threading.current_thread().name
+
+
+@database_sync_to_async(fail_fast=False)
+def wait_patiently(event: threading.Event) -> str:
+    event.wait(5)
+    return threading.current_thread().name
+
+
+@pytest.mark.asyncio
+async def test_server_busy(executor: DatabaseExecutor) -> None:
+    event = threading.Event()
+    with override_settings(DB_EXECUTOR_WORKERS=2, DB_EXECUTOR_QUEUE_SIZE=2):
+        # Two running, two waiting for a thread
+        calls = [asyncio.ensure_future(wait(event)) for _ in range(4)]
+        await asyncio.sleep(0.1)
+        assert executor.queued == 2
+
+        with pytest.raises(ClientError) as error:
+            await wait(event)
+        assert error.value.code == 'SERVER_BUSY'
+        # Unless they can't be refused
+        patient = asyncio.ensure_future(wait_patiently(event))
+        await asyncio.sleep(0.1)
+        assert executor.queued == 3
+
+    event.set()
+    names = await asyncio.gather(*calls, patient)
+    assert all(name.startswith('whisper-db') for name in names)
+    assert len(set(names)) == 2
+    assert executor.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_calls_leave_the_queue(executor: DatabaseExecutor) -> None:
+    event = threading.Event()
+    with override_settings(DB_EXECUTOR_WORKERS=1, DB_EXECUTOR_QUEUE_SIZE=1):
+        running = asyncio.ensure_future(wait(event))
+        waiting = asyncio.ensure_future(wait(event))
+        await asyncio.sleep(0.1)
+        assert executor.queued == 1
+
+        waiting.cancel()
+        await asyncio.sleep(0.1)
+        assert executor.queued == 0
+    event.set()
+    await running
+
+
+@pytest.mark.django_db
+@override_settings(DB_HEALTH_CHECK_INTERVAL=30)
+def test_health_check(monkeypatch) -> None:
+    executor = DatabaseExecutor()
+    connection.ensure_connection()
+    closed = []
+    monkeypatch.setattr(connection, 'is_usable', lambda: False)
+    # The in-memory test database ignores closing anyway
+    monkeypatch.setattr(connection, 'close', lambda: closed.append(connection.alias))
+
+    # Used a moment ago, it's trusted
+    executor._local.last_used = time.monotonic() - 10
+    executor.check_connections()
+    assert closed == []
+
+    # Idle for a while, the database may have dropped it
+    executor._local.last_used = time.monotonic() - 60
+    executor.check_connections()
+    assert closed == ['default']
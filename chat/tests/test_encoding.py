@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from chat import encoding
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def json_backend(request, monkeypatch) -> None:
+    if request.param == 'json':
+        monkeypatch.setattr(encoding, 'orjson', None)
+    elif encoding.orjson is None:
+        pytest.skip('orjson is not installed')
+
+
+def test_dumps_and_loads(json_backend) -> None:
+    content: dict = {
+        'msg_type': 0,
+        'room': 1,
+        'username': 'alireza',
+        'message': 'Salam 👋',
+        'data': {'users': {1: {'left': False, 'last_update': 1527000000.123456}}},
+    }
+
+    text: str = encoding.dumps(content)
+
+    assert isinstance(text, str)
+    # User ids come back as strings, like with any JSON round trip
+    assert json.loads(text) == encoding.loads(text) == json.loads(json.dumps(content))
@@ -0,0 +1,214 @@
+import asyncio
+import time
+
+import pytest
+import redis
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+from chat.layers import HybridChannelLayer
+
+HOSTS = [('localhost', 6379)]
+
+
+@pytest.fixture(params=[RedisChannelLayer, HybridChannelLayer])
+async def channel_layer(request):
+    """The same conformance tests run against channels_redis, which the layer has to behave like."""
+    layer = request.param(hosts=HOSTS, capacity=3, channel_capacity={'tiny': 1}, prefix='test-layers')
+    yield layer
+    await layer.flush()
+
+
+@pytest.fixture
+async def workers():
+    """Two processes, each with its own layer."""
+    layers = [HybridChannelLayer(hosts=HOSTS, prefix='test-layers') for _ in range(2)]
+    yield layers
+    for layer in layers:
+        await layer.flush()
+
+
+def in_thread(func, *args):
+    """Run the layer method in a thread, on an event loop of its own."""
+    return asyncio.get_event_loop().run_in_executor(None, lambda: async_to_sync(func)(*args))
+
+
+async def receive(layer, channel: str, timeout: float = 1) -> dict:
+    return await asyncio.wait_for(layer.receive(channel), timeout)
+
+
+async def assert_nothing_received(layer, channel: str) -> None:
+    with pytest.raises(asyncio.TimeoutError):
+        await receive(layer, channel, 0.2)
+
+
+def group_size(layer, group: str) -> int:
+    """How many channels are grouped through Redis."""
+    return redis.StrictRedis().zcard(layer._group_key(group))
+
+
+@pytest.mark.asyncio
+async def test_send_receive(channel_layer) -> None:
+    await channel_layer.send('test-channel-1', {'type': 'test.message', 'text': 'Ahoy-hoy!'})
+    assert await receive(channel_layer, 'test-channel-1') == {'type': 'test.message', 'text': 'Ahoy-hoy!'}
+
+
+@pytest.mark.asyncio
+async def test_send_capacity(channel_layer) -> None:
+    for _ in range(3):
+        await channel_layer.send('test-channel-1', {'type': 'test.message'})
+    with pytest.raises(ChannelFull):
+        await channel_layer.send('test-channel-1', {'type': 'test.message'})
+
+    await channel_layer.send('tiny', {'type': 'test.message'})
+    with pytest.raises(ChannelFull):
+        await channel_layer.send('tiny', {'type': 'test.message'})
+
+
+@pytest.mark.asyncio
+async def test_process_local_send_receive(channel_layer) -> None:
+    channel: str = await channel_layer.new_channel()
+    channel_2: str = await channel_layer.new_channel()
+    for i in range(2):
+        await channel_layer.send(channel, {'type': 'test.message', 'number': i})
+    await channel_layer.send(channel_2, {'type': 'test.message', 'number': 2})
+
+    assert [(await receive(channel_layer, channel))['number'] for _ in range(2)] == [0, 1]
+    assert (await receive(channel_layer, channel_2))['number'] == 2
+
+
+@pytest.mark.asyncio
+async def test_reject_bad_channel(channel_layer) -> None:
+    with pytest.raises(TypeError):
+        await channel_layer.send('=+135!', {'type': 'foom'})
+    with pytest.raises(AssertionError):
+        await channel_layer.receive('specific.wrongprefix!channel')
+
+
+@pytest.mark.asyncio
+async def test_receive_cancel(channel_layer) -> None:
+    channel: str = await channel_layer.new_channel()
+    for _ in range(3):
+        # Cancelled while waiting, then a message arrives
+        with pytest.raises(asyncio.TimeoutError):
+            await receive(channel_layer, channel, 0.05)
+        await channel_layer.send(channel, {'type': 'test.message'})
+        assert await receive(channel_layer, channel) == {'type': 'test.message'}
+
+
+@pytest.mark.asyncio
+async def test_groups_basic(channel_layer) -> None:
+    channels = [await channel_layer.new_channel() for _ in range(3)]
+    for channel in channels:
+        await channel_layer.group_add('test-group', channel)
+    await channel_layer.group_discard('test-group', channels[1])
+    # Discarding what isn't in the group does nothing
+    await channel_layer.group_discard('test-group', 'test-channel-1')
+    await channel_layer.group_send('test-group', {'type': 'message.1'})
+
+    assert await receive(channel_layer, channels[0]) == {'type': 'message.1'}
+    assert await receive(channel_layer, channels[2]) == {'type': 'message.1'}
+    await assert_nothing_received(channel_layer, channels[1])
+
+
+@pytest.mark.asyncio
+async def test_groups_channel_full(channel_layer) -> None:
+    channel: str = await channel_layer.new_channel()
+    await channel_layer.group_add('test-group', channel)
+    # Group sends skip full channels rather than raising
+    for i in range(5):
+        await channel_layer.group_send('test-group', {'type': 'message', 'number': i})
+
+    assert [(await receive(channel_layer, channel))['number'] for _ in range(3)] == [0, 1, 2]
+    await assert_nothing_received(channel_layer, channel)
+
+
+@pytest.mark.asyncio
+async def test_group_expiry(channel_layer, monkeypatch) -> None:
+    channel: str = await channel_layer.new_channel()
+    await channel_layer.group_add('test-group', channel)
+
+    later: float = time.time() + channel_layer.group_expiry + 1
+    with monkeypatch.context() as patch:
+        patch.setattr(time, 'time', lambda: later)
+        await channel_layer.group_send('test-group', {'type': 'message'})
+    await assert_nothing_received(channel_layer, channel)
+
+
+@pytest.mark.asyncio
+async def test_fan_out(workers) -> None:
+    layer, layer_2 = workers
+    channels = [await layer.new_channel() for _ in range(2)]
+    channel_2: str = await layer_2.new_channel()
+    for channel in channels:
+        await layer.group_add('test-group', channel)
+    await layer_2.group_add('test-group', channel_2)
+    # Nothing is grouped through Redis
+    assert group_size(layer, 'test-group') == 0
+
+    await layer.group_send('test-group', {'type': 'message.1'})
+    await layer_2.group_send('test-group', {'type': 'message.2'})
+    # Like with RedisChannelLayer, what different workers send isn't ordered
+    for channel in channels:
+        assert {(await receive(layer, channel))['type'] for _ in range(2)} == {'message.1', 'message.2'}
+    assert {(await receive(layer_2, channel_2))['type'] for _ in range(2)} == {'message.1', 'message.2'}
+    # Each member got it once
+    await assert_nothing_received(layer_2, channel_2)
+
+    # Once the last member left, the worker stops listening to the group
+    await layer_2.group_discard('test-group', channel_2)
+    assert layer_2.subscribers[layer_2.consistent_hash('test-group')].names == set()
+    await layer.group_send('test-group', {'type': 'message.3'})
+    assert (await receive(layer, channels[0]))['type'] == 'message.3'
+    await assert_nothing_received(layer_2, channel_2)
+
+
+@pytest.mark.asyncio
+async def test_fan_out_from_other_event_loops(workers) -> None:
+    layer, layer_2 = workers
+    channel: str = await layer.new_channel()
+    channel_2: str = await layer.new_channel()
+    await layer.group_add('test-group', channel)
+
+    # Sent from a thread, e.g. by a signal, local members still get it
+    await in_thread(layer.group_send, 'test-group', {'type': 'message.1'})
+    assert await receive(layer, channel) == {'type': 'message.1'}
+
+    # Added from a thread, the channel is grouped through Redis instead
+    await in_thread(layer.group_add, 'test-group', channel_2)
+    assert group_size(layer, 'test-group') == 1
+    await layer_2.group_send('test-group', {'type': 'message.2'})
+    assert await receive(layer, channel) == {'type': 'message.2'}
+    assert await receive(layer, channel_2) == {'type': 'message.2'}
+
+    await layer.group_discard('test-group', channel_2)
+    assert group_size(layer, 'test-group') == 0
+
+
+@pytest.mark.asyncio
+async def test_fan_out_to_plain_redis_layers(workers) -> None:
+    layer, _ = workers
+    plain_layer = RedisChannelLayer(hosts=HOSTS, prefix='test-layers')
+    channel: str = await layer.new_channel()
+    plain_channel: str = await plain_layer.new_channel()
+    await layer.group_add('test-group', channel)
+    await plain_layer.group_add('test-group', plain_channel)
+
+    await layer.group_send('test-group', {'type': 'message'})
+    assert await receive(layer, channel) == {'type': 'message'}
+    assert await receive(plain_layer, plain_channel) == {'type': 'message'}
+    await plain_layer.flush()
+
+
+@pytest.mark.asyncio
+async def test_group_sends_share_a_connection(workers) -> None:
+    layer, _ = workers
+    channel: str = await layer.new_channel()
+    await layer.group_add('test-group', channel)
+
+    await asyncio.gather(*(layer.group_send('test-group', {'type': 'message', 'number': i}) for i in range(10)))
+    # Pipelined on one connection, rather than one from the pool each
+    assert len(layer.publishers) == 1
+    assert not any(layer.pools[0].conn_map.values())
+    assert sorted([(await receive(layer, channel))['number'] for _ in range(10)]) == list(range(10))
@@ -0,0 +1,41 @@
+import json
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+
+from chat.loadtest import SCENARIOS, percentile
+
+
+def test_percentile() -> None:
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([1.0], 95) == 1
+    assert percentile([], 50) is None
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('scenario', sorted(SCENARIOS))
+def test_loadtest_command(scenario: str) -> None:
+    output = StringIO()
+    call_command(
+        'loadtest', scenario, clients=5, rooms=2, messages=3, senders=2, timeout=5, msgpack=scenario == 'hot_room',
+        stdout=output,
+    )
+    results: dict = json.loads(output.getvalue())
+
+    assert results['scenario'] == scenario
+    assert results['errors'] == 0
+    assert results['lost'] == 0
+    assert results['messages'] == {
+        'join_storm': 5,
+        # Every message of both senders reaches all the clients
+        'hot_room': 2 * 3 * 5,
+        'presence_polling': 5 * 3,
+    }[scenario]
+    assert results['msgs_per_second'] > 0
+    assert results['cpu_ms_per_message'] > 0
+    latency: dict = results['latency_ms']
+    assert 0 < latency['p50'] <= latency['p95'] <= latency['p99'] <= latency['max']
@@ -0,0 +1,124 @@
+import threading
+import time
+
+import pytest
+import redis
+from channels.testing import WebsocketCommunicator
+from django.test import Client
+from django.test.utils import override_settings
+
+from chat.consumers import COMMANDS_RECEIVED, OPEN_CONNECTIONS, ChatConsumer
+from chat.metrics import METRICS_KEY, Counter, Gauge, Histogram, SnapshotStore, render
+from users.models import User
+
+
+def test_metrics_add_up_threads() -> None:
+    counter = Counter('test_total', 'Test counter.', ['kind'], register=False)
+    gauge = Gauge('test_gauge', 'Test gauge.', register=False)
+
+    def work():
+        for _ in range(1000):
+            counter.labels('a').inc()
+            gauge.inc()
+        gauge.dec(500)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.labels('b').inc(2)
+
+    assert counter.samples() == {('a',): 4000, ('b',): 2}
+    assert gauge.samples() == {(): 2000}
+
+
+def test_render() -> None:
+    counter = Counter('test_total', 'Test counter.', ['kind'], register=False)
+    counter.labels('a"b').inc()
+    histogram = Histogram('test_seconds', 'Test histogram.', ['operation'], buckets=(0.1, 1), register=False)
+    histogram.labels('join').observe(0.05)
+    histogram.labels('join').observe(0.1)
+    histogram.labels('join').observe(0.5)
+    histogram.labels('join').observe(5)
+    snapshot = {'test_total': counter.describe(), 'test_seconds': histogram.describe()}
+
+    # Two processes with the same values
+    assert render([snapshot, snapshot]) == '\n'.join([
+        '# HELP test_seconds Test histogram.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{operation="join",le="0.1"} 4',
+        'test_seconds_bucket{operation="join",le="1"} 6',
+        'test_seconds_bucket{operation="join",le="+Inf"} 8',
+        'test_seconds_sum{operation="join"} 11.3',
+        'test_seconds_count{operation="join"} 8',
+        '# HELP test_total Test counter.',
+        '# TYPE test_total counter',
+        'test_total{kind="a\\"b"} 2',
+    ]) + '\n'
+
+
+@override_settings(METRICS_PUSH_INTERVAL=15)
+def test_snapshot_store(monkeypatch) -> None:
+    client = redis.StrictRedis()
+    client.delete(METRICS_KEY)
+    gauge = Gauge('test_gauge', 'Test gauge.', register=False)
+    gauge.inc(3)
+    snapshot = {'test_gauge': gauge.describe()}
+
+    first, second, gone = SnapshotStore(client), SnapshotStore(client), SnapshotStore(client)
+    first.process_id, second.process_id, gone.process_id = 'web:1', 'web:2', 'web:3'
+    first.publish(snapshot)
+    second.publish(snapshot)
+    now: float = time.time()
+    monkeypatch.setattr('chat.metrics.time.time', lambda: now - 60)
+    gone.publish(snapshot)
+    monkeypatch.undo()
+
+    # The second process serves the request with its live values, the third one is gone
+    snapshots = second.get_snapshots({'test_gauge': dict(gauge.describe(), samples=[[[], 1]])})
+    assert render(snapshots).splitlines()[-1] == 'test_gauge 4'
+    assert sorted(client.hkeys(METRICS_KEY)) == [b'web:1', b'web:2']
+    client.delete(METRICS_KEY)
+
+
+@pytest.mark.django_db
+def test_metrics_view() -> None:
+    # Without a token only staff get them
+    with override_settings(METRICS_TOKEN='', DEBUG=False):
+        assert Client().get('/metrics').status_code == 403
+        client = Client()
+        user: User = User.objects.create_user(email='ali@email.com', username='alireza', password='somepassword')
+        client.force_login(user)
+        assert client.get('/metrics').status_code == 403
+        user.is_staff = True
+        user.save()
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+        assert '# TYPE whisper_commands_total counter' in response.content.decode()
+
+    with override_settings(METRICS_TOKEN='', DEBUG=True):
+        assert Client().get('/metrics').status_code == 200
+
+    with override_settings(METRICS_TOKEN='secret'):
+        assert Client().get('/metrics').status_code == 403
+        assert Client().get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_consumer_metrics() -> None:
+    connections: float = OPEN_CONNECTIONS.samples().get((), 0)
+    commands: float = COMMANDS_RECEIVED.samples().get(('unknown',), 0)
+
+    communicator = WebsocketCommunicator(ChatConsumer, '/testws/')
+    communicator.scope['user'] = User(id=1, username='alireza')
+    await communicator.connect()
+    assert OPEN_CONNECTIONS.samples()[()] == connections + 1
+
+    await communicator.send_json_to({'command': 'dance'})
+    await communicator.receive_nothing()
+    assert COMMANDS_RECEIVED.samples()[('unknown',)] == commands + 1
+
+    await communicator.disconnect()
+    assert OPEN_CONNECTIONS.samples()[()] == connections
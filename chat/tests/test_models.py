@@ -0,0 +1,38 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from chat.models import Message, Room
+
+
+class TestMessagePage(TestCase):
+    """Unit testing keyset pagination of room messages."""
+    def setUp(self) -> None:
+        self.room: Room = Room.objects.create(title='Savand Bros')
+        other_room: Room = Room.objects.create(title='Other')
+        Message.objects.bulk_create(
+            Message(room=room, username='alireza', message=str(i))
+            for i in range(10)
+            for room in (self.room, other_room)
+        )
+        self.ids = list(self.room.messages.order_by('-id').values_list('id', flat=True))
+
+    def test_pages(self) -> None:
+        page = Message.objects.page(self.room.id, None, 4)
+        self.assertEqual([message['id'] for message in page], self.ids[:4])
+        self.assertEqual([message['message'] for message in page], ['9', '8', '7', '6'])
+
+        page = Message.objects.page(self.room.id, page[-1]['id'], 4)
+        self.assertEqual([message['id'] for message in page], self.ids[4:8])
+
+        page = Message.objects.page(self.room.id, page[-1]['id'], 4)
+        self.assertEqual([message['id'] for message in page], self.ids[8:])
+
+        self.assertEqual(Message.objects.page(self.room.id, page[-1]['id'], 4), [])
+
+    def test_pages_never_offset(self) -> None:
+        with CaptureQueriesContext(connection) as queries:
+            Message.objects.page(self.room.id, self.ids[5], 4)
+
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('OFFSET', queries[0]['sql'].upper())
@@ -0,0 +1,258 @@
+import asyncio
+import time
+from io import StringIO
+
+import pytest
+import redis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test.utils import override_settings
+
+from chat import presence
+from chat.encoding import loads
+from chat.management.commands.sweep_presence import SWEEP_LOCK_KEY
+from chat.models import get_room_group_name
+from chat.presence import BasePresenceBackend, LocMemPresenceBackend, RedisPresenceBackend, get_presence_backend
+from chat.tests.conftest import TEST_REDIS_URL
+
+
+# For the backend fixture, see conftest
+LOCMEM_BACKEND = LocMemPresenceBackend
+REDIS_BACKEND = RedisPresenceBackend
+
+
+def user_data(username: str, last_update: float) -> dict:
+    return {'username': username, 'name': username.title(), 'left': False, 'last_update': last_update}
+
+
+def test_update_and_get_users(backend: BasePresenceBackend) -> None:
+    assert backend.get_users(1) == {}
+
+    backend.update(1, 1, user_data('alireza', 1.5))
+    backend.update(1, 2, user_data('amir', 2.5))
+    backend.update(1, 1, user_data('alireza', 3.5))
+
+    assert backend.get_users(1) == {1: user_data('alireza', 3.5), 2: user_data('amir', 2.5)}
+    assert backend.get_users(2) == {}
+
+
+def test_mark_left(backend: BasePresenceBackend) -> None:
+    # Timestamps keep all their digits
+    backend.update(1, 1, user_data('alireza', 1527000000.123456))
+    # Names looking like the flag aren't touched
+    backend.update(1, 3, dict(user_data('amir', 1.5), name='"left": false'))
+    backend.mark_left(1, 1)
+    # Users that aren't in the room are left alone
+    backend.mark_left(1, 2)
+
+    assert backend.get_users(1) == {
+        1: dict(user_data('alireza', 1527000000.123456), left=True),
+        3: dict(user_data('amir', 1.5), name='"left": false'),
+    }
+    assert backend.mark_left_many([1], 3) == {1: {'version': 4, 'user': 3, 'change': 'left'}}
+    assert backend.get_users(1)[3] == dict(user_data('amir', 1.5), name='"left": false', left=True)
+    # Only once
+    assert backend.mark_left_many([1], 3) == {}
+
+
+def test_many_rooms(backend: BasePresenceBackend) -> None:
+    backend.update_many([1, 2], 1, user_data('alireza', 1.5))
+    backend.update(2, 2, user_data('amir', 2.5))
+
+    assert backend.get_users(1) == {1: user_data('alireza', 1.5)}
+    assert backend.get_users(2) == {1: user_data('alireza', 1.5), 2: user_data('amir', 2.5)}
+
+    backend.mark_left_many([1, 2], 1)
+
+    assert backend.get_users(1) == {1: dict(user_data('alireza', 1.5), left=True)}
+    assert backend.get_users(2) == {1: dict(user_data('alireza', 1.5), left=True), 2: user_data('amir', 2.5)}
+
+
+def test_discard(backend: BasePresenceBackend) -> None:
+    backend.update(1, 1, user_data('alireza', 1.5))
+    backend.update(1, 2, user_data('amir', 2.5))
+    backend.update(1, 3, user_data('sina', 3.5))
+
+    backend.discard(1, [1, 3])
+    backend.discard(1, [])
+
+    assert backend.get_users(1) == {2: user_data('amir', 2.5)}
+
+
+def test_redis_presence_expires(redis_client: redis.StrictRedis) -> None:
+    backend = RedisPresenceBackend(client=redis_client, address=TEST_REDIS_URL)
+    backend.update(1, 1, user_data('alireza', 1.5))
+
+    # The last key holds the deadlines of all the rooms, which the sweeper keeps short
+    for key in backend.get_keys(1)[:3]:
+        assert 0 < backend.client.ttl(key) <= settings.ROOM_PRESENCE_TIMEOUT
+
+
+def test_versions_and_changes(backend: BasePresenceBackend) -> None:
+    assert backend.get_snapshot(1) == (0, {})
+    assert backend.get_changes(1, 0) == (0, [])
+
+    assert backend.update(1, 1, user_data('alireza', 1.5)) == {
+        'version': 1, 'user': 1, 'change': 'joined', 'data': user_data('alireza', 1.5),
+    }
+    # Refreshing last_update isn't a change
+    assert backend.update(1, 1, user_data('alireza', 2.5)) is None
+    assert backend.update_many([1, 2], 2, user_data('amir', 3.5)) == {
+        1: {'version': 2, 'user': 2, 'change': 'joined', 'data': user_data('amir', 3.5)},
+        2: {'version': 1, 'user': 2, 'change': 'joined', 'data': user_data('amir', 3.5)},
+    }
+    assert backend.update(1, 2, dict(user_data('amir', 4.5), name='Amir Savand')) == {
+        'version': 3, 'user': 2, 'change': 'updated', 'data': dict(user_data('amir', 4.5), name='Amir Savand'),
+    }
+    assert backend.mark_left(1, 1) == {'version': 4, 'user': 1, 'change': 'left'}
+    # Already gone
+    assert backend.mark_left(1, 1) is None
+    assert backend.mark_left_many([1, 2], 3) == {}
+    # Coming back is joining again
+    assert backend.update(1, 1, user_data('alireza', 5.5))['change'] == 'joined'
+    assert backend.discard(1, [2, 3]) == [{'version': 6, 'user': 2, 'change': 'removed'}]
+
+    version, users = backend.get_snapshot(1)
+    assert version == 6
+    assert users == {1: user_data('alireza', 5.5)}
+
+    version, changes = backend.get_changes(1, 3)
+    assert version == 6
+    assert [(change['version'], change['user'], change['change']) for change in changes] == [
+        (4, 1, 'left'), (5, 1, 'joined'), (6, 2, 'removed'),
+    ]
+    assert backend.get_changes(1, 6) == (6, [])
+    # From the future, the presence must have expired in between
+    assert backend.get_changes(1, 7) is None
+
+
+@override_settings(ROOM_PRESENCE_LOG_SIZE=2)
+def test_changes_forgotten(backend: BasePresenceBackend) -> None:
+    for user_id in range(1, 5):
+        backend.update(1, user_id, user_data(str(user_id), 1.5))
+
+    assert [change['version'] for change in backend.get_changes(1, 2)[1]] == [3, 4]
+    assert backend.get_changes(1, 1) is None
+
+
+@override_settings(ROOM_PRESENCE_IDLE_TIMEOUT=60, ROOM_PRESENCE_LEFT_TIMEOUT=10)
+def test_sweep(backend: BasePresenceBackend, monkeypatch) -> None:
+    now: float = time.time()
+    monkeypatch.setattr('chat.presence.time.time', lambda: now)
+    backend.update_many([1, 2], 1, user_data('alireza', 1.5))
+    backend.update(1, 2, user_data('amir', 1.5))
+    backend.update(1, 3, user_data('sina', 1.5))
+    backend.mark_left(1, 2)
+    backend.discard(1, [3])
+    assert backend.sweep(100) == {}
+
+    # Left users go first
+    monkeypatch.setattr('chat.presence.time.time', lambda: now + 30)
+    backend.update(2, 1, user_data('alireza', 2.5))
+    assert backend.sweep(100) == {1: [{'version': 6, 'user': 2, 'change': 'removed'}]}
+
+    # Then the ones who weren't heard from, the heartbeat kept alireza in the second room
+    monkeypatch.setattr('chat.presence.time.time', lambda: now + 70)
+    assert backend.sweep(100) == {1: [{'version': 7, 'user': 1, 'change': 'removed'}]}
+    assert backend.get_users(1) == {}
+    assert backend.get_users(2) == {1: user_data('alireza', 2.5)}
+
+    monkeypatch.setattr('chat.presence.time.time', lambda: now + 100)
+    assert backend.sweep(100) == {2: [{'version': 2, 'user': 1, 'change': 'removed'}]}
+    assert backend.sweep(100) == {}
+
+
+@override_settings(ROOM_PRESENCE_IDLE_TIMEOUT=0)
+def test_sweep_limit(backend: BasePresenceBackend) -> None:
+    for user_id in range(1, 6):
+        backend.update(1, user_id, user_data(str(user_id), 1.5))
+
+    assert len(backend.sweep(3)[1]) == 3
+    assert len(backend.sweep(3)[1]) == 2
+    assert backend.get_users(1) == {}
+
+
+@pytest.mark.asyncio
+async def test_async_api(backend: BasePresenceBackend, monkeypatch) -> None:
+    """What the consumers use, the same presence as the blocking methods."""
+    now: float = time.time()
+    monkeypatch.setattr('chat.presence.time.time', lambda: now)
+    assert await backend.update_many_async([1, 2], 1, user_data('alireza', 1.5)) == {
+        1: {'version': 1, 'user': 1, 'change': 'joined', 'data': user_data('alireza', 1.5)},
+        2: {'version': 1, 'user': 1, 'change': 'joined', 'data': user_data('alireza', 1.5)},
+    }
+    backend.update(1, 2, user_data('amir', 1527000000.123456))
+    with override_settings(ROOM_PRESENCE_LEFT_TIMEOUT=10):
+        assert await backend.mark_left_many_async([1, 2], 2) == {1: {'version': 3, 'user': 2, 'change': 'left'}}
+
+    assert await backend.get_snapshot_async(1) == (3, {
+        1: user_data('alireza', 1.5), 2: dict(user_data('amir', 1527000000.123456), left=True),
+    })
+    assert await backend.get_snapshot_async(3) == (0, {})
+    version, changes = await backend.get_changes_async(1, 1)
+    assert version == 3
+    assert [(change['version'], change['user'], change['change']) for change in changes] == [
+        (2, 2, 'joined'), (3, 2, 'left'),
+    ]
+    assert await backend.get_changes_async(1, 4) is None
+
+    monkeypatch.setattr('chat.presence.time.time', lambda: now + 30)
+    assert await backend.sweep_async(100) == {1: [{'version': 4, 'user': 2, 'change': 'removed'}]}
+    assert backend.get_users(1) == {1: user_data('alireza', 1.5)}
+
+
+def test_async_pool_per_loop(redis_client: redis.StrictRedis) -> None:
+    backend = RedisPresenceBackend(client=redis_client, address=TEST_REDIS_URL)
+    # Redis doesn't know the scripts yet, they are sent whole
+    backend.client.script_flush()
+    loop = asyncio.new_event_loop()
+
+    async def join(user_id: int) -> dict:
+        return await backend.update_many_async([1], user_id, user_data(str(user_id), 1.5))
+
+    # Shared by everything running on the loop
+    changes = loop.run_until_complete(asyncio.gather(*(join(user_id) for user_id in range(1, 11)), loop=loop))
+    assert sorted(change[1]['version'] for change in changes) == list(range(1, 11))
+    assert list(backend.async_redis.pools) == [loop]
+    pool = backend.async_redis.pools[loop].result().connection
+    assert pool.size == 1
+
+    # And closed along with it
+    loop.close()
+    assert backend.async_redis.pools == {}
+    assert pool.closed
+
+
+@pytest.mark.django_db
+@override_settings(ROOM_PRESENCE_IDLE_TIMEOUT=0)
+def test_sweep_presence_command(monkeypatch) -> None:
+    # Sweeping goes through every room, start from an empty presence rather than what other tests left
+    monkeypatch.setattr(presence, '_backend', LocMemPresenceBackend())
+    room_id: int = 1000001
+    channel_layer = get_channel_layer()
+    channel: str = async_to_sync(channel_layer.new_channel)()
+    async_to_sync(channel_layer.group_add)(get_room_group_name(room_id), channel)
+    cache.delete(SWEEP_LOCK_KEY)
+    get_presence_backend().update(room_id, 1, user_data('alireza', 1.5))
+
+    output = StringIO()
+    call_command('sweep_presence', stdout=output)
+    assert output.getvalue() == 'Swept 1 users from the room presence\n'
+    assert get_presence_backend().get_users(room_id) == {}
+    event: dict = async_to_sync(channel_layer.receive)(channel)
+    assert event['type'] == 'presence.delta'
+    assert loads(event['text']) == {'presence_delta': room_id, 'version': 2, 'user': 1, 'change': 'removed'}
+
+    # Someone else swept during this interval
+    get_presence_backend().update(room_id, 1, user_data('alireza', 1.5))
+    output = StringIO()
+    call_command('sweep_presence', stdout=output)
+    assert output.getvalue() == ''
+    assert get_presence_backend().get_users(room_id) == {1: user_data('alireza', 1.5)}
+
+    get_presence_backend().discard(room_id, [1])
+    async_to_sync(channel_layer.group_discard)(get_room_group_name(room_id), channel)
+    cache.delete(SWEEP_LOCK_KEY)
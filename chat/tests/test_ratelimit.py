@@ -0,0 +1,35 @@
+from django.test.utils import override_settings
+
+from chat import ratelimit
+from chat.ratelimit import RoomRateLimiter, TokenBucket
+
+
+def test_token_bucket(monkeypatch) -> None:
+    now: float = 1000.0
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now)
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    # Bursts up to the capacity
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+    # Then refills at the rate
+    now += 0.5
+    assert [bucket.consume() for _ in range(2)] == [True, False]
+
+    # But never above the capacity
+    now += 100
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+
+@override_settings(ROOM_RATE_LIMIT=1, ROOM_RATE_LIMIT_BURST=1, ROOM_RATE_LIMIT_USERS=2)
+def test_room_rate_limiter() -> None:
+    limiter = RoomRateLimiter()
+
+    assert limiter.consume(1, 1)
+    assert not limiter.consume(1, 1)
+    # Other rooms and other users have their own buckets
+    assert limiter.consume(1, 2)
+    assert limiter.consume(2, 1)
+
+    # Only the most recent buckets are kept, so (1, 1) starts over
+    assert limiter.consume(1, 1)
@@ -0,0 +1,109 @@
+import json
+import time
+
+import pytest
+from django.conf import settings
+from django.test.utils import override_settings
+
+from chat import replay
+from chat.replay import BaseReplayBackend, LocMemReplayBackend, RedisReplayBackend
+
+
+# For the backend fixture, see conftest
+LOCMEM_BACKEND = LocMemReplayBackend
+REDIS_BACKEND = RedisReplayBackend
+
+
+def message(text: str) -> dict:
+    return {'msg_type': 0, 'room': 1, 'username': 'alireza', 'message': text}
+
+
+def test_append_and_replay(backend: BaseReplayBackend) -> None:
+    assert backend.replay({1: None, 2: 0}) == {1: (0, None), 2: (0, [])}
+
+    seq, text = backend.append(1, message('Hello'))
+    assert seq == 1
+    assert json.loads(text) == dict(message('Hello'), seq=1)
+    backend.append(1, message('Hi'))
+    backend.append(2, message('Hey'))
+
+    replays = backend.replay({1: 0, 2: None})
+    assert replays[2] == (1, None)
+    seq, events = replays[1]
+    assert seq == 2
+    assert [json.loads(event) for event in events] == [dict(message('Hello'), seq=1), dict(message('Hi'), seq=2)]
+    assert [json.loads(event) for event in backend.replay({1: 1})[1][1]] == [dict(message('Hi'), seq=2)]
+    assert backend.replay({1: 2}) == {1: (2, [])}
+    # Numbers from the future are unknown
+    assert backend.replay({1: 3}) == {1: (2, None)}
+
+
+def test_events_forgotten(backend: BaseReplayBackend) -> None:
+    with override_settings(ROOM_REPLAY_BUFFER_SIZE=2):
+        for i in range(3):
+            backend.append(1, message(str(i)))
+
+    # The first message fell out of the buffer
+    assert backend.replay({1: 0}) == {1: (3, None)}
+    assert [json.loads(event)['seq'] for event in backend.replay({1: 1})[1][1]] == [2, 3]
+
+
+def test_numbering_outlives_events(backend: BaseReplayBackend, monkeypatch) -> None:
+    for i in range(2):
+        backend.append(1, message(str(i)))
+
+    # Only the events expire
+    if isinstance(backend, RedisReplayBackend):
+        seq_key, events_key = backend.get_keys(1)
+        assert backend.client.ttl(seq_key) == -1
+        assert backend.client.ttl(events_key) > 0
+        backend.client.delete(events_key)
+    else:
+        later: float = time.monotonic() + settings.ROOM_REPLAY_TIMEOUT
+        monkeypatch.setattr(replay.time, 'monotonic', lambda: later)
+
+    # Nothing was missed by whoever saw the last one, the others have to reload
+    assert backend.replay({1: 2}) == {1: (2, [])}
+    assert backend.replay({1: 1}) == {1: (2, None)}
+    seq, _ = backend.append(1, message('Hello again'))
+    assert seq == 3
+
+
+def test_resume_rooms(backend: BaseReplayBackend, monkeypatch) -> None:
+    backend.save_resume_rooms('token', 1, [1, 2])
+
+    # Only their owner can use them, and only once
+    assert backend.pop_resume_rooms('token', 2) is None
+    assert backend.pop_resume_rooms('token', 1) == [1, 2]
+    assert backend.pop_resume_rooms('token', 1) is None
+    assert backend.pop_resume_rooms('unknown', 1) is None
+
+    backend.save_resume_rooms('token', 1, [1])
+    if isinstance(backend, RedisReplayBackend):
+        assert 0 < backend.client.ttl(backend.get_resume_key('token')) <= settings.RESUME_TIMEOUT
+    else:
+        later: float = time.monotonic() + settings.RESUME_TIMEOUT
+        monkeypatch.setattr(replay.time, 'monotonic', lambda: later)
+        assert backend.pop_resume_rooms('token', 1) is None
+
+
+@pytest.mark.asyncio
+async def test_async_api(backend: BaseReplayBackend) -> None:
+    """What the consumers use, the same buffers and tokens as the blocking methods."""
+    assert await backend.replay_async({}) == {}
+    assert await backend.replay_async({1: None, 2: 0}) == {1: (0, None), 2: (0, [])}
+
+    backend.append(1, message('Hello'))
+    seq, text = await backend.append_async(1, message('Hi'))
+    assert seq == 2
+    assert json.loads(text) == dict(message('Hi'), seq=2)
+    assert backend.replay({1: 1}) == {1: (2, [text])}
+    assert await backend.replay_async({1: 1, 2: None}) == {1: (2, [text]), 2: (0, None)}
+    assert await backend.replay_async({1: 3}) == {1: (2, None)}
+
+    backend.save_resume_rooms('token', 1, [1, 2])
+    assert await backend.pop_resume_rooms_async('token', 2) is None
+    assert await backend.pop_resume_rooms_async('token', 1) == [1, 2]
+    await backend.save_resume_rooms_async('token', 1, [2])
+    assert backend.pop_resume_rooms('token', 1) == [2]
+    assert await backend.pop_resume_rooms_async('token', 1) is None
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.test.utils import override_settings
+
+from chat import room_cache as room_cache_module, utils
+from chat.exceptions import ClientError
+from chat.models import Room
+from chat.room_cache import ROOM_INVALIDATION_GROUP, CachedRoom, InvalidationListener, RoomCache, room_cache
+from chat.utils import get_room_or_error
+from users.models import User
+
+
+def make_room(room_id: int, title: str = 'room', staff_only: bool = False) -> CachedRoom:
+    return CachedRoom(id=room_id, title=title, staff_only=staff_only, group_name=f'room-{room_id}')
+
+
+@override_settings(ROOM_CACHE_SIZE=2)
+def test_room_cache_evicts_least_recently_used() -> None:
+    cache = RoomCache()
+    cache.set(make_room(1))
+    cache.set(make_room(2))
+
+    # Touch 1 so 2 becomes the least recently used one
+    assert cache.get(1) == make_room(1)
+    cache.set(make_room(3))
+
+    assert len(cache) == 2
+    assert cache.get(2) is None
+    assert cache.get(1) == make_room(1)
+    assert cache.get(3) == make_room(3)
+
+
+@override_settings(ROOM_CACHE_TIMEOUT=10)
+def test_room_cache_expires_entries(monkeypatch) -> None:
+    now: float = 1000.0
+    monkeypatch.setattr(room_cache_module.time, 'monotonic', lambda: now)
+    cache = RoomCache()
+    cache.set(make_room(1))
+    assert cache.get(1) == make_room(1)
+
+    now += 10
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+
+def test_room_cache_drops_stale_reads() -> None:
+    cache = RoomCache()
+    # Read before the room changed, stored after it was invalidated
+    generation: int = cache.generation
+    cache.invalidate(1)
+    cache.set(make_room(1, 'old'), generation)
+    assert cache.get(1) is None
+
+    cache.set(make_room(1, 'new'), cache.generation)
+    assert cache.get(1) == make_room(1, 'new')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_room_change_survives_broadcast_errors(monkeypatch, caplog) -> None:
+    room: Room = Room.objects.create(title='Savand Bros')
+    room_cache.set(CachedRoom.from_room(room))
+
+    def group_send(*args, **kwargs):
+        raise ConnectionError
+    monkeypatch.setattr(get_channel_layer(), 'group_send', group_send)
+    room.title = 'Savand'
+    room.save()
+
+    # Still evicted here, the failure is logged rather than raised to whoever saved it
+    assert room_cache.get(room.id) is None
+    assert f'Broadcasting the change of room {room.id} failed' in caplog.text
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_get_room_or_error_uses_cache(monkeypatch) -> None:
+    room_cache.clear()
+    user: User = User(username='alireza', is_staff=False)
+    room: Room = await database_sync_to_async(Room.objects.create)(title='Savand Bros')
+
+    assert await get_room_or_error(room.id, user) == CachedRoom.from_room(room)
+    # The second lookup must not reach the database
+    with monkeypatch.context() as patch:
+        patch.setattr(utils, 'get_room', None)
+        assert await get_room_or_error(room.id, user) == CachedRoom.from_room(room)
+
+    # Saving the room evicts it, so permissions are re-checked against the new row
+    room.staff_only = True
+    await database_sync_to_async(room.save)()
+    with pytest.raises(ClientError) as error:
+        await get_room_or_error(room.id, user)
+    assert error.value.code == 'ROOM_ACCESS_DENIED'
+
+    await database_sync_to_async(room.delete)()
+    with pytest.raises(ClientError) as error:
+        await get_room_or_error(room.id, user)
+    assert error.value.code == 'ROOM_INVALID'
+
+    with pytest.raises(ClientError) as error:
+        await get_room_or_error('not-a-room', user)
+    assert error.value.code == 'ROOM_INVALID'
+
+
+@pytest.mark.asyncio
+async def test_invalidation_listener() -> None:
+    cache = RoomCache()
+    cache.set(make_room(1))
+    cache.set(make_room(2))
+    listener = InvalidationListener(cache)
+    listener.start()
+    # Starting again from the same loop doesn't listen twice
+    listener.start()
+    await asyncio.sleep(0.1)
+
+    # Workers without anyone in the room hear about it too
+    await get_channel_layer().group_send(ROOM_INVALIDATION_GROUP, {"type": "room.invalidate", "room_id": 1})
+    for _ in range(50):
+        if cache.get(1) is None:
+            break
+        await asyncio.sleep(0.01)
+    assert cache.get(1) is None
+    assert cache.get(2) == make_room(2)
+    await listener.stop()
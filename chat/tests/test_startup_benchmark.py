@@ -0,0 +1,18 @@
+import json
+from io import StringIO
+
+from django.core.management import call_command
+
+
+def test_startup_benchmark_command() -> None:
+    output = StringIO()
+    call_command('startup_benchmark', runs=1, stdout=output)
+    results: dict = json.loads(output.getvalue())
+
+    assert results['runs'] == 1
+    full, websocket = results['whisper.asgi'], results['whisper.asgi_ws']
+    for entrypoint in (full, websocket):
+        assert entrypoint['import_ms'] > 0
+        assert entrypoint['rss_mb'] > 0
+    # The admin, allauth and the rest of the HTTP side stay out of the websocket workers
+    assert websocket['modules'] < full['modules']
@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.test.utils import override_settings
+
+from chat.models import Message, Room
+from chat.writer import MessageWriter
+from users.models import User
+
+
+@database_sync_to_async
+def create_room_and_user():
+    room: Room = Room.objects.create(title='Savand Bros')
+    user: User = User.objects.create_user(email='ali@email.com', username='alireza', password='somepassword')
+    return room, user
+
+
+@database_sync_to_async
+def get_messages():
+    return list(Message.objects.order_by('id').values_list('room_id', 'user_id', 'username', 'message'))
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_message_writer_flushes_on_interval() -> None:
+    room, user = await create_room_and_user()
+    writer = MessageWriter()
+
+    with override_settings(MESSAGE_WRITER_FLUSH_INTERVAL=10):
+        writer.write(room.id, user, 'first')
+        writer.write(room.id, user, 'second')
+
+    # Nothing is written until the interval has passed
+    assert len(writer) == 2
+    assert await get_messages() == []
+
+    await asyncio.sleep(0.1)
+    assert len(writer) == 0
+    assert await get_messages() == [
+        (room.id, user.id, 'alireza', 'first'),
+        (room.id, user.id, 'alireza', 'second'),
+    ]
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_message_writer_flushes_full_batches() -> None:
+    room, user = await create_room_and_user()
+    writer = MessageWriter()
+
+    with override_settings(MESSAGE_WRITER_BATCH_SIZE=3):
+        for i in range(3):
+            writer.write(room.id, user, str(i))
+        # A full batch goes out right away
+        await asyncio.sleep(0.05)
+        assert len(writer) == 0
+        assert [message for *_, message in await get_messages()] == ['0', '1', '2']
+
+        # The next one waits for the timer
+        writer.write(room.id, user, '3')
+        await asyncio.sleep(0.05)
+        assert len(writer) == 1
+
+    await writer.flush()
+    assert [message for *_, message in await get_messages()] == ['0', '1', '2', '3']
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_message_writer_saves_around_bad_rows() -> None:
+    room, user = await create_room_and_user()
+    writer = MessageWriter()
+
+    writer.write(room.id, user, 'first')
+    # The room is gone, the batch insert fails on its foreign key
+    writer.write(room.id + 1, user, 'orphan')
+    writer.write(room.id, user, 'second')
+    await writer.flush()
+
+    # Only the bad row is lost, and the writer keeps going
+    assert len(writer) == 0
+    assert [message for *_, message in await get_messages()] == ['first', 'second']
+    writer.write(room.id, user, 'third')
+    await writer.flush()
+    assert [message for *_, message in await get_messages()] == ['first', 'second', 'third']
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_message_writer_schedules_one_flush() -> None:
+    room, user = await create_room_and_user()
+    writer = MessageWriter()
+
+    with override_settings(MESSAGE_WRITER_BATCH_SIZE=2, MESSAGE_WRITER_MAX_BUFFERED=10):
+        writer.write(room.id, user, '0')
+        writer.write(room.id, user, '1')
+        flush = writer._flush_task
+        assert flush is not None
+        # More full batches before it ran don't pile up flushes
+        for i in range(2, 10):
+            writer.write(room.id, user, str(i))
+        assert writer._flush_task is flush
+        # And the buffer is full
+        assert writer.full
+        await flush
+
+    assert not writer.full
+    assert [message for *_, message in await get_messages()] == [str(i) for i in range(10)]
+
+
+async def write(writer: MessageWriter, room: Room, user: User, message: str) -> None:
+    writer.write(room.id, user, message)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_message_writer_flushes_on_shutdown() -> None:
+    room, user = async_to_sync(create_room_and_user)()
+    writer = MessageWriter()
+
+    # Flushed as the event loop closes
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(write(writer, room, user, 'first'))
+    loop.close()
+    # Or by the exit hook, with no loop left
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(write(writer, room, user, 'second'))
+    writer.save_now()
+    assert len(writer) == 0
+    loop.close()
+
+    assert [message for *_, message in async_to_sync(get_messages)()] == ['first', 'second']
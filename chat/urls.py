@@ -8,4 +8,5 @@ app_name = 'chat'
 
 urlpatterns: List[path] = [
     path(r'', view=views.index, name='index'),
+    path(r'rooms/', view=views.rooms, name='rooms'),
 ]
@@ -1,78 +1,218 @@
 # This decorator turns this function from a synchronous function into an async one
 # we can call from our async consumers, that handles Django DBs correctly.
 # For more, see http://channels.readthedocs.io/en/latest/topics/databases.html
-from typing import Dict
+# Ours runs it in the bounded thread pool of chat.db, raising SERVER_BUSY when it's saturated.
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from channels.db import database_sync_to_async
-from django.conf import settings
-from django.core.cache import cache
 from django.utils import timezone
 
+from chat import encoding
+from chat.db import database_sync_to_async
 from chat.exceptions import ClientError
-from chat.models import Room
+from chat.metrics import Histogram
+from chat.models import Message, Room
+from chat.presence import PresenceChange, PresenceUsers, get_presence_backend
+from chat.replay import RoomReplay, get_replay_backend
+from chat.room_cache import CachedRoom, room_cache
 from users.models import User
 
+PRESENCE_DURATION = Histogram(
+    'whisper_presence_duration_seconds', 'Time spent in room presence operations.', ['operation'],
+)
+REPLAY_DURATION = Histogram(
+    'whisper_replay_duration_seconds', 'Time spent numbering and replaying room messages.', ['operation'],
+)
 
-@database_sync_to_async
-def get_room_or_error(room_id: int, user: User):
+
+def parse_room_id(room_id) -> int:
+    """Return the room ID sent by the client as an int."""
+    try:
+        return int(room_id)
+    except (TypeError, ValueError):
+        raise ClientError("ROOM_INVALID")
+
+
+async def get_room_or_error(room_id: int, user: User) -> CachedRoom:
     """
     Tries to fetch a room for the user, checking permissions along the way.
+
+    Rooms are served from the process-local room cache, so only the first lookup
+    of a room (or the first one after it changed) touches the database.
     """
     # Check if the user is logged in
     if not user.is_authenticated:
         raise ClientError("USER_HAS_TO_LOGIN")
+    room_id = parse_room_id(room_id)
     # Find the room they requested (by ID)
-    try:
-        room = Room.objects.get(pk=room_id)
-    except Room.DoesNotExist:
-        raise ClientError("ROOM_INVALID")
+    room: CachedRoom = room_cache.get(room_id)
+    if room is None:
+        # Not cached if the room changes while it's read
+        generation: int = room_cache.generation
+        room = await get_room(room_id)
+        room_cache.set(room, generation)
     # Check permissions
     if room.staff_only and not user.is_staff:
         raise ClientError("ROOM_ACCESS_DENIED")
     return room
 
 
+async def get_rooms_or_errors(room_ids: Iterable[int], user: User) -> Tuple[Dict[int, CachedRoom], Dict[str, str]]:
+    """
+    Fetch several rooms for the user at once, checking permissions along the way.
+
+    Returns the rooms the user may join by ID, and the error code of every other
+    requested room. Rooms missing from the room cache are loaded with a single query.
+    """
+    # Check if the user is logged in
+    if not user.is_authenticated:
+        raise ClientError("USER_HAS_TO_LOGIN")
+    rooms: Dict[int, CachedRoom] = {}
+    errors: Dict[str, str] = {}
+    missing: List[int] = []
+    for room_id in room_ids:
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            errors[str(room_id)] = "ROOM_INVALID"
+            continue
+        room: CachedRoom = room_cache.get(room_id)
+        if room is None:
+            missing.append(room_id)
+        else:
+            rooms[room_id] = room
+    if missing:
+        generation: int = room_cache.generation
+        loaded: Dict[int, CachedRoom] = await get_rooms(missing)
+        for room_id in missing:
+            if room_id in loaded:
+                room_cache.set(loaded[room_id], generation)
+                rooms[room_id] = loaded[room_id]
+            else:
+                errors[str(room_id)] = "ROOM_INVALID"
+    # Check permissions
+    for room_id, room in list(rooms.items()):
+        if room.staff_only and not user.is_staff:
+            del rooms[room_id]
+            errors[str(room_id)] = "ROOM_ACCESS_DENIED"
+    return rooms, errors
+
+
 @database_sync_to_async
-def cache_or_update_room_presence(room_id: int, user: User) -> None:
-    """Cache or update user presence in the room."""
-    cache_key = get_room_presence_cache_key(room_id)
-    room_cached = cache.get(cache_key)
-    users_data: Dict[int, Dict[str, str]] = {
-        user.id: {
-            'username': user.username,
-            'name': user.name,
-            'left': False,
-            'last_update': timezone.now().timestamp()
-        }
-    }
+def get_room(room_id: int) -> CachedRoom:
+    """Load a room from the database."""
+    try:
+        return CachedRoom.from_room(Room.objects.get(pk=room_id))
+    except Room.DoesNotExist:
+        raise ClientError("ROOM_INVALID")
 
-    if not room_cached:
-        cache.set(cache_key, users_data, timeout=settings.ROOM_PRESENCE_TIMEOUT)
-    else:
-        room_cached.update(users_data)
-        cache.set(cache_key, room_cached, timeout=settings.ROOM_PRESENCE_TIMEOUT)
+
+@database_sync_to_async
+def get_rooms(room_ids: List[int]) -> Dict[int, CachedRoom]:
+    """Load rooms from the database by ID, with a single query."""
+    return {room_id: CachedRoom.from_room(room) for room_id, room in Room.objects.in_bulk(room_ids).items()}
 
 
 @database_sync_to_async
-def get_presence_users(room_id: int) -> Dict[int, Dict[str, str]]:
+def get_room_history(room_id: int, before: Optional[int], size: int) -> List[dict]:
+    """Return a page of the room messages older than ``before``, newest first."""
+    return Message.objects.page(room_id, before, size)
+
+
+def get_user_presence(user: User) -> dict:
+    """Return what presence stores about the user."""
+    return {
+        'username': user.username,
+        'name': user.name,
+        'left': False,
+        'last_update': timezone.now().timestamp()
+    }
+
+
+# The presence backends have an asyncio API, so these stay on the event loop rather than take a
+# thread pool worker each, see chat.async_redis
+async def cache_or_update_room_presence(room_id: int, user: User) -> Optional[PresenceChange]:
+    """Cache or update user presence in the room, returns the change it made if any."""
+    with PRESENCE_DURATION.labels('update').time():
+        changes = await get_presence_backend().update_many_async([room_id], user.id, get_user_presence(user))
+    return changes.get(room_id)
+
+
+async def cache_or_update_rooms_presence(room_ids: Iterable[int], user: User) -> Dict[int, PresenceChange]:
+    """Cache or update user presence in several rooms at once, returns the changes by room."""
+    with PRESENCE_DURATION.labels('update_many').time():
+        return await get_presence_backend().update_many_async(room_ids, user.id, get_user_presence(user))
+
+
+async def get_presence_users(room_id: int) -> PresenceUsers:
     """Return all the presence users in the room."""
-    return cache.get(get_room_presence_cache_key(room_id))
+    with PRESENCE_DURATION.labels('get_users').time():
+        return (await get_presence_backend().get_snapshot_async(room_id))[1]
 
 
-@database_sync_to_async
-def remove_user_from_presence(room_id: int, user_id: int) -> None:
-    """Remove user from the room presence."""
-    cache_key = get_room_presence_cache_key(room_id)
-    room_cached = cache.get(cache_key)
-    # Purge users that have left 2 hours ago!
+async def get_presence_snapshot(room_id: int) -> Tuple[int, PresenceUsers]:
+    """Return the presence version of the room and all its users."""
+    with PRESENCE_DURATION.labels('get_snapshot').time():
+        return await get_presence_backend().get_snapshot_async(room_id)
+
+
+async def get_presence_changes(room_id: int, since_version: int) -> Optional[Tuple[int, List[PresenceChange]]]:
+    """Return the presence version of the room and its changes since ``since_version``, if still known."""
+    with PRESENCE_DURATION.labels('get_changes').time():
+        return await get_presence_backend().get_changes_async(room_id, since_version)
+
+
+async def sweep_presence(limit: int) -> Dict[int, List[PresenceChange]]:
+    """Remove up to ``limit`` presence entries past their deadline, returns the changes by room."""
+    with PRESENCE_DURATION.labels('sweep').time():
+        return await get_presence_backend().sweep_async(limit)
+
+
+def get_presence_delta_event(room_id: int, change: PresenceChange) -> dict:
+    """
+    Build the channel layer event pushing a presence change to the room, with the
+    frame already encoded in every wire format like ChatConsumer.encode_event.
+    """
+    content: dict = {"presence_delta": room_id, **change}
+    return {
+        "type": "presence.delta",
+        "room": room_id,
+        "text": encoding.dumps(content),
+        "bytes": encoding.packb(content),
+    }
+
+
+async def remove_user_from_presence(room_id: int, user_id: int) -> Optional[PresenceChange]:
+    """Remove user from the room presence, returns the change it made if any."""
+    # They are swept from the presence once ROOM_PRESENCE_LEFT_TIMEOUT went by
+    with PRESENCE_DURATION.labels('mark_left').time():
+        changes = await get_presence_backend().mark_left_many_async([room_id], user_id)
+    return changes.get(room_id)
+
+
+async def remove_user_from_rooms_presence(room_ids: Iterable[int], user_id: int) -> Dict[int, PresenceChange]:
+    """Remove user from the presence of several rooms at once, returns the changes by room."""
+    with PRESENCE_DURATION.labels('mark_left_many').time():
+        return await get_presence_backend().mark_left_many_async(room_ids, user_id)
+
+
+# Neither do the replay ones, a busy database mustn't fail sending messages or saving resume tokens
+async def append_room_event(room_id: int, content: dict) -> Tuple[int, str]:
+    """Number the event sent to the room and keep it for replays, returns its number and JSON encoding."""
+    with REPLAY_DURATION.labels('append').time():
+        return await get_replay_backend().append_async(room_id, content)
+
+
+async def replay_room_events(since: Dict[int, Optional[int]]) -> Dict[int, RoomReplay]:
+    """Return the sequence number of the rooms and their events after the ones asked for, if still known."""
+    with REPLAY_DURATION.labels('replay').time():
+        return await get_replay_backend().replay_async(since)
 
-    if room_cached:
-        user_data: dict = room_cached[user_id]
-        user_data.update({'left': True})
 
-    cache.set(cache_key, room_cached, timeout=settings.ROOM_PRESENCE_TIMEOUT)
+async def save_resume_token(token: str, user_id: int, room_ids: List[int]) -> None:
+    """Let the connection given the token be resumed, with the rooms it was in."""
+    await get_replay_backend().save_resume_rooms_async(token, user_id, room_ids)
 
 
-def get_room_presence_cache_key(room_id: int) -> str:
-    """Return Room Presence Cache Key."""
-    return f'room-presence-{room_id}'
+async def use_resume_token(token: str, user_id: int) -> Optional[List[int]]:
+    """Return the rooms of the connection being resumed, None when the token isn't valid anymore."""
+    return await get_replay_backend().pop_resume_rooms_async(token, user_id)
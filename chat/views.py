@@ -1,30 +1,97 @@
-import json
+import hashlib
+from functools import lru_cache
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.db.models import QuerySet
-from django.http import HttpRequest
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden, JsonResponse
 from django.shortcuts import render
-from typing import List
+from django.template.loader import get_template
+from django.templatetags.static import static
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_GET
 
-from chat.models import Room
+from chat.exceptions import ClientError
+from chat.metrics import collect_all, render as render_metrics
+from chat.room_list import get_room_list, get_room_list_version, get_rooms_page
+
+
+@lru_cache(maxsize=None)
+def get_index_page_version() -> str:
+    """Hash of what the index page is built from besides the rooms, which only changes on deploys."""
+    parts = [get_template(name).template.source for name in ('base.html', 'index.html')]
+    parts += [static(path) for path in ('assets/app.js', 'assets/app.css')]
+    return hashlib.md5('\n'.join(parts).encode()).hexdigest()
+
+
+def get_index_etag(request: HttpRequest) -> str:
+    """The page only changes with the room list and the user it's rendered for."""
+    user = request.user
+    key: str = f'{get_room_list_version()}:{user.pk}:{user.username}:{user.is_staff}:{get_index_page_version()}'
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def get_rooms_etag(request: HttpRequest) -> str:
+    """Pages of the directory only change with the rooms, and differ between staff users and the others."""
+    key: str = f'{get_room_list_version()}:{request.user.is_staff}:{request.GET.urlencode()}'
+    return hashlib.md5(key.encode()).hexdigest()
 
 
 @login_required
+@cache_control(private=True, no_cache=True)
+# No Last-Modified, the page differs between users that share the same room list
+@condition(etag_func=get_index_etag)
 def index(request: HttpRequest):
     """
     Root page view. This is essentially a single-page app, if you ignore the
     login and admin parts.
+
+    Only the first page of the room directory is embedded, the client fetches
+    the others from the rooms view. It's serialized once per change of the rooms
+    rather than on every load, and reloads answer 304 Not Modified until the
+    rooms or the user change.
     """
-    # Get a list of rooms, ordered alphabetically
-    rooms: QuerySet = Room.objects.order_by("title")
-    rooms_js: List[dict] = []
-
-    for room in rooms:
-        rooms_js.append({
-            'id': room.id,
-            'title': room.title,
-            'staff_only': room.staff_only,
-            'group_name': room.group_name,
-        })
-
-    return render(request, "index.html", {"rooms": rooms, 'rooms_js': json.dumps(rooms_js)})
+    _, rooms_js, rooms_next = get_room_list(request.user.is_staff)
+    return render(request, "index.html", {'rooms_js': rooms_js, 'rooms_next': rooms_next})
+
+
+@require_GET
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=get_rooms_etag)
+def rooms(request: HttpRequest) -> JsonResponse:
+    """
+    The room directory, a page at a time ordered by title, the rooms the user may join only.
+
+    Takes an optional ``q`` to only list the rooms whose title contains it and ``limit``
+    for the page size. Pass the returned ``next`` cursor as ``after`` to get the next
+    page, it's None once there's nothing left.
+    """
+    try:
+        limit: int = min(int(request.GET.get('limit') or settings.ROOM_DIRECTORY_PAGE_SIZE),
+                         settings.ROOM_DIRECTORY_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError
+        page, cursor = get_rooms_page(
+            request.GET.get('after'), limit, request.GET.get('q', '').strip(), request.user.is_staff,
+        )
+    except ValueError:
+        return JsonResponse({'error': 'LIMIT_INVALID'}, status=400)
+    except ClientError as e:
+        return JsonResponse({'error': e.code}, status=400)
+    return JsonResponse({'rooms': page, 'next': cursor})
+
+
+@require_GET
+def metrics(request: HttpRequest) -> HttpResponse:
+    """Metrics of all the server processes, in the Prometheus text format."""
+    if settings.METRICS_TOKEN:
+        allowed: bool = constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {settings.METRICS_TOKEN}',
+        )
+    else:
+        # Nothing is public by default, only staff and development servers see them without a token
+        allowed = bool(settings.DEBUG) or request.user.is_staff
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(collect_all()), content_type='text/plain; version=0.0.4; charset=utf-8')
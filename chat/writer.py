@@ -0,0 +1,159 @@
+import asyncio
+import atexit
+import logging
+from typing import List, Optional
+
+from channels_redis.core import _wrap_close
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from chat.db import database_sync_to_async
+from chat.models import Message
+from users.models import User
+
+logger = logging.getLogger(__name__)
+
+
+# The messages were delivered already, they wait for a thread rather than be dropped
+@database_sync_to_async(fail_fast=False)
+def save_messages(messages: List[Message]) -> int:
+    """
+    Insert the messages with a single query. When that fails they are inserted one
+    by one, so a single bad row only loses itself. Returns how many were dropped.
+    """
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+        return 0
+    except Exception:
+        logger.warning('Saving %d chat messages at once failed, saving them one by one', len(messages), exc_info=True)
+    dropped: int = 0
+    for message in messages:
+        try:
+            with transaction.atomic():
+                message.save(force_insert=True)
+        except Exception:
+            dropped += 1
+            logger.exception('Dropped a chat message of room %s that could not be saved', message.room_id)
+    return dropped
+
+
+class MessageWriter:
+    """
+    Write-behind buffer for chat messages.
+
+    Messages are kept in memory and inserted with ``bulk_create`` once
+    ``MESSAGE_WRITER_BATCH_SIZE`` of them are waiting, or ``MESSAGE_WRITER_FLUSH_INTERVAL``
+    milliseconds after the first one was buffered, whichever comes first. The insert
+    runs in the thread pool, so sending a message never waits on the database.
+
+    At most ``MESSAGE_WRITER_MAX_BUFFERED`` messages wait or are being inserted, past
+    that ``full`` tells the consumers to refuse new ones. What's buffered is flushed
+    when the event loop closes, and saved on the way out of the process otherwise;
+    only a killed process loses it.
+    """
+
+    def __init__(self):
+        self._buffer: List[Message] = []
+        # Messages taken off the buffer by a flush that's still inserting them
+        self._saving: List[Message] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # The flush scheduled for a full batch, there's never more than one waiting
+        self._flush_task: Optional[asyncio.Future] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def full(self) -> bool:
+        """Whether no more messages should be accepted until the database caught up."""
+        return len(self._buffer) + len(self._saving) >= settings.MESSAGE_WRITER_MAX_BUFFERED
+
+    def unsaved(self, room_id: int) -> List[Message]:
+        """Return the messages of the room that are buffered or being inserted, oldest first."""
+        return [message for message in self._saving + self._buffer if message.room_id == room_id]
+
+    def _bind(self) -> asyncio.AbstractEventLoop:
+        """Attach to the running event loop, timers and locks can't be shared between loops."""
+        loop = asyncio.get_event_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._timer = None
+            self._flush_task = None
+            self._lock = asyncio.Lock()
+            # Like the connection pools of the channel layer, flushed before the loop closes
+            _wrap_close(loop, self)
+        return loop
+
+    def _schedule_flush(self) -> None:
+        """Flush right away once a batch is full, or after the interval otherwise."""
+        if self._flush_task is not None or not self._buffer:
+            return
+        if len(self._buffer) >= settings.MESSAGE_WRITER_BATCH_SIZE:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._flush_task = asyncio.ensure_future(self.flush())
+        elif self._timer is None:
+            self._timer = self._loop.call_later(settings.MESSAGE_WRITER_FLUSH_INTERVAL / 1000, self._flush_later)
+
+    def _flush_later(self) -> None:
+        self._timer = None
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    def write(self, room_id: int, user: User, message: str) -> None:
+        """Buffer a message, it'll be saved by one of the next flushes."""
+        self._bind()
+        self._buffer.append(Message(
+            room_id=room_id,
+            user_id=user.id,
+            username=user.username,
+            message=message,
+            created=timezone.now(),
+        ))
+        self._schedule_flush()
+
+    async def flush(self) -> None:
+        """Save everything buffered so far."""
+        self._bind()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # One batch at a time, so messages are stored in the order they were sent
+        async with self._lock:
+            # Whatever comes in from now on needs a flush of its own
+            if self._flush_task is asyncio.Task.current_task():
+                self._flush_task = None
+            messages, self._buffer = self._buffer, []
+            if not messages:
+                return
+            self._saving = messages
+            try:
+                await save_messages(messages)
+            except Exception:
+                # Whatever went wrong, flushing goes on for the next batches and the history command
+                logger.exception('Dropped %d chat messages that could not be saved', len(messages))
+            finally:
+                self._saving = []
+        self._schedule_flush()
+
+    async def close_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Save what's buffered before the loop closes, called as it closes."""
+        if loop is self._loop:
+            await self.flush()
+            self._loop = None
+
+    def save_now(self) -> None:
+        """Save what's buffered in the calling thread, for when there's no event loop left to flush it."""
+        messages, self._buffer = self._buffer, []
+        if messages:
+            save_messages.func(messages)
+
+
+message_writer = MessageWriter()
+# Servers often exit without closing their event loop
+atexit.register(message_writer.save_now)
@@ -0,0 +1,85 @@
+import json
+import os
+import statistics
+import time
+from typing import Callable, Dict, List
+
+import pytest
+
+# Median timings of the benchmarks, in microseconds, checked in so regressions fail the suite
+BENCHMARK_BASELINE: str = os.path.join(os.path.dirname(__file__), 'chat', 'tests', 'benchmarks.json')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmark')
+    group.addoption('--benchmark', action='store_true', help='Run the tests marked as benchmark too.')
+    group.addoption(
+        '--benchmark-save', action='store_true', help='Store the timings of this run as the new baseline.',
+    )
+    group.addoption(
+        '--benchmark-tolerance', type=float, default=2.0,
+        help='How many times slower than the baseline a benchmark may get before failing.',
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: timing test, only runs with --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark') or config.getoption('--benchmark-save'):
+        return
+    skip = pytest.mark.skip(reason='benchmarks only run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+class Benchmark:
+    """Times functions and compares them against the stored baseline."""
+
+    def __init__(self, baseline: Dict[str, float], tolerance: float, save: bool):
+        self.baseline: Dict[str, float] = baseline
+        self.tolerance: float = tolerance
+        self.save: bool = save
+        self.results: Dict[str, float] = {}
+
+    async def __call__(self, name: str, function: Callable, min_time: float = 0.2, min_rounds: int = 5,
+                       max_rounds: int = 1000) -> float:
+        """
+        Await ``function()`` until ``min_time`` seconds went by, at least ``min_rounds`` times,
+        and return the median time it took in microseconds.
+
+        Fails when that's over ``--benchmark-tolerance`` times the baseline, unless the
+        baseline is being saved.
+        """
+        timings: List[float] = []
+        started_at: float = time.perf_counter()
+        while len(timings) < max_rounds and (len(timings) < min_rounds or time.perf_counter() - started_at < min_time):
+            start: float = time.perf_counter()
+            await function()
+            timings.append(time.perf_counter() - start)
+        median: float = round(statistics.median(timings) * 1000000, 1)
+        self.results[name] = median
+
+        baseline: float = self.baseline.get(name)
+        if not self.save and baseline is not None and median > baseline * self.tolerance:
+            pytest.fail(f'{name} took {median:.1f}us, the baseline is {baseline:.1f}us')
+        return median
+
+
+@pytest.fixture(scope='session')
+def benchmark(request) -> Benchmark:
+    """Time benchmarks with ``await benchmark(name, function)``, see ``--benchmark``."""
+    try:
+        with open(BENCHMARK_BASELINE) as file:
+            baseline: Dict[str, float] = json.load(file)
+    except FileNotFoundError:
+        baseline = {}
+    save: bool = request.config.getoption('--benchmark-save')
+    benchmark = Benchmark(baseline, request.config.getoption('--benchmark-tolerance'), save)
+    yield benchmark
+    if save and benchmark.results:
+        with open(BENCHMARK_BASELINE, 'w') as file:
+            json.dump({**baseline, **benchmark.results}, file, indent=2, sort_keys=True)
+            file.write('\n')
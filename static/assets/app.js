@@ -96,9 +96,23 @@ app.service("Room", function ($rootScope) {
     self.title = data.title;
     self.messages = [];
     self.joined = false;
+    /**
+     * Sequence number of the last message we got in the room
+     * @type {number}
+     */
+    self.seq = 0;
     self.message = function (message) {
       self.messages.push(message);
     }
+    /**
+     * Show where messages sent while we were disconnected are missing
+     */
+    self.gap = function () {
+      var last = self.messages[self.messages.length - 1];
+      if (self.messages.length && !last.gap) {
+        self.messages.push({gap: true, isOwn: function () { return false; }});
+      }
+    };
     self.join = function (socket) {
       if (self.joined) {
         return;
@@ -169,16 +183,55 @@ app.controller("IndexController", function (UTILS, SETTING, VIEW, PATH, Room, Me
     };
 
     /**
+     * Rooms we know of, listed or opened
      * @type {Array<Room>}
      */
     vm.rooms = [];
 
+    /**
+     * Rooms listed in the menu, fetched from the room directory a page at a time
+     * @type {object}
+     */
+    vm.directory = {
+      /**
+       * @type {Array<Room>}
+       */
+      rooms: [],
+      /**
+       * @type {string}
+       */
+      query: "",
+      /**
+       * Cursor of the next page, null once there's nothing left
+       * @type {string}
+       */
+      next: VIEW.ROOMS_NEXT,
+      /**
+       * Only the latest request is listed, the others are outdated
+       * @type {number}
+       */
+      request: 0
+    };
+
     /**
      * Current room instance
      * @type {Room}
      */
     vm.room = null;
 
+    /**
+     * Lets us get the rooms and missed messages of the connection back after a reconnect
+     * @type {string}
+     */
+    vm.resumeToken = null;
+
+    /**
+     * Frames received on this connection, acknowledged every few of them so the
+     * server doesn't write faster than we read
+     * @type {number}
+     */
+    vm.framesReceived = 0;
+
     /**
      * @type {boolean}
      */
@@ -199,10 +252,10 @@ app.controller("IndexController", function (UTILS, SETTING, VIEW, PATH, Room, Me
     };
 
     /**
-     * Get rooms
+     * Get rooms, the first page of the directory comes with the page
      */
     angular.forEach(VIEW.ROOMS, function (room) {
-      vm.rooms.push(new Room(room));
+      vm.directory.rooms.push(vm.getRoom(room));
     });
 
     /**
@@ -224,6 +277,59 @@ app.controller("IndexController", function (UTILS, SETTING, VIEW, PATH, Room, Me
      */
     vm.socket.onmessage = function (messageData) {
       var data = JSON.parse(messageData.data);
+
+      if (++vm.framesReceived % 10 === 0) {
+        vm.socket.send(JSON.stringify({
+          "command": "ack",
+          "frames": vm.framesReceived
+        }));
+      }
+
+      // Several messages coalesced into one frame
+      if (data.batch) {
+        angular.forEach(data.batch, vm.onSocketMessage);
+      } else {
+        vm.onSocketMessage(data);
+      }
+
+      // Update template
+      $scope.$apply();
+    };
+
+    /**
+     * Handle a single message from the socket
+     *
+     * @param {object} data
+     */
+    vm.onSocketMessage = function (data) {
+      if (data.resume_token) {
+        vm.resumeToken = data.resume_token;
+      }
+
+      // Room opened, rooms resumed after reconnecting or too late for that
+      if (data.join || data.join_many || data.resume) {
+        angular.forEach(data.join_many || data.resume || [data], function (joined) {
+          var room = vm.getRoomById(parseInt(joined.join));
+          if (room) {
+            // Some of the messages we missed aren't remembered anymore
+            if (joined.reset) {
+              room.gap();
+            }
+            // The server's number wins, even a lower one if the room was renumbered
+            room.seq = joined.seq;
+          }
+        });
+        return;
+      }
+      if (data.error === "RESUME_EXPIRED" || data.error === "RESUME_INVALID") {
+        // Joining again, whatever was sent meanwhile is lost
+        angular.forEach(vm.getJoinedRooms(), function (room) {
+          room.gap();
+        });
+        vm.joinRooms();
+        return;
+      }
+
       var message = new Message(data);
       var room = data.room == vm.room.id ? vm.room : null;
       var fromUser = data.username === SETTING.USER.USERNAME;
@@ -239,6 +345,14 @@ app.controller("IndexController", function (UTILS, SETTING, VIEW, PATH, Room, Me
 
       console.log("New socket message", data);
 
+      // Already got it before reconnecting
+      if (room && data.seq) {
+        if (data.seq <= room.seq) {
+          return;
+        }
+        room.seq = data.seq;
+      }
+
       // Add to room messages
       if (room) {
 
@@ -263,9 +377,6 @@ app.controller("IndexController", function (UTILS, SETTING, VIEW, PATH, Room, Me
       if (data.error) {
         alert(data.error);
       }
-
-      // Update template
-      $scope.$apply();
     };
 
     /**
@@ -274,12 +385,32 @@ app.controller("IndexController", function (UTILS, SETTING, VIEW, PATH, Room, Me
     vm.socket.onopen = function () {
 
       console.log("Connected to chat socket");
+      vm.framesReceived = 0;
+
+      // Get the rooms we were in back, with the messages we missed
+      if (vm.resumeToken) {
+        var seqs = {};
+        angular.forEach(vm.getJoinedRooms(), function (room) {
+          seqs[room.id] = room.seq;
+        });
+        vm.socket.send(JSON.stringify({
+          "command": "resume",
+          "token": vm.resumeToken,
+          "rooms": seqs
+        }));
+        vm.resumeToken = null;
+      } else {
+        vm.joinRooms();
+      }
 
       // Join the last visited room
       if (location.hash) {
-        var index = parseInt(location.hash.split("#")[1]);
-        if (vm.rooms[index]) {
-          vm.openRoom(vm.rooms[index]);
+        var id = parseInt(location.hash.split("#")[1]);
+        var lastRoom = vm.rooms.filter(function (room) {
+          return room.id === id;
+        })[0];
+        if (lastRoom) {
+          vm.openRoom(lastRoom);
           $scope.$apply();
         }
       }
@@ -300,6 +431,84 @@ app.controller("IndexController", function (UTILS, SETTING, VIEW, PATH, Room, Me
     });
   };
 
+  /**
+   * Return the room we know of with the data id, or a new one
+   *
+   * @param {object} data
+   * @returns {Room}
+   */
+  vm.getRoom = function (data) {
+    for (var i in vm.rooms) {
+      if (vm.rooms[i].id === data.id) {
+        return vm.rooms[i];
+      }
+    }
+    var room = new Room(data);
+    vm.rooms.push(room);
+    return room;
+  };
+
+  /**
+   * Return the room we know of with the id, if any
+   *
+   * @param {number} id
+   * @returns {Room}
+   */
+  vm.getRoomById = function (id) {
+    return vm.rooms.filter(function (room) {
+      return room.id === id;
+    })[0];
+  };
+
+  /**
+   * @returns {Array<Room>}
+   */
+  vm.getJoinedRooms = function () {
+    return vm.rooms.filter(function (room) {
+      return room.joined;
+    });
+  };
+
+  /**
+   * Rejoin the rooms we were in before reconnecting, with a single command
+   */
+  vm.joinRooms = function () {
+    var joinedRooms = vm.getJoinedRooms();
+    if (joinedRooms.length) {
+      vm.socket.send(JSON.stringify({
+        "command": "join_many",
+        "rooms": joinedRooms.map(function (room) {
+          return room.id;
+        })
+      }));
+    }
+  };
+
+  /**
+   * List the rooms matching the search, or the next page of them
+   *
+   * @param {boolean} more
+   */
+  vm.loadRooms = function (more) {
+    var request = ++vm.directory.request;
+    var params = {q: vm.directory.query || undefined};
+    if (more) {
+      params.after = vm.directory.next;
+    }
+    $http.get(PATH.ROOMS, {params: params}).then(function (response) {
+      if (request !== vm.directory.request) {
+        return;
+      }
+      if (!more) {
+        vm.directory.rooms = [];
+      }
+      angular.forEach(response.data.rooms, function (room) {
+        vm.directory.rooms.push(vm.getRoom(room));
+      });
+      vm.directory.next = response.data.next;
+    });
+  };
+
   /**
    * @param {Room} room
    */
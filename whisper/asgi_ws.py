@@ -0,0 +1,17 @@
+"""
+Websocket-only ASGI entrypoint, for the workers that only serve the chat::
+
+    daphne -b 0.0.0.0 -p 8001 whisper.asgi_ws:application
+
+Configures Django with the slim ``whisper.settings_ws`` and then runs the
+application defined in the ASGI_APPLICATION setting, like ``whisper.asgi``.
+Route only ``/chat/stream/`` to these workers.
+"""
+
+import os
+import django
+from channels.routing import get_default_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "whisper.settings_ws")
+django.setup()
+application = get_default_application()
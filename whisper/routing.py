@@ -2,8 +2,8 @@ from django.urls import path
 
 from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 
+from chat.auth import CachedAuthMiddlewareStack
 from chat.consumers import ChatConsumer
 
 
@@ -18,9 +18,10 @@ application = ProtocolTypeRouter({
 
     # Route all WebSocket requests to our custom chat handler.
     # We actually don't need the URLRouter here, but we've put it in for
-    # illustration. Also note the inclusion of the AuthMiddlewareStack to
+    # illustration. Also note the inclusion of the CachedAuthMiddlewareStack to
     # add users and sessions - see http://channels.readthedocs.io/en/latest/topics/authentication.html
-    "websocket": AuthMiddlewareStack(
+    # and chat.auth for how it differs from Channels' AuthMiddlewareStack
+    "websocket": CachedAuthMiddlewareStack(
         URLRouter([
             # URLRouter just takes standard Django path() or url() entries.
             path("chat/stream/", ChatConsumer),
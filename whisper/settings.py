@@ -14,8 +14,8 @@ TESTING: bool = sys.argv[1:2] == ['test'] or 'test' in sys.argv[0]
 # http://channels.readthedocs.io/en/latest/topics/channel_layers.html
 CHANNEL_LAYERS = {
     "default": {
-        # This example app uses the Redis channel layer implementation channels_redis
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        # channels_redis, with group messages fanned out in process, see chat.layers
+        "BACKEND": "chat.layers.HybridChannelLayer",
         "CONFIG": {
             "hosts": [os.environ.get('REDISCLOUD_URL', ('localhost', 6379)), ],
         },
@@ -30,6 +30,33 @@ ASGI_APPLICATION = 'whisper.routing.application'
 
 NOTIFY_USERS_ON_ENTER_OR_LEAVE_ROOMS = True
 
+# Rooms a single join_many or leave_many command may ask for
+MAX_ROOMS_PER_COMMAND: int = 100
+# Characters a single chat message may have
+MAX_MESSAGE_LENGTH: int = 4000
+
+# Token bucket rate limits of websocket commands, see chat.ratelimit
+CONNECTION_RATE_LIMIT: float = 20  # commands per second per connection
+CONNECTION_RATE_LIMIT_BURST: int = 50
+ROOM_RATE_LIMIT: float = 5  # commands per second per user in a room
+ROOM_RATE_LIMIT_BURST: int = 20
+ROOM_RATE_LIMIT_USERS: int = 100000  # (user, room) buckets kept per process
+RATE_LIMIT_CLOSE_AFTER: int = 50  # consecutive rate limited commands before closing the socket, 0 never closes
+
+# Room events waiting to be written to a websocket, each entry is one frame unless coalesced
+OUTBOUND_QUEUE_SIZE: int = 100
+# Events in all entries together, coalescing doesn't get around it
+OUTBOUND_QUEUE_MAX_FRAMES: int = 1000
+# Seconds the oldest event may wait, the queue counts as full after that
+OUTBOUND_QUEUE_MAX_DELAY: float = 10
+# What to do once the queue is full: 'drop_oldest', 'coalesce' it into a single frame or 'disconnect'.
+# Coalescing disconnects too once there are OUTBOUND_QUEUE_MAX_FRAMES events or they are too old.
+OUTBOUND_QUEUE_POLICY: str = 'coalesce'
+# Send the events queued within one loop tick as a single {"batch": [...]} frame
+OUTBOUND_COALESCE: bool = True
+# Frames written ahead of the last ack of clients acknowledging them, the outbox holds the rest back
+OUTBOUND_ACK_WINDOW: int = 100
+
 MSG_TYPE_MESSAGE = 0  # For standard messages
 MSG_TYPE_WARNING = 1  # For yellow messages
 MSG_TYPE_ALERT = 2  # For red & dangerous alerts
@@ -59,6 +86,67 @@ MESSAGE_TYPES_LIST = [
 ]
 
 ROOM_PRESENCE_TIMEOUT: int = 3600  # 1 hours
+ROOM_PRESENCE_BACKEND: str = 'chat.presence.RedisPresenceBackend'
+# Where the consumers reach the presence and replay backends on the event loop, the same Redis as the cache,
+# see chat.async_redis
+ASYNC_REDIS_URL: str = os.environ.get('REDISCLOUD_URL', 'redis://localhost:6379')
+# Connections per process and event loop, concurrent commands are pipelined on them
+ASYNC_REDIS_POOL_SIZE: int = 10
+# Presence changes remembered per room, for clients catching up with since_version
+ROOM_PRESENCE_LOG_SIZE: int = 1000
+# Sending messages refreshes presence at most this often, keep it well below ROOM_PRESENCE_TIMEOUT
+ROOM_PRESENCE_HEARTBEAT_INTERVAL: int = 30  # 30 seconds
+# Connected users refresh their presence in every room they are in this often, even when they don't talk
+ROOM_PRESENCE_KEEPALIVE_INTERVAL: int = 300  # 5 minutes, 0 turns it off
+# Users are swept from the room presence when not refreshed for this long, see the sweep_presence command
+ROOM_PRESENCE_IDLE_TIMEOUT: int = 900  # 15 minutes, keep it well above ROOM_PRESENCE_KEEPALIVE_INTERVAL
+ROOM_PRESENCE_LEFT_TIMEOUT: int = 300  # 5 minutes after leaving
+# sweep_presence --loop runs this often, a single process sweeps per interval however many are running
+ROOM_PRESENCE_SWEEP_INTERVAL: int = 60  # 1 minute
+ROOM_PRESENCE_SWEEP_BATCH_SIZE: int = 1000
+
+ROOM_REPLAY_BACKEND: str = 'chat.replay.RedisReplayBackend'
+# Messages kept per room for reconnecting clients to catch up with, see chat.replay
+ROOM_REPLAY_BUFFER_SIZE: int = 200
+ROOM_REPLAY_TIMEOUT: int = 86400  # 1 day, the events of rooms quiet for that long are dropped
+# How long after a connection closed it can be resumed
+RESUME_TIMEOUT: int = 120  # 2 minutes
+
+# Process-local room cache used by the websocket consumers, see chat.room_cache
+ROOM_CACHE_SIZE: int = 1024
+ROOM_CACHE_TIMEOUT: int = 60  # 1 minute
+
+# Old versions of the serialized room list of the index page are dropped after this, see chat.room_list
+ROOM_LIST_CACHE_TIMEOUT: int = 86400  # 1 day
+# Pages of the room directory, the index page embeds the first one
+ROOM_DIRECTORY_PAGE_SIZE: int = 50
+ROOM_DIRECTORY_MAX_PAGE_SIZE: int = 100
+
+# Process-local cache of the users of websocket handshakes, see chat.auth
+USER_CACHE_SIZE: int = 10000
+USER_CACHE_TIMEOUT: int = 30  # seconds, how long other processes may use a user after they changed
+
+# Messages are saved in batches, see chat.writer
+MESSAGE_WRITER_BATCH_SIZE: int = 100
+MESSAGE_WRITER_FLUSH_INTERVAL: int = 500  # milliseconds
+# Messages waiting to be saved, past that sending fails with SERVER_BUSY until the database caught up
+MESSAGE_WRITER_MAX_BUFFERED: int = 10000
+
+# Pages of the "history" websocket command
+HISTORY_PAGE_SIZE: int = 50
+HISTORY_MAX_PAGE_SIZE: int = 100
+
+# ORM calls of the websocket consumers run in a thread pool of their own, see chat.db
+DB_EXECUTOR_WORKERS: int = 10
+# Calls waiting for one of its threads, past that commands fail with SERVER_BUSY rather than queue up
+DB_EXECUTOR_QUEUE_SIZE: int = 100
+# Connections idle for this long are checked before use, in case the database dropped them
+DB_HEALTH_CHECK_INTERVAL: int = 30  # seconds
+
+# Every process publishes its metrics to Redis this often, so /metrics adds them all up, see chat.metrics
+METRICS_PUSH_INTERVAL: int = 15  # seconds, 0 only exposes the metrics of the process serving /metrics
+# When set, /metrics requires an "Authorization: Bearer <token>" header, otherwise a staff login unless DEBUG
+METRICS_TOKEN: str = os.environ.get('METRICS_TOKEN', '')
 
 ##### Normal Django settings
 
@@ -87,7 +175,7 @@ INSTALLED_APPS = [
     'allauth.account',  # registration
     'allauth.socialaccount',  # registration
     'channels',
-    'chat',
+    'chat.apps.ChatConfig',
     'users.apps.UserConfig',
 ]
 
@@ -129,7 +217,9 @@ WSGI_APPLICATION = 'whisper.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/dev/ref/settings/#databases
-DATABASES = {'default': dj_database_url.config()}
+# Connections are kept open for 10 minutes, one per thread of chat.db.db_executor, so the database has to
+# allow DB_EXECUTOR_WORKERS of them per websocket process on top of the HTTP ones
+DATABASES = {'default': dj_database_url.config(conn_max_age=600)}
 
 
 # Password validation
@@ -185,6 +275,11 @@ else:
             'LOCATION': 'unique-snowflake',
         }
     }
+    ROOM_PRESENCE_BACKEND = 'chat.presence.LocMemPresenceBackend'
+    # Connections left open by the thread pools would keep the test database from being dropped
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    ROOM_REPLAY_BACKEND = 'chat.replay.LocMemReplayBackend'
+    METRICS_PUSH_INTERVAL = 0
     WHITENOISE_AUTOREFRESH = True
     STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
     PASSWORD_HASHERS = ['django.contrib.auth.hashers.UnsaltedMD5PasswordHasher']
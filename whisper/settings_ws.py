@@ -0,0 +1,20 @@
+"""
+Settings of the workers only serving websockets, see ``whisper/asgi_ws.py``.
+
+The same as ``whisper.settings`` with only the apps ``ChatConsumer`` needs, so
+starting a worker doesn't load the admin, allauth, crispy forms or the static
+files. Sessions live in the cache, the sessions app isn't needed to read them.
+"""
+from whisper.settings import *  # noqa
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'chat.apps.ChatConfig',
+    'users.apps.UserConfig',
+]
+
+# Nothing but the websockets is served, HTTP requests get Django's plain 404 page
+MIDDLEWARE = []
+ROOT_URLCONF = 'whisper.urls_ws'
+TEMPLATES = []
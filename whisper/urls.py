@@ -5,7 +5,10 @@ from django.contrib import admin
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.urls import path, include
 
+from chat.views import metrics
+
 urlpatterns = [
+    path('metrics', metrics, name='metrics'),
     url(r'', include('chat.urls', namespace='chat')),
     url(r'^users/', include('users.urls', namespace='users')),
     url(r'^accounts/', include('allauth.urls')),
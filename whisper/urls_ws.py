@@ -0,0 +1,2 @@
+# The websocket workers serve no pages, see whisper.settings_ws
+urlpatterns = []